@@ -7,6 +7,7 @@ code.google.com/p/appengine-ndb-experiment/source/browse/ndb/ndb_test.py
 """
 
 
+import importlib
 import os
 import subprocess
 import sys
@@ -15,7 +16,8 @@ import unittest
 import test_utils
 
 
-MODULES_TO_TEST = ['utils']
+MODULES_TO_TEST = ['utils', 'ndb.cache', 'ndb.index_advisor', 'ndb.model',
+                   'ndb.page_token']
 NO_DEVAPPSERVER_TEMPLATE = ('Either dev appserver file path %r does not exist '
                             'or dev_appserver.py is not on your PATH.')
 
@@ -65,15 +67,14 @@ def load_tests(import_location):
     Instance of unittest.TestSuite containing all tests from the modules in
         this library.
   """
-  test_modules = ['%s_test' % name for name in MODULES_TO_TEST]
-  endpoints_proto_datastore = __import__(import_location,
-                                         fromlist=test_modules, level=1)
+  # Modules in subpackages are named relative to the package, e.g. ndb.model
+  test_modules = ['%s.%s_test' % (import_location, name)
+                  for name in MODULES_TO_TEST]
 
   loader = unittest.TestLoader()
   suite = unittest.TestSuite()
 
-  for module in [getattr(endpoints_proto_datastore, name)
-                 for name in test_modules]:
+  for module in [importlib.import_module(name) for name in test_modules]:
     for name in set(dir(module)):
       try:
         if issubclass(getattr(module, name), unittest.TestCase):
@@ -1,8 +1,14 @@
 __all__ = []
 
+from cache import *
+__all__ += cache.__all__
+
 from model import *
 __all__ += model.__all__
 
+from page_token import *
+__all__ += page_token.__all__
+
 from properties import *
 __all__ += properties.__all__
 
@@ -0,0 +1,816 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Process-local caches used by EndpointsModel.
+
+These caches sit in front of the NDB context cache and memcache, and are shared
+by every request served by the same instance. They are opted into per model
+class by setting a class attribute, for example:
+
+  class Profile(EndpointsModel):
+    _entity_cache = EntityCache(max_size=1000, ttl=60)
+    _missing_key_cache = MissingKeyCache(max_size=10000, ttl=30)
+    _key_get_coalescer = KeyGetCoalescer()
+    _query_result_cache = QueryResultCache(max_size=1000, ttl=60)
+    _page_prefetcher = PagePrefetcher(max_size=100, ttl=30, max_in_flight=2)
+"""
+
+import logging
+import threading
+import time
+
+from .. import utils
+
+from protorpc import protobuf
+
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import eventloop
+
+
+__all__ = ['EntityCache', 'KeyGetCoalescer', 'MissingKeyCache',
+           'PagePrefetcher', 'QueryResultCache']
+
+
+ENTITY_CACHE_SIZE_DEFAULT = 1000
+MISSING_KEY_CACHE_SIZE_DEFAULT = 10000
+MISSING_KEY_TTL_DEFAULT = 30
+QUERY_RESULT_CACHE_SIZE_DEFAULT = 1000
+QUERY_RESULT_TTL_DEFAULT = 60
+PREFETCH_CACHE_SIZE_DEFAULT = 100
+PREFETCH_TTL_DEFAULT = 30
+PREFETCH_MAX_IN_FLIGHT_DEFAULT = 2
+COALESCED_GET_TIMEOUT_DEFAULT = 10
+
+
+def _CompletedFuture(result):
+  """Creates an NDB future which already has a result.
+
+  Args:
+    result: The result of the future.
+
+  Returns:
+    An NDB future whose result is the value passed in.
+  """
+  future = ndb.Future()
+  future.set_result(result)
+  return future
+
+
+def _SerializeEntity(entity):
+  """Serializes an entity so it can be shared between requests.
+
+  Args:
+    entity: An NDB entity or None.
+
+  Returns:
+    The serialized entity protocol buffer, or None if entity is None.
+  """
+  if entity is None:
+    return None
+  return entity._to_pb().Encode()
+
+
+def _DeserializeEntity(serialized):
+  """Builds a new entity from one serialized by _SerializeEntity.
+
+  Args:
+    serialized: A serialized entity protocol buffer or None.
+
+  Returns:
+    A new NDB entity, or None if serialized is None.
+  """
+  if serialized is None:
+    return None
+  return ndb.ModelAdapter().pb_to_entity(entity_pb.EntityProto(serialized))
+
+
+class EntityCache(object):
+  """A read-through cache of entities, keyed by NDB key.
+
+  Entities are stored as serialized protocol buffers, so that each read returns
+  a fresh entity which can be modified without affecting the cached copy.
+
+  Every invalidation bumps a version stamp for the kind of the key. A get which
+  misses records the version of its kind when it was issued and only fills the
+  cache if the version is unchanged when the get completes. This way a put or
+  delete in this process which races a get can't be undone by the (possibly
+  stale) result of the get, while writes to other kinds don't keep gets from
+  filling the cache. Writes made by other instances are only bounded by the
+  time to live.
+  """
+
+  def __init__(self, max_size=ENTITY_CACHE_SIZE_DEFAULT, ttl=None):
+    """Constructor for EntityCache.
+
+    Args:
+      max_size: An optional maximum number of entities to cache. Defaults to
+          ENTITY_CACHE_SIZE_DEFAULT.
+      ttl: An optional number of seconds an entity is cached for. Defaults to
+          None, in which case entities are held until evicted or invalidated.
+    """
+    self._entries = utils.LRUCache(max_size, ttl=ttl)
+    self._lock = threading.Lock()
+    self._versions = {}
+    self._clears = 0
+
+  @property
+  def hits(self):
+    """The number of gets served from the cache."""
+    return self._entries.hits
+
+  @property
+  def misses(self):
+    """The number of gets which went to the datastore."""
+    return self._entries.misses
+
+  @property
+  def evictions(self):
+    """The number of entities evicted to make room for others."""
+    return self._entries.evictions
+
+  @property
+  def hit_rate(self):
+    """The fraction of gets served from the cache."""
+    return self._entries.hit_rate
+
+  def Version(self, kind):
+    """Gets the current version stamp of a kind.
+
+    Args:
+      kind: The name of a datastore kind.
+
+    Returns:
+      A value which changes every time an entity of the kind is invalidated or
+          the cache is cleared.
+    """
+    return self._clears, self._versions.get(kind, 0)
+
+  def Get(self, key):
+    """Gets an entity from the cache.
+
+    Args:
+      key: An NDB key.
+
+    Returns:
+      A new entity built from the cached copy, or None if the key is not cached.
+    """
+    return _DeserializeEntity(self._entries.Get(key))
+
+  def Set(self, key, entity, version):
+    """Stores an entity in the cache.
+
+    Args:
+      key: The NDB key of the entity.
+      entity: The entity retrieved from the datastore.
+      version: The version stamp of the kind of the key when the get was
+          issued.
+
+    Returns:
+      Boolean indicating whether or not the entity was stored. It is not stored
+          if the kind has been invalidated since the get was issued.
+    """
+    serialized = _SerializeEntity(entity)
+    with self._lock:
+      if version != self.Version(key.kind()):
+        return False
+      self._entries.Set(key, serialized)
+    return True
+
+  def Invalidate(self, key):
+    """Removes an entity from the cache and bumps the version of its kind.
+
+    Args:
+      key: The NDB key of an entity which has been written or deleted.
+    """
+    kind = key.kind()
+    with self._lock:
+      self._versions[kind] = self._versions.get(kind, 0) + 1
+      self._entries.Delete(key)
+
+  def Clear(self):
+    """Removes all entities from the cache and bumps every version stamp."""
+    with self._lock:
+      self._clears += 1
+      self._entries.Clear()
+
+  def GetAsync(self, key, get_async=None):
+    """Gets an entity, from the cache if possible, else from the datastore.
+
+    Args:
+      key: An NDB key.
+      get_async: An optional callable which takes the key and returns an NDB
+          future for the entity, used if the key is not cached. Defaults to
+          None, in which case key.get_async is used.
+
+    Returns:
+      An NDB future whose result is the entity, or None if there is no entity
+          for the key.
+    """
+    entity = self.Get(key)
+    if entity is not None:
+      return _CompletedFuture(entity)
+
+    version = self.Version(key.kind())
+    if get_async is None:
+      future = key.get_async()
+    else:
+      future = get_async(key)
+    return self._FillAsync(key, future, version)
+
+  @ndb.tasklet
+  def _FillAsync(self, key, future, version):
+    """Waits on a get and stores the entity in the cache.
+
+    Args:
+      key: An NDB key.
+      future: An NDB future for the get of the key.
+      version: The version stamp of the kind of the key when the get was
+          issued.
+
+    Returns:
+      An NDB future whose result is the entity, or None if there is no entity
+          for the key.
+    """
+    entity = yield future
+    if entity is not None:
+      self.Set(key, entity, version)
+    raise ndb.Return(entity)
+
+
+class MissingKeyCache(object):
+  """A cache of keys which have no entity in the datastore.
+
+  Repeated gets for keys which don't exist are answered from the cache rather
+  than by a datastore get. Since a key may be written by another instance, keys
+  are only cached for a limited time. Puts in the same process remove the key
+  from the cache, and as with EntityCache, a version stamp per kind keeps a get
+  which races a put from recording the key as missing.
+
+  Puts made by other instances are not seen, so the time to live is the bound
+  on how long this instance keeps reporting a key created elsewhere as missing.
+  It should be kept short for kinds whose entities are created by one request
+  and read by the next, which may be served by a different instance.
+  """
+
+  def __init__(self, max_size=MISSING_KEY_CACHE_SIZE_DEFAULT,
+               ttl=MISSING_KEY_TTL_DEFAULT):
+    """Constructor for MissingKeyCache.
+
+    Args:
+      max_size: An optional maximum number of keys to cache. Defaults to
+          MISSING_KEY_CACHE_SIZE_DEFAULT.
+      ttl: An optional number of seconds a key is cached for, which bounds
+          how stale a cached key can be. Defaults to MISSING_KEY_TTL_DEFAULT.
+
+    Raises:
+      TypeError: if ttl is None, since missing keys must expire.
+    """
+    if ttl is None:
+      raise TypeError('Missing keys must be cached with a time to live.')
+    self._entries = utils.LRUCache(max_size, ttl=ttl)
+    self._lock = threading.Lock()
+    self._versions = {}
+    self._clears = 0
+
+  @property
+  def hits(self):
+    """The number of gets answered by the cache."""
+    return self._entries.hits
+
+  @property
+  def misses(self):
+    """The number of gets which went to the datastore."""
+    return self._entries.misses
+
+  @property
+  def evictions(self):
+    """The number of keys evicted to make room for others."""
+    return self._entries.evictions
+
+  @property
+  def hit_rate(self):
+    """The fraction of gets answered by the cache."""
+    return self._entries.hit_rate
+
+  def Version(self, kind):
+    """Gets the current version stamp of a kind.
+
+    Args:
+      kind: The name of a datastore kind.
+
+    Returns:
+      A value which changes every time a key of the kind is invalidated or the
+          cache is cleared.
+    """
+    return self._clears, self._versions.get(kind, 0)
+
+  def IsMissing(self, key):
+    """Checks if a key is known to have no entity.
+
+    Args:
+      key: An NDB key.
+
+    Returns:
+      Boolean indicating whether or not the key was recently found missing.
+    """
+    return self._entries.Get(key, default=False)
+
+  def Add(self, key, version):
+    """Records that a key has no entity.
+
+    Args:
+      key: An NDB key.
+      version: The version stamp of the kind of the key when the get was
+          issued.
+
+    Returns:
+      Boolean indicating whether or not the key was recorded. It is not recorded
+          if the kind has been invalidated since the get was issued.
+    """
+    with self._lock:
+      if version != self.Version(key.kind()):
+        return False
+      self._entries.Set(key, True)
+    return True
+
+  def Invalidate(self, key):
+    """Removes a key from the cache and bumps the version of its kind.
+
+    Args:
+      key: The NDB key of an entity which has been written.
+    """
+    kind = key.kind()
+    with self._lock:
+      self._versions[kind] = self._versions.get(kind, 0) + 1
+      self._entries.Delete(key)
+
+  def Clear(self):
+    """Removes all keys from the cache and bumps every version stamp."""
+    with self._lock:
+      self._clears += 1
+      self._entries.Clear()
+
+  def GetAsync(self, key, get_async):
+    """Gets an entity unless the key is known to be missing.
+
+    Args:
+      key: An NDB key.
+      get_async: A callable which takes the key and returns an NDB future for
+          the entity, used if the key is not cached.
+
+    Returns:
+      An NDB future whose result is the entity, or None if there is no entity
+          for the key.
+    """
+    if self.IsMissing(key):
+      return _CompletedFuture(None)
+    version = self.Version(key.kind())
+    return self._RecordMissingAsync(key, get_async(key), version)
+
+  @ndb.tasklet
+  def _RecordMissingAsync(self, key, future, version):
+    """Waits on a get and records the key if there is no entity.
+
+    Args:
+      key: An NDB key.
+      future: An NDB future for the get of the key.
+      version: The version stamp of the kind of the key when the get was
+          issued.
+
+    Returns:
+      An NDB future whose result is the entity, or None if there is no entity
+          for the key.
+    """
+    entity = yield future
+    if entity is None:
+      self.Add(key, version)
+    raise ndb.Return(entity)
+
+
+class KeyGetCoalescer(object):
+  """Coalesces concurrent gets of the same key made by different requests.
+
+  When several threads of a threadsafe instance get the same key at the same
+  time, only the first issues a datastore get and the others share its result.
+  The shared get skips the NDB context cache, so no state of the request which
+  issued it leaks into the others, and the entity is shared in serialized form,
+  so each request receives its own copy. Gets made in a transaction are never
+  coalesced.
+
+  NDB futures belong to the thread which created them, so a get sharing the
+  result of the same thread waits on the future of the first get, and a get
+  sharing the result of another thread only waits for it once its own event
+  loop has nothing else to run. If the other thread takes longer than the
+  timeout, the get is issued again rather than waiting any longer.
+  """
+
+  def __init__(self, timeout=COALESCED_GET_TIMEOUT_DEFAULT):
+    """Constructor for KeyGetCoalescer.
+
+    Args:
+      timeout: An optional number of seconds to wait for the get of another
+          thread. Defaults to COALESCED_GET_TIMEOUT_DEFAULT.
+    """
+    self._flight = utils.SingleFlight()
+    self._timeout = timeout
+
+  @property
+  def shared(self):
+    """The number of gets which shared the result of another get."""
+    return self._flight.shared
+
+  def Get(self, key):
+    """Gets an entity, sharing the get with concurrent gets of the same key.
+
+    Args:
+      key: An NDB key.
+
+    Returns:
+      The entity, or None if there is no entity for the key.
+    """
+    return self.GetAsync(key).get_result()
+
+  def GetAsync(self, key):
+    """Same as Get, but returns an NDB future for the entity.
+
+    Args:
+      key: An NDB key.
+
+    Returns:
+      An NDB future whose result is the entity, or None if there is no entity
+          for the key.
+    """
+    if ndb.in_transaction():
+      return key.get_async()
+
+    call, leader = self._flight.Join(key)
+    if leader:
+      call.handle = self._LeadAsync(key, call)
+      return call.handle
+    if call.owner == threading.current_thread().ident:
+      # The get runs on the event loop of this thread, so blocking on it would
+      # never let it complete
+      return self._CopyAsync(call.handle)
+    return self._FollowAsync(key, call)
+
+  @ndb.tasklet
+  def _LeadAsync(self, key, call):
+    """Gets an entity and shares it with the gets waiting on the call.
+
+    Args:
+      key: An NDB key.
+      call: The state of the call returned by SingleFlight.Join.
+
+    Returns:
+      An NDB future whose result is the entity, or None if there is no entity
+          for the key.
+    """
+    # The call is finished even if the tasklet is interrupted, for example by
+    # a deadline, else later gets of the key would wait on it
+    outcome = {'error': RuntimeError('The get of %r was interrupted.' % key)}
+    try:
+      entity = yield key.get_async(use_cache=False)
+      outcome = {'result': _SerializeEntity(entity)}
+    except Exception as error:
+      outcome = {'error': error}
+      raise
+    finally:
+      self._flight.Finish(key, call, **outcome)
+    raise ndb.Return(entity)
+
+  @ndb.tasklet
+  def _CopyAsync(self, leader_future):
+    """Copies the entity of a get made by the same thread.
+
+    Args:
+      leader_future: The NDB future of the get.
+
+    Returns:
+      An NDB future whose result is a copy of the entity, or None if there is
+          no entity for the key.
+    """
+    entity = yield leader_future
+    raise ndb.Return(_DeserializeEntity(_SerializeEntity(entity)))
+
+  @ndb.tasklet
+  def _FollowAsync(self, key, call):
+    """Shares the result of a get made by another thread.
+
+    Args:
+      key: An NDB key.
+      call: The state of the call returned by SingleFlight.Join.
+
+    Returns:
+      An NDB future whose result is a copy of the entity, or None if there is
+          no entity for the key.
+    """
+    shared = ndb.Future()
+    deadline = time.time() + self._timeout
+
+    def ShareResult():
+      """Completes the shared future once this thread has nothing else to run.
+
+      Returns:
+        False to be called again once the other work of this thread is done,
+            or None once the shared future is complete.
+      """
+      if not call.done.is_set():
+        event_loop = eventloop.get_event_loop()
+        if event_loop.current or event_loop.queue or event_loop.rpcs:
+          return False
+      try:
+        shared.set_result(call.Wait(timeout=max(0, deadline - time.time())))
+      except Exception as error:  # pylint:disable-msg=W0703
+        shared.set_exception(error)
+      return None
+
+    eventloop.add_idle(ShareResult)
+    try:
+      serialized = yield shared
+    except utils.FlightTimeoutError:
+      logging.warning('Timed out sharing the get of %r, getting it again.',
+                      key)
+      entity = yield key.get_async(use_cache=False)
+      raise ndb.Return(entity)
+    raise ndb.Return(_DeserializeEntity(serialized))
+
+
+class QueryResultCache(object):
+  """A cache of query result messages, invalidated by writes to their kind.
+
+  Messages are stored in serialized form under a key which describes the query
+  and a generation counter for the kind of the query. A put or delete of an
+  entity of the kind in this process bumps the counter, so the pages cached
+  before the write are no longer found and age out of the cache. A page whose
+  query started before a write is not stored. Writes made by other instances,
+  and writes to the kinds of any entities embedded in the messages, are only
+  bounded by the time to live.
+  """
+
+  def __init__(self, max_size=QUERY_RESULT_CACHE_SIZE_DEFAULT,
+               ttl=QUERY_RESULT_TTL_DEFAULT):
+    """Constructor for QueryResultCache.
+
+    Args:
+      max_size: An optional maximum number of messages to cache. Defaults to
+          QUERY_RESULT_CACHE_SIZE_DEFAULT.
+      ttl: An optional number of seconds a message is cached for. Defaults to
+          QUERY_RESULT_TTL_DEFAULT.
+
+    Raises:
+      TypeError: if ttl is None, since results must expire.
+    """
+    if ttl is None:
+      raise TypeError('Query results must be cached with a time to live.')
+    self._entries = utils.LRUCache(max_size, ttl=ttl)
+    self._generations = {}
+    self._lock = threading.Lock()
+
+  @property
+  def hits(self):
+    """The number of queries answered by the cache."""
+    return self._entries.hits
+
+  @property
+  def misses(self):
+    """The number of queries which went to the datastore."""
+    return self._entries.misses
+
+  @property
+  def evictions(self):
+    """The number of messages evicted to make room for others."""
+    return self._entries.evictions
+
+  @property
+  def hit_rate(self):
+    """The fraction of queries answered by the cache."""
+    return self._entries.hit_rate
+
+  def Generation(self, kind):
+    """Gets the current generation of a kind.
+
+    Args:
+      kind: The name of a datastore kind.
+
+    Returns:
+      An integer which changes every time the kind is invalidated.
+    """
+    return self._generations.get(kind, 0)
+
+  def Invalidate(self, kind):
+    """Invalidates all cached results for queries of a kind.
+
+    Args:
+      kind: The name of a datastore kind which has been written to.
+    """
+    with self._lock:
+      self._generations[kind] = self._generations.get(kind, 0) + 1
+
+  def Clear(self):
+    """Removes all results from the cache."""
+    self._entries.Clear()
+
+  def Contains(self, kind, cache_key):
+    """Checks whether a result is cached, without counting a hit or miss.
+
+    Args:
+      kind: The kind of the query.
+      cache_key: A hashable key describing the query.
+
+    Returns:
+      Boolean indicating whether or not a result is cached for the current
+          generation of the kind.
+    """
+    return (kind, self.Generation(kind), cache_key) in self._entries
+
+  def Get(self, kind, cache_key, message_class):
+    """Gets a cached result.
+
+    Args:
+      kind: The kind of the query.
+      cache_key: A hashable key describing the query.
+      message_class: The ProtoRPC message class of the result.
+
+    Returns:
+      A new instance of message_class, or None if there is no result cached
+          for the current generation of the kind.
+    """
+    serialized = self._entries.Get((kind, self.Generation(kind), cache_key))
+    if serialized is None:
+      return None
+    return protobuf.decode_message(message_class, serialized)
+
+  def Set(self, kind, cache_key, message, generation):
+    """Stores a result in the cache.
+
+    Args:
+      kind: The kind of the query.
+      cache_key: A hashable key describing the query.
+      message: The ProtoRPC message resulting from the query.
+      generation: The generation of the kind when the query was started.
+
+    Returns:
+      Boolean indicating whether or not the result was stored. It is not stored
+          if the kind has been invalidated since the query was started.
+    """
+    if generation != self.Generation(kind):
+      return False
+    self._entries.Set((kind, generation, cache_key),
+                      protobuf.encode_message(message))
+    return True
+
+
+class PagePrefetcher(object):
+  """Fetches the next page of query results before it is requested.
+
+  After a query method gets a page with a next page token, the next page is
+  fetched and converted in a separate thread, with its own NDB context, and
+  stored in a short-lived QueryResultCache, so a client paging through results
+  gets it from memory while the response to the current page is not held up.
+  The number of pages being prefetched at once is bounded per instance, and a
+  page which is already cached or being prefetched is not fetched again, so
+  prefetching can at most double the queries of a client. As for the query
+  result cache, writes to the kind in this process invalidate the pages.
+
+  Threads started by a request on an automatically scaled App Engine instance
+  are bound to that request. On instances with manual or basic scaling, pass
+  google.appengine.api.background_thread.BackgroundThread as thread_class so
+  prefetches run independently of the request.
+
+  Attributes:
+    started: The number of prefetches started.
+    skipped: The number of prefetches not started because the budget was used
+        up.
+  """
+
+  def __init__(self, max_size=PREFETCH_CACHE_SIZE_DEFAULT,
+               ttl=PREFETCH_TTL_DEFAULT,
+               max_in_flight=PREFETCH_MAX_IN_FLIGHT_DEFAULT,
+               thread_class=threading.Thread):
+    """Constructor for PagePrefetcher.
+
+    Args:
+      max_size: An optional maximum number of pages to keep. Defaults to
+          PREFETCH_CACHE_SIZE_DEFAULT.
+      ttl: An optional number of seconds a page is kept for. Defaults to
+          PREFETCH_TTL_DEFAULT.
+      max_in_flight: An optional positive integer, defaults to
+          PREFETCH_MAX_IN_FLIGHT_DEFAULT. The maximum number of pages being
+          prefetched at once.
+      thread_class: An optional threading.Thread subclass used to run the
+          prefetches. Defaults to threading.Thread.
+
+    Raises:
+      TypeError: if max_in_flight is not a positive integer.
+    """
+    if not isinstance(max_in_flight, (int, long)) or max_in_flight < 1:
+      raise TypeError('The number of pages prefetched at once must be a '
+                      'positive integer. Received %r.' % (max_in_flight,))
+    self._pages = QueryResultCache(max_size=max_size, ttl=ttl)
+    self._max_in_flight = max_in_flight
+    self._thread_class = thread_class
+    self._in_flight = set()
+    self._lock = threading.Lock()
+    self.started = 0
+    self.skipped = 0
+
+  @property
+  def hits(self):
+    """The number of pages served from the prefetched pages."""
+    return self._pages.hits
+
+  @property
+  def misses(self):
+    """The number of pages which had not been prefetched."""
+    return self._pages.misses
+
+  @property
+  def hit_rate(self):
+    """The fraction of pages served from the prefetched pages."""
+    return self._pages.hit_rate
+
+  def Invalidate(self, kind):
+    """Invalidates all prefetched pages for queries of a kind.
+
+    Args:
+      kind: The name of a datastore kind which has been written to.
+    """
+    self._pages.Invalidate(kind)
+
+  def Clear(self):
+    """Removes all prefetched pages."""
+    self._pages.Clear()
+
+  def Get(self, kind, cache_key, message_class):
+    """Gets a prefetched page.
+
+    Args:
+      kind: The kind of the query.
+      cache_key: A hashable key describing the query and its start cursor.
+      message_class: The ProtoRPC message class of the page.
+
+    Returns:
+      A new instance of message_class, or None if the page has not been
+          prefetched.
+    """
+    return self._pages.Get(kind, cache_key, message_class)
+
+  def Prefetch(self, kind, cache_key, fetch_async):
+    """Starts prefetching a page unless it is not needed or over budget.
+
+    Args:
+      kind: The kind of the query.
+      cache_key: A hashable key describing the query and its start cursor.
+      fetch_async: A function which takes no arguments and returns an NDB
+          future for the ProtoRPC message for the page. It is called in the
+          thread of the prefetch.
+
+    Returns:
+      The started thread, which completes once the page has been stored, or
+          None if the prefetch was not started.
+    """
+    if self._pages.Contains(kind, cache_key):
+      return None
+    with self._lock:
+      if cache_key in self._in_flight:
+        return None
+      if len(self._in_flight) >= self._max_in_flight:
+        self.skipped += 1
+        return None
+      self._in_flight.add(cache_key)
+      self.started += 1
+
+    # A page whose query started before a write to the kind is not stored
+    generation = self._pages.Generation(kind)
+    thread = self._thread_class(
+        target=self._Prefetch,
+        args=(kind, cache_key, fetch_async, generation))
+    thread.daemon = True
+    try:
+      thread.start()
+    except Exception:
+      with self._lock:
+        self._in_flight.discard(cache_key)
+      raise
+    return thread
+
+  def _Prefetch(self, kind, cache_key, fetch_async, generation):
+    """Fetches a page and stores it, in the thread started by Prefetch.
+
+    A failure is logged rather than raised, since the page was not requested.
+
+    Args:
+      kind: The kind of the query.
+      cache_key: A hashable key describing the query and its start cursor.
+      fetch_async: A function which takes no arguments and returns an NDB
+          future for the ProtoRPC message for the page.
+      generation: The generation of the kind before the page was fetched.
+    """
+    try:
+      page = fetch_async().get_result()
+      self._pages.Set(kind, cache_key, page, generation)
+    except Exception:  # pylint:disable-msg=W0703
+      logging.exception('Prefetching a page of %s failed.', kind)
+    finally:
+      with self._lock:
+        self._in_flight.discard(cache_key)
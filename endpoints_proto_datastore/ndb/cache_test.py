@@ -0,0 +1,334 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Tests for ndb/cache.py."""
+
+
+import threading
+import time
+import unittest
+
+from protorpc import messages
+
+from . import cache
+from .. import utils
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+
+class Note(ndb.Model):
+  """Simple model used to test the caches."""
+  text = ndb.StringProperty()
+
+
+class Task(ndb.Model):
+  """Model of a second kind used to test the caches."""
+  done = ndb.BooleanProperty()
+
+
+class NoteMessage(messages.Message):
+  """Simple message used to test QueryResultCache."""
+  text = messages.StringField(1)
+
+
+def _CompletedFuture(result):
+  """Creates an NDB future which already has a result."""
+  future = ndb.Future()
+  future.set_result(result)
+  return future
+
+
+class CacheTests(unittest.TestCase):
+  """Comprehensive test for the endpoints_proto_datastore.ndb.cache module."""
+
+  def setUp(self):
+    """Activates the datastore stub and turns off the NDB caches."""
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    context = ndb.get_context()
+    context.set_cache_policy(False)
+    context.set_memcache_policy(False)
+
+  def tearDown(self):
+    """Deactivates the stubs."""
+    self.testbed.deactivate()
+
+  def testEntityCache(self):
+    """Tests the cache.EntityCache class."""
+    entity_cache = cache.EntityCache(max_size=10)
+    key = Note(text='a').put()
+
+    entity = entity_cache.GetAsync(key).get_result()
+    self.assertEqual(entity.text, 'a')
+    self.assertEqual((entity_cache.hits, entity_cache.misses), (0, 1))
+
+    # Each read returns a new copy of the cached entity
+    cached = entity_cache.GetAsync(key).get_result()
+    self.assertEqual(cached, entity)
+    self.assertFalse(cached is entity)
+    cached.text = 'b'
+    self.assertEqual(entity_cache.Get(key).text, 'a')
+    self.assertEqual(entity_cache.hits, 2)
+    self.assertEqual(entity_cache.hit_rate, 2.0 / 3)
+
+    # Missing entities are not cached
+    missing_key = ndb.Key(Note, 'missing')
+    self.assertEqual(entity_cache.GetAsync(missing_key).get_result(), None)
+    self.assertEqual(entity_cache.Get(missing_key), None)
+
+    entity_cache.Invalidate(key)
+    self.assertEqual(entity_cache.Get(key), None)
+
+    # A custom get is only used when the key is not cached
+    gets = []
+    def GetAsync(key):
+      gets.append(key)
+      return _CompletedFuture(Note(key=key, text='c'))
+    self.assertEqual(entity_cache.GetAsync(key, GetAsync).get_result().text,
+                     'c')
+    self.assertEqual(entity_cache.GetAsync(key, GetAsync).get_result().text,
+                     'c')
+    self.assertEqual(gets, [key])
+
+    entity_cache.Clear()
+    self.assertEqual(entity_cache.Get(key), None)
+
+  def testEntityCacheVersions(self):
+    """Tests that gets racing an invalidation don't fill cache.EntityCache."""
+    entity_cache = cache.EntityCache()
+    note_key = Note(text='a').put()
+    task_key = Task(done=True).put()
+
+    version = entity_cache.Version('Note')
+    task_version = entity_cache.Version('Task')
+    entity_cache.Invalidate(note_key)
+    self.assertNotEqual(entity_cache.Version('Note'), version)
+    self.assertFalse(entity_cache.Set(note_key, Note(text='stale'), version))
+    self.assertEqual(entity_cache.Get(note_key), None)
+
+    # Versions are kept per kind
+    self.assertEqual(entity_cache.Version('Task'), task_version)
+    self.assertTrue(entity_cache.Set(task_key, Task(done=True), task_version))
+
+    # A get issued before an invalidation completes without filling the cache
+    future = entity_cache.GetAsync(note_key)
+    entity_cache.Invalidate(note_key)
+    self.assertEqual(future.get_result().text, 'a')
+    self.assertEqual(entity_cache.Get(note_key), None)
+
+    # Clearing the cache bumps the versions of every kind
+    entity_cache.Clear()
+    self.assertNotEqual(entity_cache.Version('Task'), task_version)
+    self.assertFalse(entity_cache.Set(task_key, Task(done=True), task_version))
+
+  def testMissingKeyCache(self):
+    """Tests the cache.MissingKeyCache class."""
+    self.assertRaises(TypeError, cache.MissingKeyCache, ttl=None)
+
+    missing_cache = cache.MissingKeyCache(max_size=10)
+    gets = []
+    def GetAsync(key):
+      gets.append(key)
+      return key.get_async()
+
+    missing_key = ndb.Key(Note, 'missing')
+    self.assertEqual(missing_cache.GetAsync(missing_key,
+                                            GetAsync).get_result(), None)
+    self.assertTrue(missing_cache.IsMissing(missing_key))
+    self.assertEqual(missing_cache.GetAsync(missing_key,
+                                            GetAsync).get_result(), None)
+    self.assertEqual(gets, [missing_key])
+
+    # Existing entities are not recorded
+    key = Note(text='a').put()
+    self.assertEqual(missing_cache.GetAsync(key, GetAsync).get_result().text,
+                     'a')
+    self.assertFalse(missing_cache.IsMissing(key))
+
+    # A put of the key in this process removes it
+    missing_cache.Invalidate(missing_key)
+    self.assertFalse(missing_cache.IsMissing(missing_key))
+
+    # A get issued before the invalidation does not record the key
+    version = missing_cache.Version('Note')
+    missing_cache.Invalidate(missing_key)
+    self.assertFalse(missing_cache.Add(missing_key, version))
+    self.assertTrue(missing_cache.Add(ndb.Key(Task, 'missing'),
+                                      missing_cache.Version('Task')))
+
+    missing_cache.Clear()
+    self.assertFalse(missing_cache.IsMissing(ndb.Key(Task, 'missing')))
+
+  def testMissingKeyCacheTtl(self):
+    """Tests that keys put elsewhere are only missing until the ttl."""
+    now = [100.0]
+    missing_cache = cache.MissingKeyCache(max_size=10, ttl=30)
+    # pylint:disable-msg=W0212
+    missing_cache._entries = utils.LRUCache(10, ttl=30, clock=lambda: now[0])
+    # pylint:enable-msg=W0212
+
+    missing_key = ndb.Key(Note, 'created-elsewhere')
+    self.assertEqual(missing_cache.GetAsync(
+        missing_key, lambda key: key.get_async()).get_result(), None)
+
+    # Written without going through the hooks of this process
+    Note(key=missing_key, text='a').put()
+    now[0] = 129.0
+    self.assertEqual(missing_cache.GetAsync(
+        missing_key, lambda key: key.get_async()).get_result(), None)
+    now[0] = 130.0
+    self.assertEqual(missing_cache.GetAsync(
+        missing_key, lambda key: key.get_async()).get_result().text, 'a')
+    self.assertFalse(missing_cache.IsMissing(missing_key))
+
+  def testKeyGetCoalescer(self):
+    """Tests the cache.KeyGetCoalescer class."""
+    coalescer = cache.KeyGetCoalescer()
+    key = Note(text='a').put()
+
+    # The get is in flight until the event loop of this thread runs
+    future = coalescer.GetAsync(key)
+    shared = []
+    def ShareGet():
+      shared.append(coalescer.GetAsync(key).get_result())
+    follower = threading.Thread(target=ShareGet)
+    follower.start()
+    while coalescer.shared == 0:
+      time.sleep(0.001)
+
+    entity = future.get_result()
+    follower.join()
+    self.assertEqual(entity.text, 'a')
+    self.assertEqual(shared, [entity])
+    self.assertFalse(shared[0] is entity)
+
+    # Once complete, the key is retrieved again
+    self.assertEqual(coalescer.Get(ndb.Key(Note, 'missing')), None)
+    self.assertEqual(coalescer.shared, 1)
+
+  def testKeyGetCoalescerSameThread(self):
+    """Tests coalescing gets of the same key made by the same thread."""
+    coalescer = cache.KeyGetCoalescer()
+    key = Note(text='a').put()
+    first = coalescer.GetAsync(key)
+    second = coalescer.GetAsync(key)
+    self.assertEqual(coalescer.shared, 1)
+
+    # Waiting on the second get runs the first one rather than blocking
+    entity = second.get_result()
+    self.assertEqual(entity.text, 'a')
+    self.assertEqual(first.get_result(), entity)
+    self.assertFalse(first.get_result() is entity)
+
+    missing = ndb.Key(Note, 'missing')
+    futures = [coalescer.GetAsync(missing), coalescer.GetAsync(missing)]
+    self.assertEqual([future.get_result() for future in futures],
+                     [None, None])
+
+  def testKeyGetCoalescerTimeout(self):
+    """Tests that a get stops waiting on a stuck get of another thread."""
+    coalescer = cache.KeyGetCoalescer(timeout=0.01)
+    key = Note(text='a').put()
+
+    def JoinAndAbandon():
+      # pylint:disable-msg=W0212
+      coalescer._flight.Join(key)
+      # pylint:enable-msg=W0212
+    stuck = threading.Thread(target=JoinAndAbandon)
+    stuck.start()
+    stuck.join()
+
+    self.assertEqual(coalescer.Get(key).text, 'a')
+    self.assertEqual(coalescer.shared, 1)
+
+  def testKeyGetCoalescerTransaction(self):
+    """Tests that gets in transactions are not coalesced."""
+    coalescer = cache.KeyGetCoalescer()
+    key = Note(text='a').put()
+    future = coalescer.GetAsync(key)
+
+    @ndb.transactional
+    def GetInTransaction():
+      return coalescer.GetAsync(key).get_result()
+
+    self.assertEqual(GetInTransaction().text, 'a')
+    self.assertEqual(future.get_result().text, 'a')
+    self.assertEqual(coalescer.shared, 0)
+
+  def testQueryResultCache(self):
+    """Tests the cache.QueryResultCache class."""
+    self.assertRaises(TypeError, cache.QueryResultCache, ttl=None)
+
+    result_cache = cache.QueryResultCache(max_size=10)
+    generation = result_cache.Generation('Note')
+    self.assertTrue(result_cache.Set('Note', 'query', NoteMessage(text='a'),
+                                     generation))
+    self.assertTrue(result_cache.Contains('Note', 'query'))
+    self.assertEqual(result_cache.Get('Note', 'query', NoteMessage),
+                     NoteMessage(text='a'))
+    self.assertEqual(result_cache.Get('Note', 'other', NoteMessage), None)
+    self.assertEqual((result_cache.hits, result_cache.misses), (1, 1))
+
+    # Writes to a kind only invalidate the results of its queries
+    task_generation = result_cache.Generation('Task')
+    result_cache.Set('Task', 'query', NoteMessage(text='b'), task_generation)
+    result_cache.Invalidate('Note')
+    self.assertFalse(result_cache.Contains('Note', 'query'))
+    self.assertEqual(result_cache.Get('Note', 'query', NoteMessage), None)
+    self.assertEqual(result_cache.Get('Task', 'query', NoteMessage),
+                     NoteMessage(text='b'))
+
+    # A query started before the invalidation is not stored
+    self.assertFalse(result_cache.Set('Note', 'query', NoteMessage(text='c'),
+                                      generation))
+    self.assertFalse(result_cache.Contains('Note', 'query'))
+
+    result_cache.Clear()
+    self.assertFalse(result_cache.Contains('Task', 'query'))
+
+
+  def testPagePrefetcher(self):
+    """Tests the cache.PagePrefetcher class."""
+    self.assertRaises(TypeError, cache.PagePrefetcher, max_in_flight=0)
+
+    prefetcher = cache.PagePrefetcher(max_size=10, max_in_flight=1)
+    thread = prefetcher.Prefetch(
+        'Note', 'page', lambda: _CompletedFuture(NoteMessage(text='a')))
+    thread.join()
+    self.assertEqual(prefetcher.Get('Note', 'page', NoteMessage),
+                     NoteMessage(text='a'))
+    self.assertEqual((prefetcher.hits, prefetcher.started), (1, 1))
+
+    # Pages already prefetched are not fetched again
+    self.assertEqual(prefetcher.Prefetch('Note', 'page', None), None)
+
+    # Only max_in_flight pages are fetched at once, each in its own thread
+    release = threading.Event()
+    def PendingFetchAsync():
+      release.wait()
+      return _CompletedFuture(NoteMessage(text='b'))
+    thread = prefetcher.Prefetch('Note', 'pending', PendingFetchAsync)
+    self.assertNotEqual(thread, threading.current_thread())
+    self.assertEqual(prefetcher.Prefetch('Note', 'pending', None), None)
+    self.assertEqual(prefetcher.Prefetch('Note', 'other', None), None)
+    self.assertEqual(prefetcher.skipped, 1)
+
+    # A page whose fetch started before a write to the kind is not stored
+    prefetcher.Invalidate('Note')
+    release.set()
+    thread.join()
+    self.assertEqual(prefetcher.Get('Note', 'pending', NoteMessage), None)
+
+    # Failures are logged rather than raised
+    def FailingFetchAsync():
+      failed = ndb.Future()
+      failed.set_exception(ValueError('failed'))
+      return failed
+    prefetcher.Prefetch('Note', 'failing', FailingFetchAsync).join()
+    self.assertEqual(prefetcher.Get('Note', 'failing', NoteMessage), None)
+    self.assertEqual(prefetcher.started, 3)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,442 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Derives the composite indexes needed by query methods of EndpointsModels.
+
+Every API method decorated with query_method is recorded on its model class.
+After importing an API module, the query fields of each of these methods are
+used to find the queries clients can make:
+  - each NDB property in the query fields is an optional equality filter, as
+    is each field using the __in operator;
+  - fields using the __lt, __lte, __gt and __gte operators are optional
+    inequality filters;
+  - the order field allows the orders it can be set to. If the order alias
+    property has an enum property type (see the matching_queries_to_indexes
+    example), each enum value is set to find its order. Otherwise any order is
+    allowed, which can't be indexed ahead of time.
+
+Since the datastore can merge indexes which end in the same sort orders, a
+single index per equality filter (followed by the sort orders) serves every
+combination of the equality filters. Queries which only use equality filters,
+or a single sort order, are served by the built-in indexes.
+
+Methods using a projection query, with use_projection on query_method or
+aggregate_method, also need the projected properties in their indexes. They
+follow the sort orders, so a projection of more than one property always
+needs a composite index. Projections dropped at request time, because the
+final query filters a projected property by equality, are not seen.
+
+Alias properties whose setter sets the ancestor of the query info are
+declared with sets_ancestor=True, and their query methods get ancestor indexes.
+Since the built-in indexes only serve ancestor queries with no sort order, an
+ancestor query sorted by a single property still needs a composite index. If
+the alias property is not required, indexes without the ancestor are also
+advised.
+
+Filters, orders and ancestors added by the decorated method itself, or by
+other custom alias properties, are not seen and must be added by hand.
+
+Usage, with the App Engine SDK on the import path:
+
+  python -m endpoints_proto_datastore.ndb.index_advisor main [index.yaml]
+
+where main is the module defining the API. The advised indexes are printed in
+index.yaml format, followed by any warnings. If an existing index.yaml is
+given, indexes missing from it are also reported, as are the indexes it holds
+for the kinds of the query methods which none of them needs.
+"""
+
+import importlib
+import sys
+
+from . import model
+from .. import utils
+
+from protorpc import messages
+
+from google.appengine.ext import ndb
+
+
+__all__ = ['AdviseIndexes', 'FormatIndexYaml', 'QueryMethodIndexes',
+           'UnneededIndexes']
+
+
+ASCENDING = 'asc'
+DESCENDING = 'desc'
+ORDER_FIELD = 'order'
+UNBOUNDED_ORDER_TEMPLATE = ('%s.%s allows any order, so indexes for its '
+                            'orders can\'t be advised.')
+BAD_ORDER_TEMPLATE = '%s.%s: could not determine the order for %s: %s'
+MULTIPLE_INEQUALITY_TEMPLATE = ('%s.%s has inequality filters on more than one '
+                                'property: %s. Only one can be used at once.')
+EXPLODING_INDEX_TEMPLATE = ('Index %s contains more than one repeated '
+                            'property and may explode.')
+MISSING_INDEX_TEMPLATE = 'Index %s is missing from %s.'
+UNNEEDED_INDEX_TEMPLATE = ('Index %s in %s is not needed by any query method, '
+                           'unless other code queries it.')
+COVERED_INDEX_TEMPLATE = ('Index %s in %s is not needed by any query method '
+                          'and is a prefix of index %s.')
+
+
+def _ParseOrder(order):
+  """Parses an order string as used by the order alias property.
+
+  Args:
+    order: String; comma separated list of property names or property names
+        preceded by a minus sign.
+
+  Returns:
+    A tuple of (property name, direction) pairs.
+  """
+  result = []
+  for name in order.strip().split(','):
+    if name.startswith('-'):
+      result.append((name[1:], DESCENDING))
+    else:
+      result.append((name, ASCENDING))
+  return tuple(result)
+
+
+def _AllowedOrders(modelclass, method_name, query_field_names, warnings):
+  """Finds the orders a query method allows clients to use.
+
+  Args:
+    modelclass: An EndpointsModel subclass.
+    method_name: The name of the decorated query method.
+    query_field_names: A list of the names of the query fields.
+    warnings: A list which warnings are appended to.
+
+  Returns:
+    A list of orders, each a tuple of (property name, direction) pairs. The
+        empty order, used when no order is sent, is always included.
+  """
+  orders = [()]
+  if ORDER_FIELD not in query_field_names:
+    return orders
+
+  prop = modelclass._alias_properties.get(ORDER_FIELD)
+  if prop is None or not utils.IsSubclass(prop.property_type, messages.Enum):
+    warnings.append(UNBOUNDED_ORDER_TEMPLATE %
+                    (modelclass.__name__, method_name))
+    return orders
+
+  for value in prop.property_type:
+    entity = modelclass()
+    try:
+      setattr(entity, ORDER_FIELD, value)
+    except Exception as error:
+      warnings.append(BAD_ORDER_TEMPLATE %
+                      (modelclass.__name__, method_name, value, error))
+      continue
+    order = entity._endpoints_query_info._order
+    if order is not None:
+      orders.append(_ParseOrder(order))
+  return orders
+
+
+def _IndexesForQuery(kind, equality_names, sort_orders, projection=(),
+                     ancestor=False):
+  """Finds the composite indexes needed by a query with optional equalities.
+
+  Args:
+    kind: The kind of the query.
+    equality_names: A list of the names of properties which may be filtered
+        by equality. Each one is optional.
+    sort_orders: A tuple of (property name, direction) pairs the results are
+        sorted by, including the property with inequality filters, if any.
+    projection: An optional list or tuple of the names of projected
+        properties. Defaults to an empty tuple.
+    ancestor: An optional boolean, defaults to False. Whether the query has an
+        ancestor.
+
+  Returns:
+    A list of indexes, each a tuple of the kind, a tuple of (property name,
+        direction) pairs and a boolean indicating whether the index includes
+        the ancestor.
+  """
+  # Projected properties which are not sorted by follow the sort orders
+  sort_names = set(name for name, _ in sort_orders)
+  sort_orders += tuple((name, ASCENDING) for name in projection
+                       if name not in sort_names)
+  if not sort_orders:
+    # Merge joins of the built-in indexes serve equality filters
+    return []
+
+  indexes = []
+  if len(sort_orders) > 1 or ancestor:
+    indexes.append((kind, sort_orders, ancestor))
+
+  sort_names = set(name for name, _ in sort_orders)
+  for name in equality_names:
+    if name in sort_names:
+      continue
+    indexes.append((kind, ((name, ASCENDING),) + sort_orders, ancestor))
+  return indexes
+
+
+def _AncestorVariants(modelclass, query_field_names):
+  """Finds whether the queries of a query method have an ancestor.
+
+  Args:
+    modelclass: An EndpointsModel subclass.
+    query_field_names: A list of the names of the query fields.
+
+  Returns:
+    A tuple of booleans: (False,) if no query field sets the ancestor, (True,)
+        if a required one does, or (False, True) if only optional ones do.
+  """
+  ancestor_props = [prop for prop in (modelclass._alias_properties.get(name)
+                                      for name in query_field_names)
+                    if getattr(prop, '_sets_ancestor', False)]
+  if not ancestor_props:
+    return (False,)
+  if any(prop._required for prop in ancestor_props):
+    return (True,)
+  return (False, True)
+
+
+def QueryMethodIndexes(modelclass, method_name, query_fields,
+                       projection=None):
+  """Finds the composite indexes needed by a query method.
+
+  Args:
+    modelclass: An EndpointsModel subclass.
+    method_name: The name of the decorated query method.
+    query_fields: The query fields passed to query_method.
+    projection: An optional list of the names of the properties projected by
+        the method. Defaults to None.
+
+  Returns:
+    A pair of a list of indexes, each a tuple of the kind, a tuple of
+        (property name, direction) pairs and a boolean indicating whether the
+        index includes the ancestor, and a list of warnings.
+  """
+  warnings = []
+  kind = modelclass._get_kind()
+  query_field_names = list(utils.MessageFieldsSchema.Intern(
+      query_fields, basename=modelclass.__name__ + 'Proto'))
+
+  equality_names = []
+  inequality_names = []
+  for name in query_field_names:
+    operator_field = modelclass._QueryOperatorField(name)
+    if operator_field is None:
+      if name in modelclass._properties:
+        equality_names.append(name)
+      continue
+
+    prop, operator = operator_field
+    if operator == model.QUERY_OPERATOR_IN:
+      equality_names.append(prop._name)
+    elif prop._name not in inequality_names:
+      inequality_names.append(prop._name)
+
+  if len(inequality_names) > 1:
+    warnings.append(MULTIPLE_INEQUALITY_TEMPLATE %
+                    (modelclass.__name__, method_name,
+                     ', '.join(inequality_names)))
+
+  sort_orders_list = []
+  for order in _AllowedOrders(modelclass, method_name, query_field_names,
+                              warnings):
+    sort_orders_list.append(order)
+    for inequality_name in inequality_names:
+      if not order:
+        sort_orders_list.append(((inequality_name, ASCENDING),))
+      elif order[0][0] == inequality_name:
+        sort_orders_list.append(order)
+      # Otherwise rejected by the query info, so never run
+
+  indexes = []
+  for ancestor in _AncestorVariants(modelclass, query_field_names):
+    for sort_orders in sort_orders_list:
+      indexes.extend(_IndexesForQuery(kind, equality_names, sort_orders,
+                                      projection=projection or (),
+                                      ancestor=ancestor))
+  return indexes, warnings
+
+
+def _FormatIndex(index):
+  """Formats an index as a short string for warnings."""
+  kind, properties, ancestor = index
+  names = [name if direction == ASCENDING else '-' + name
+           for name, direction in properties]
+  if ancestor:
+    names.insert(0, 'ancestor')
+  return '%s(%s)' % (kind, ', '.join(names))
+
+
+def _IsExploding(modelclass, index):
+  """Checks if an index has more than one repeated property."""
+  repeated = [name for name, _ in index[1]
+              if getattr(modelclass._properties.get(name), '_repeated', False)]
+  return len(repeated) > 1
+
+
+def AdviseIndexes(modelclasses):
+  """Finds the composite indexes needed by the query methods of models.
+
+  Args:
+    modelclasses: An iterable of EndpointsModel subclasses.
+
+  Returns:
+    A pair of a sorted list of indexes, each a tuple of the kind, a tuple of
+        (property name, direction) pairs and a boolean indicating whether the
+        index includes the ancestor, and a list of warnings.
+  """
+  warnings = []
+  indexes = set()
+  modelclass_by_kind = {}
+  for modelclass in modelclasses:
+    modelclass_by_kind[modelclass._get_kind()] = modelclass
+    for method_name, query_fields, projection in (
+        modelclass._query_methods or ()):
+      method_indexes, method_warnings = QueryMethodIndexes(
+          modelclass, method_name, query_fields, projection=projection)
+      indexes.update(method_indexes)
+      warnings.extend(method_warnings)
+
+  result = sorted(indexes)
+  for index in result:
+    if _IsExploding(modelclass_by_kind[index[0]], index):
+      warnings.append(EXPLODING_INDEX_TEMPLATE % (_FormatIndex(index),))
+  return result, warnings
+
+
+def FormatIndexYaml(indexes):
+  """Formats indexes in the format of index.yaml.
+
+  Args:
+    indexes: A list of indexes, each a tuple of the kind, a tuple of
+        (property name, direction) pairs and a boolean indicating whether the
+        index includes the ancestor.
+
+  Returns:
+    String; the contents of an index.yaml file.
+  """
+  lines = ['indexes:']
+  for kind, properties, ancestor in indexes:
+    lines.append('')
+    lines.append('- kind: %s' % (kind,))
+    if ancestor:
+      lines.append('  ancestor: yes')
+    lines.append('  properties:')
+    for name, direction in properties:
+      lines.append('  - name: %s' % (name,))
+      if direction == DESCENDING:
+        lines.append('    direction: desc')
+  return '\n'.join(lines) + '\n'
+
+
+def UnneededIndexes(existing, indexes, kinds):
+  """Finds the existing indexes which no query method needs.
+
+  An index which is a prefix of another one is not redundant, since the
+  datastore only uses an index for the exact sort orders it was built for, so
+  indexes which are prefixes are only reported along with the index covering
+  them if they are not needed either.
+
+  Args:
+    existing: An iterable of the indexes in an index.yaml file, each a tuple
+        of the kind, a tuple of (property name, direction) pairs and a boolean
+        indicating whether the index includes the ancestor.
+    indexes: The indexes needed by the query methods, as returned by
+        AdviseIndexes.
+    kinds: The kinds of the query methods. Indexes of other kinds are skipped.
+
+  Returns:
+    A sorted list of pairs of an unneeded index and another existing index it
+        is a prefix of, or None if there is none.
+  """
+  needed = set(indexes)
+  result = []
+  for index in sorted(set(existing)):
+    kind, properties, ancestor = index
+    if kind not in kinds or index in needed:
+      continue
+    covering = None
+    for other in sorted(existing):
+      if (other[0] == kind and other[2] == ancestor and
+          len(other[1]) > len(properties) and
+          other[1][:len(properties)] == properties):
+        covering = other
+        break
+    result.append((index, covering))
+  return result
+
+
+def _ReadIndexYaml(path):
+  """Reads the composite indexes from an index.yaml file.
+
+  Args:
+    path: The path of an index.yaml file.
+
+  Returns:
+    A set of indexes, each a tuple of the kind, a tuple of (property name,
+        direction) pairs and a boolean indicating whether the index includes
+        the ancestor.
+  """
+  import yaml
+
+  with open(path) as index_file:
+    definitions = yaml.safe_load(index_file) or {}
+
+  result = set()
+  for definition in definitions.get('indexes') or ():
+    properties = tuple((prop['name'], prop.get('direction', ASCENDING))
+                       for prop in definition.get('properties') or ())
+    result.add((definition['kind'], properties,
+                bool(definition.get('ancestor'))))
+  return result
+
+
+def _EndpointsModelClasses():
+  """Gets every EndpointsModel subclass which has been imported."""
+  return [modelclass for modelclass in ndb.Model._kind_map.itervalues()
+          if issubclass(modelclass, model.EndpointsModel)]
+
+
+def main(argv):
+  """Imports an API module and prints the indexes its query methods need.
+
+  Args:
+    argv: The command line arguments: the module to import and, optionally,
+        the path of an existing index.yaml file.
+
+  Returns:
+    The exit code: 1 for bad arguments or if an index is missing from the
+        given index.yaml, else 0. Unneeded indexes are only warned about.
+  """
+  if len(argv) not in (2, 3):
+    sys.stderr.write(__doc__)
+    return 1
+
+  importlib.import_module(argv[1])
+  modelclasses = _EndpointsModelClasses()
+  indexes, warnings = AdviseIndexes(modelclasses)
+
+  exit_code = 0
+  if len(argv) == 3:
+    existing = _ReadIndexYaml(argv[2])
+    for index in indexes:
+      if index not in existing:
+        warnings.append(MISSING_INDEX_TEMPLATE % (_FormatIndex(index), argv[2]))
+        exit_code = 1
+
+    kinds = set(modelclass._get_kind() for modelclass in modelclasses
+                if modelclass._query_methods)
+    for index, covering in UnneededIndexes(existing, indexes, kinds):
+      if covering is None:
+        warnings.append(UNNEEDED_INDEX_TEMPLATE % (_FormatIndex(index),
+                                                   argv[2]))
+      else:
+        warnings.append(COVERED_INDEX_TEMPLATE % (_FormatIndex(index), argv[2],
+                                                  _FormatIndex(covering)))
+
+  sys.stdout.write(FormatIndexYaml(indexes))
+  for warning in warnings:
+    sys.stderr.write('WARNING: %s\n' % (warning,))
+  return exit_code
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
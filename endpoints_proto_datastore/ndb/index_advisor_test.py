@@ -0,0 +1,254 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Tests for ndb/index_advisor.py."""
+
+
+import unittest
+
+from protorpc import messages
+
+from . import index_advisor
+from . import model
+
+from google.appengine.ext import ndb
+
+
+ASC = index_advisor.ASCENDING
+DESC = index_advisor.DESCENDING
+
+
+class RankOrder(messages.Enum):
+  """Orders allowed when querying Rank entities."""
+  LEVEL = 1
+  LEVEL_THEN_SCORE = 2
+
+
+class Rank(model.EndpointsModel):
+  """Model with a bounded set of orders."""
+  group = ndb.StringProperty()
+  level = ndb.IntegerProperty()
+  score = ndb.IntegerProperty()
+
+  def OrderSet(self, value):
+    """Sets the order for a RankOrder value."""
+    if value == RankOrder.LEVEL:
+      super(Rank, self).OrderSet('level')
+    else:
+      super(Rank, self).OrderSet('level,-score')
+
+  @model.EndpointsAliasProperty(setter=OrderSet, property_type=RankOrder)
+  def order(self):
+    """Limits the order to RankOrder values."""
+    return super(Rank, self).order
+
+
+class TagOrder(messages.Enum):
+  """Orders allowed when querying Labeled entities."""
+  LABELS = 1
+
+
+class Labeled(model.EndpointsModel):
+  """Model with more than one repeated property."""
+  tags = ndb.StringProperty(repeated=True)
+  labels = ndb.StringProperty(repeated=True)
+
+  def OrderSet(self, value):
+    """Sets the order for a TagOrder value."""
+    super(Labeled, self).OrderSet('labels')
+
+  @model.EndpointsAliasProperty(setter=OrderSet, property_type=TagOrder)
+  def order(self):
+    """Limits the order to TagOrder values."""
+    return super(Labeled, self).order
+
+
+class Unbounded(model.EndpointsModel):
+  """Model using the default order alias property, which allows any order."""
+  name = ndb.StringProperty()
+
+
+class Child(model.EndpointsModel):
+  """Model with alias properties setting the ancestor of queries."""
+  group = ndb.StringProperty()
+  level = ndb.IntegerProperty()
+
+  def ParentSet(self, value):
+    """Sets the ancestor of queries."""
+    self._endpoints_query_info.ancestor = ndb.Key('Parent', value)
+
+  @model.EndpointsAliasProperty(setter=ParentSet, required=True,
+                                sets_ancestor=True)
+  def parent(self):
+    """Required alias property setting the ancestor."""
+    return None
+
+  @model.EndpointsAliasProperty(setter=ParentSet, sets_ancestor=True)
+  def maybeParent(self):
+    """Optional alias property setting the ancestor."""
+    return None
+
+
+class IndexAdvisorTests(unittest.TestCase):
+  """Tests for the endpoints_proto_datastore.ndb.index_advisor module."""
+
+  def setUp(self):
+    """Forgets the query methods recorded on the test models."""
+    for modelclass in (Rank, Labeled, Unbounded, Child):
+      # pylint:disable-msg=W0212
+      modelclass._query_methods = []
+      # pylint:enable-msg=W0212
+
+  def testQueryMethodIndexes(self):
+    """Tests the index_advisor.QueryMethodIndexes method."""
+    indexes, warnings = index_advisor.QueryMethodIndexes(
+        Rank, 'RankList', ('group', 'order'))
+    self.assertEqual(sorted(indexes), [
+        ('Rank', (('group', ASC), ('level', ASC)), False),
+        ('Rank', (('group', ASC), ('level', ASC), ('score', DESC)), False),
+        ('Rank', (('level', ASC), ('score', DESC)), False),
+    ])
+    self.assertEqual(warnings, [])
+
+    # Equality filters alone are served by the built-in indexes
+    self.assertEqual(index_advisor.QueryMethodIndexes(
+        Rank, 'RankList', ('group', 'score')), ([], []))
+
+    # Inequality filters sort by their property, using the same order
+    indexes, warnings = index_advisor.QueryMethodIndexes(
+        Rank, 'RankList', ('group', 'level__gte', 'order'))
+    self.assertEqual(sorted(set(indexes)), [
+        ('Rank', (('group', ASC), ('level', ASC)), False),
+        ('Rank', (('group', ASC), ('level', ASC), ('score', DESC)), False),
+        ('Rank', (('level', ASC), ('score', DESC)), False),
+    ])
+    self.assertEqual(warnings, [])
+
+    # The __in operator is an equality filter
+    indexes, _ = index_advisor.QueryMethodIndexes(
+        Rank, 'RankList', ('group__in', 'level__lt'))
+    self.assertEqual(indexes,
+                     [('Rank', (('group', ASC), ('level', ASC)), False)])
+
+  def testQueryMethodWarnings(self):
+    """Tests the warnings of the index_advisor.QueryMethodIndexes method."""
+    _, warnings = index_advisor.QueryMethodIndexes(
+        Rank, 'RankList', ('level__gte', 'score__lt'))
+    self.assertEqual(warnings, [index_advisor.MULTIPLE_INEQUALITY_TEMPLATE %
+                                ('Rank', 'RankList', 'level, score')])
+
+    indexes, warnings = index_advisor.QueryMethodIndexes(
+        Unbounded, 'UnboundedList', ('name', 'order'))
+    self.assertEqual(indexes, [])
+    self.assertEqual(warnings, [index_advisor.UNBOUNDED_ORDER_TEMPLATE %
+                                ('Unbounded', 'UnboundedList')])
+
+  def testProjectionIndexes(self):
+    """Tests the indexes advised for methods using a projection query."""
+    # A single projected property is served by the built-in indexes
+    self.assertEqual(index_advisor.QueryMethodIndexes(
+        Rank, 'RankScores', (), projection=['score']), ([], []))
+
+    # Projected properties follow the equality filters and sort orders
+    indexes, _ = index_advisor.QueryMethodIndexes(
+        Rank, 'RankScores', ('group', 'level__gte'),
+        projection=['level', 'score'])
+    self.assertEqual(sorted(set(indexes)), [
+        ('Rank', (('group', ASC), ('level', ASC), ('score', ASC)), False),
+        ('Rank', (('level', ASC), ('score', ASC)), False),
+    ])
+
+    indexes, _ = index_advisor.QueryMethodIndexes(
+        Rank, 'RankScores', ('group',), projection=['score'])
+    self.assertEqual(indexes,
+                     [('Rank', (('group', ASC), ('score', ASC)), False)])
+
+  def testAncestorIndexes(self):
+    """Tests the indexes advised for query methods with an ancestor."""
+    # Ancestor queries with only equality filters use the built-in indexes
+    self.assertEqual(index_advisor.QueryMethodIndexes(
+        Child, 'ChildList', ('parent', 'group')), ([], []))
+
+    # Even a single sort order needs an ancestor index
+    indexes, _ = index_advisor.QueryMethodIndexes(
+        Child, 'ChildList', ('parent', 'group', 'level__gt'))
+    self.assertEqual(indexes, [
+        ('Child', (('level', ASC),), True),
+        ('Child', (('group', ASC), ('level', ASC)), True),
+    ])
+
+    # An optional ancestor needs the indexes with and without it
+    indexes, _ = index_advisor.QueryMethodIndexes(
+        Child, 'ChildList', ('maybeParent', 'group', 'level__gt'))
+    self.assertEqual(indexes, [
+        ('Child', (('group', ASC), ('level', ASC)), False),
+        ('Child', (('level', ASC),), True),
+        ('Child', (('group', ASC), ('level', ASC)), True),
+    ])
+
+  def testUnneededIndexes(self):
+    """Tests the index_advisor.UnneededIndexes method."""
+    needed = [('Rank', (('group', ASC), ('level', ASC)), False),
+              ('Rank', (('group', ASC), ('level', ASC), ('score', DESC)),
+               False)]
+    unused = ('Rank', (('score', ASC), ('level', ASC)), False)
+    covered = ('Rank', (('group', ASC), ('level', ASC)), True)
+    covering = ('Rank', (('group', ASC), ('level', ASC), ('score', ASC)), True)
+    other_kind = ('Other', (('a', ASC), ('b', ASC)), False)
+    existing = needed + [unused, covered, covering, other_kind]
+
+    self.assertEqual(
+        index_advisor.UnneededIndexes(existing, needed + [covering],
+                                      set(['Rank'])),
+        [(covered, covering), (unused, None)])
+
+    # Needed indexes are kept, even when they are a prefix of another one
+    self.assertEqual(
+        index_advisor.UnneededIndexes(existing, existing, set(['Rank'])), [])
+
+  def testAdviseIndexes(self):
+    """Tests the index_advisor.AdviseIndexes method."""
+    # pylint:disable-msg=W0212
+    Rank._query_methods.append(('RankList', ('group', 'order'), None))
+    Rank._query_methods.append(('RankByLevel', ('group', 'level__gt'),
+                                None))
+    Labeled._query_methods.append(('LabeledList', ('tags', 'order'), None))
+    # pylint:enable-msg=W0212
+
+    indexes, warnings = index_advisor.AdviseIndexes(
+        [Rank, Labeled, Unbounded])
+    # Indexes which are a prefix of another one are still needed, since the
+    # datastore only uses an index for the exact sort orders it was built for
+    self.assertEqual(indexes, [
+        ('Labeled', (('tags', ASC), ('labels', ASC)), False),
+        ('Rank', (('group', ASC), ('level', ASC)), False),
+        ('Rank', (('group', ASC), ('level', ASC), ('score', DESC)), False),
+        ('Rank', (('level', ASC), ('score', DESC)), False),
+    ])
+    self.assertEqual(warnings, [index_advisor.EXPLODING_INDEX_TEMPLATE %
+                                ('Labeled(tags, labels)',)])
+
+  def testFormatIndexYaml(self):
+    """Tests the index_advisor.FormatIndexYaml method."""
+    self.assertEqual(index_advisor.FormatIndexYaml([]), 'indexes:\n')
+    self.assertEqual(
+        index_advisor.FormatIndexYaml(
+            [('Rank', (('group', ASC), ('score', DESC)), False)]),
+        'indexes:\n'
+        '\n'
+        '- kind: Rank\n'
+        '  properties:\n'
+        '  - name: group\n'
+        '  - name: score\n'
+        '    direction: desc\n')
+    self.assertEqual(
+        index_advisor.FormatIndexYaml([('Rank', (('level', ASC),), True)]),
+        'indexes:\n'
+        '\n'
+        '- kind: Rank\n'
+        '  ancestor: yes\n'
+        '  properties:\n'
+        '  - name: level\n')
+
+
+if __name__ == '__main__':
+  unittest.main()
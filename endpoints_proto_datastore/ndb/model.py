@@ -8,8 +8,11 @@ used to simplify endpoints API methods so that only entities need be used rather
 than converting between ProtoRPC messages and entities and then back again.
 """
 
+import collections
 import functools
+import inspect
 import itertools
+import logging
 import re
 
 try:
@@ -17,6 +20,7 @@ try:
 except ImportError:
   from google.appengine.ext import endpoints
 
+from . import cache
 from . import properties
 from . import utils as ndb_utils
 from .. import utils
@@ -24,7 +28,8 @@ from .. import utils
 from protorpc import messages
 from protorpc import message_types
 
-from google.appengine.api import datastore_types
+from google.appengine.api import datastore_errors
+from google.appengine.api import namespace_manager
 from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
@@ -34,6 +39,8 @@ __all__ = ['EndpointsModel']
 
 QUERY_LIMIT_DEFAULT = 10
 QUERY_LIMIT_MAX = 100
+QUERY_BATCH_SIZE_DEFAULT = 100
+COUNT_LIMIT_MAX = 1000
 QUERY_MAX_EXCEEDED_TEMPLATE = '%s results requested. Exceeds limit of %s.'
 PROPERTY_COLLISION_TEMPLATE = ('Name conflict: %s set as an NDB property and '
                                'an Endpoints alias property.')
@@ -48,6 +55,60 @@ RESPONSE_MESSAGE = 'response_message'
 HTTP_METHOD = 'http_method'
 PATH = 'path'
 QUERY_HTTP_METHOD = 'GET'
+PROJECTION_AUTO = 'auto'
+# Suffixes of query fields which filter a property using an operator
+QUERY_OPERATOR_SEPARATOR = '__'
+QUERY_OPERATOR_IN = 'in'
+QUERY_OPERATORS = {
+    'lt': '<',
+    'lte': '<=',
+    'gt': '>',
+    'gte': '>=',
+    QUERY_OPERATOR_IN: 'in',
+}
+MULTIPLE_INEQUALITY_TEMPLATE = ('Inequality filters can only be used on one '
+                                'property. Received %s and %s.')
+# Page tokens for queries with IN filters hold a cursor for each branch
+COMPOSITE_PAGE_TOKEN_PREFIX = '~'
+COMPOSITE_PAGE_TOKEN_SEPARATOR = '.'
+BRANCH_EXHAUSTED_TOKEN = '-'
+COMPOSITE_PAGE_TOKEN_MISMATCH = 'The page token does not match the query.'
+INEQUALITY_ORDER_TEMPLATE = ('The first sort order must be on %s, the property '
+                             'with inequality filters. Received %s.')
+# Property types whose values can't be read back from a projection query
+PROJECTION_UNSAFE_PROPERTIES = (ndb.StructuredProperty,
+                                ndb.LocalStructuredProperty,
+                                ndb.ComputedProperty, ndb.UserProperty)
+MULTI_INSERT = 'insert'
+MULTI_UPDATE = 'update'
+MULTI_DELETE = 'delete'
+MULTI_OPERATIONS = frozenset([MULTI_INSERT, MULTI_UPDATE, MULTI_DELETE])
+# The maximum number of entities in a single datastore put or delete call
+MULTI_BATCH_SIZE = 500
+AGGREGATE_FUNCTIONS = frozenset(['sum', 'min', 'max'])
+AGGREGATE_PROPERTY_TO_FIELD = (
+    (ndb.IntegerProperty, messages.IntegerField),
+    (ndb.FloatProperty, messages.FloatField),
+)
+AGGREGATE_UNGROUPABLE_PROPERTIES = (ndb.StructuredProperty,
+                                    ndb.LocalStructuredProperty,
+                                    ndb.JsonProperty, ndb.PickleProperty)
+AGGREGATE_GROUPS_MAX = 1000
+AGGREGATE_GROUPS_EXCEEDED_TEMPLATE = ('Query results have more than %s groups. '
+                                      'Use more filters.')
+BAD_AGGREGATE_TEMPLATE = ('Aggregate %s must be a non-repeated integer or '
+                          'float property followed by __sum, __min or __max.')
+BAD_GROUP_BY_TEMPLATE = ('Can\'t group by %s, only by non-repeated NDB '
+                         'properties with simple values.')
+# Class attributes holding process-local caches invalidated by puts and deletes
+INVALIDATED_CACHES = ('_entity_cache', '_missing_key_cache',
+                      '_query_result_cache', '_page_prefetcher',
+                      '_query_count_cache')
+MULTI_NO_KEY_ERROR = 'Entity has no key.'
+MULTI_NOT_FOUND_ERROR = 'Entity not found.'
+EXPAND_NOT_IN_FIELDS_TEMPLATE = 'Expanded field %s is not one of the fields.'
+EXPAND_NOT_KEY_TEMPLATE = ('Expanded field %s must be an NDB KeyProperty with '
+                           'a kind set to an EndpointsModel subclass.')
 # This global will be updated after EndpointsModel is defined and is used by
 # the metaclass EndpointsMetaModel
 BASE_MODEL_CLASS = None
@@ -56,6 +117,10 @@ EndpointsAliasProperty = properties.EndpointsAliasProperty
 MessageFieldsSchema = utils.MessageFieldsSchema
 
 
+class AggregateGroupsExceededError(ValueError):
+  """Raised when the results of an aggregate query have too many groups."""
+
+
 def _VerifyProperty(modelclass, attr_name):
   """Return a property if set on a model class, otherwise raises an exception.
 
@@ -80,12 +145,15 @@ def _VerifyProperty(modelclass, attr_name):
   return prop
 
 
-def ToValue(prop, value):
+def ToValue(prop, value, modelclass=None):
   """Serializes a value from a property to a ProtoRPC message type.
 
   Args:
     prop: The NDB or alias property to be converted.
     value: The value to be serialized.
+    modelclass: An optional EndpointsModel subclass the property belongs to,
+        defaults to None. If set, the serializers of the class, including its
+        _custom_property_to_value, are used.
 
   Returns:
     The serialized version of the value to be set on a ProtoRPC message.
@@ -94,30 +162,494 @@ def ToValue(prop, value):
     return value
   elif isinstance(value, EndpointsModel):
     return value.ToMessage()
-  elif hasattr(prop, 'ToValue') and callable(prop.ToValue):
-    return prop.ToValue(value)
-  elif isinstance(prop, ndb.UserProperty):
-    return utils.UserMessageFromUser(value)
-  elif isinstance(prop, ndb.GeoPtProperty):
-    return utils.GeoPtMessage(lat=value.lat, lon=value.lon)
-  elif isinstance(prop, ndb.KeyProperty):
-    return value.urlsafe()
-  elif isinstance(prop, ndb.BlobKeyProperty):
-    return str(value)
-  elif isinstance(prop, (ndb.TimeProperty,
-                         ndb.DateProperty,
-                         ndb.DateTimeProperty)):
-    return utils.DatetimeValueToString(value)
+
+  if modelclass is None:
+    converter = _ToValueConverter(prop)
   else:
+    converter = _ToValueConverter(
+        prop, registry=modelclass._property_to_value,
+        custom_registry=modelclass._custom_property_to_value)
+  if converter is None:
     return value
+  return converter(value)
+
+
+def _ToValueConverter(prop, registry=ndb_utils.NDB_PROPERTY_TO_VALUE,
+                      custom_registry=None):
+  """Resolves the serializer used by ToValue for a property.
+
+  A serializer set for the property class in custom_registry takes precedence,
+  then a ToValue method defined on the property, otherwise the serializer
+  registered for the property class is used. The result only depends on the
+  property, so it can be computed once and reused for every value serialized
+  from that property.
+
+  Args:
+    prop: The NDB or alias property to be converted.
+    registry: An optional dictionary from property classes to serializers.
+        Defaults to NDB_PROPERTY_TO_VALUE from ndb_utils.
+    custom_registry: An optional dictionary from property classes to
+        serializers, such as _custom_property_to_value on a model class.
+        Defaults to None.
+
+  Returns:
+    A callable which takes a single non-null value and returns the serialized
+        version of the value, or None if values need no conversion.
+  """
+  if custom_registry:
+    custom_converter = ndb_utils.GetValueConverter(custom_registry,
+                                                   prop.__class__)
+    if custom_converter is not None:
+      return custom_converter
+
+  to_value = getattr(prop, 'ToValue', None)
+  if callable(to_value):
+    return to_value
+
+  property_class = prop.__class__
+  if property_class in registry:
+    return registry[property_class]
+  return ndb_utils.GetValueConverter(registry, property_class)
+
+
+def _EntityToMessage(value):
+  """Serializes a value of a property with no serializer.
+
+  As in ToValue, an entity held by any property, such as a GenericProperty, is
+  serialized to its message.
+
+  Args:
+    value: A non-null property value.
+
+  Returns:
+    The message of the value if it is an EndpointsModel, otherwise the value.
+  """
+  if isinstance(value, EndpointsModel):
+    return value.ToMessage()
+  return value
+
+
+def _RepeatedField(field):
+  """Creates a repeated copy of a simple or enum ProtoRPC field.
+
+  Args:
+    field: A ProtoRPC field which is not a MessageField.
+
+  Returns:
+    An unbound ProtoRPC field with the same type, number and variant as field,
+        but repeated.
+  """
+  if isinstance(field, messages.EnumField):
+    return messages.EnumField(field.type, field.number, repeated=True)
+  return field.__class__(field.number, repeated=True, variant=field.variant)
+
+
+def _ExpandSuffix(expand):
+  """Creates a suffix for the names of message classes with expanded fields.
+
+  Args:
+    expand: A sorted tuple of the names of expanded fields.
+
+  Returns:
+    A string, e.g. 'ExpandOwnerParent' for ('owner', 'parent').
+  """
+  return 'Expand' + ''.join(name[:1].upper() + name[1:] for name in expand)
+
+
+# Stands in for the cursor of a branch which has no more results
+_BRANCH_EXHAUSTED = object()
+
+
+class _BranchCursors(object):
+  """The cursors for each branch of a disjunctive (IN or OR) query.
+
+  A disjunctive query is run as one query per branch of the disjunction. To
+  resume it, the position in each branch is needed, so a page token holds all
+  of them. Has the same websafe string methods as datastore_query.Cursor, so it
+  can be used as the cursor of a query info. The cursor of each branch can also
+  be encoded by a PageTokenCodec.
+
+  Attributes:
+    cursors: A tuple with one item for each branch: the cursor to resume the
+        branch from, None to start it from the beginning, or _BRANCH_EXHAUSTED
+        if it has no more results.
+  """
+
+  __slots__ = ('cursors',)
+
+  def __init__(self, cursors):
+    """Constructor for _BranchCursors.
+
+    Args:
+      cursors: An iterable of cursors, as in the cursors attribute.
+    """
+    self.cursors = tuple(cursors)
+
+  def to_websafe_string(self, codec=None):
+    """Encodes the cursors as a page token.
+
+    Args:
+      codec: An optional PageTokenCodec used to encode the cursor of each
+          branch, defaults to None, in which case their websafe strings are
+          used.
+
+    Returns:
+      The composite page token, starting with COMPOSITE_PAGE_TOKEN_PREFIX.
+    """
+    parts = []
+    for cursor in self.cursors:
+      if cursor is _BRANCH_EXHAUSTED:
+        parts.append(BRANCH_EXHAUSTED_TOKEN)
+      elif cursor is None:
+        parts.append('')
+      elif codec is not None:
+        parts.append(codec.Encode(cursor))
+      else:
+        parts.append(cursor.to_websafe_string())
+    return (COMPOSITE_PAGE_TOKEN_PREFIX +
+            COMPOSITE_PAGE_TOKEN_SEPARATOR.join(parts))
+
+  @classmethod
+  def from_websafe_string(cls, value, codec=None):
+    """Decodes a page token created by to_websafe_string.
+
+    Args:
+      value: A composite page token.
+      codec: An optional PageTokenCodec, defaults to None. Must be the codec
+          the token was encoded with.
+
+    Returns:
+      A _BranchCursors instance.
+
+    Raises:
+      ValueError: if the value is not a composite page token.
+    """
+    if not value.startswith(COMPOSITE_PAGE_TOKEN_PREFIX):
+      raise ValueError('Not a composite page token: %s.' % (value,))
+
+    cursors = []
+    parts = value[len(COMPOSITE_PAGE_TOKEN_PREFIX):].split(
+        COMPOSITE_PAGE_TOKEN_SEPARATOR)
+    for part in parts:
+      if part == BRANCH_EXHAUSTED_TOKEN:
+        cursors.append(_BRANCH_EXHAUSTED)
+      elif not part:
+        cursors.append(None)
+      elif codec is not None:
+        cursors.append(codec.Decode(part))
+      else:
+        cursors.append(datastore_query.Cursor.from_websafe_string(part))
+    return cls(cursors)
+
+
+def _OrderSpec(query):
+  """Gets the orders of a query as property names and directions.
+
+  Args:
+    query: An NDB query.
+
+  Returns:
+    A list of (property name, descending) pairs.
+  """
+  orders = query.orders
+  if orders is None:
+    return []
+  if isinstance(orders, datastore_query.CompositeOrder):
+    orders = orders.orders
+  else:
+    orders = [orders]
+  return [(order.prop,
+           order.direction == datastore_query.PropertyOrder.DESCENDING)
+          for order in orders]
+
+
+def _ResultKey(result):
+  """Gets the key of a query result, which is a key for keys-only queries."""
+  if isinstance(result, ndb.Key):
+    return result
+  return result.key
+
+
+def _OrderValue(result, name):
+  """Gets the value a query result is sorted by for a property in an order.
+
+  Args:
+    result: An entity, or a key for keys-only queries.
+    name: The name of the property, or '__key__'.
+
+  Returns:
+    The value of the property. Keys are compared by their flattened paths.
+  """
+  if name == '__key__':
+    return _ResultKey(result).flat()
+  return getattr(result, result._properties[name]._code_name)
+
+
+def _ResultComparator(order_spec):
+  """Creates a comparison function which sorts results as the datastore does.
+
+  Args:
+    order_spec: A list of (property name, descending) pairs from _OrderSpec.
+
+  Returns:
+    A function comparing two query results, ordered by the properties in
+        order_spec and then by key.
+  """
+  def Compare(lhs, rhs):
+    for name, descending in order_spec:
+      result = cmp(_OrderValue(lhs, name), _OrderValue(rhs, name))
+      if result:
+        return -result if descending else result
+    return cmp(_ResultKey(lhs).flat(), _ResultKey(rhs).flat())
+  return Compare
+
+
+def _BranchQuery(query, branch):
+  """Creates the query for a branch of a disjunctive query.
+
+  Args:
+    query: An NDB query whose filters are an ndb.DisjunctionNode.
+    branch: One of the filter nodes in the disjunction.
+
+  Returns:
+    An NDB query with the same options as query, filtered by branch.
+  """
+  return ndb.Query(kind=query.kind, ancestor=query.ancestor, filters=branch,
+                   orders=query.orders, app=query.app,
+                   namespace=query.namespace,
+                   default_options=query.default_options,
+                   projection=query.projection, group_by=query.group_by)
+
+
+def _EqualityFilterNames(node):
+  """Collects the names of the properties filtered by equality in a query.
+
+  Args:
+    node: The filters of an NDB query, such as an ndb.FilterNode or an
+        ndb.ConjunctionNode, or None.
+
+  Returns:
+    A set of the names of the properties with an equality filter, including
+        the equality filters an IN or OR filter is made of.
+  """
+  if isinstance(node, ndb.FilterNode):
+    if node._FilterNode__opsymbol == '=':
+      return set([node._FilterNode__name])
+  elif isinstance(node, (ndb.ConjunctionNode, ndb.DisjunctionNode)):
+    names = set()
+    for child in node:
+      names.update(_EqualityFilterNames(child))
+    return names
+  return set()
+
+
+def _InequalityFilterName(node):
+  """Finds the property filtered by inequality in a query.
+
+  Args:
+    node: The filters of an NDB query, such as an ndb.FilterNode or an
+        ndb.ConjunctionNode, or None.
+
+  Returns:
+    The name of the property with an inequality filter, or None if there is
+        none. The datastore allows a single one per query.
+  """
+  if isinstance(node, ndb.FilterNode):
+    if node._FilterNode__opsymbol in ('<', '<=', '>', '>='):
+      return node._FilterNode__name
+  elif isinstance(node, (ndb.ConjunctionNode, ndb.DisjunctionNode)):
+    for child in node:
+      name = _InequalityFilterName(child)
+      if name is not None:
+        return name
+  return None
+
+
+def _ProjectionForQuery(query, projection):
+  """Checks a projection against the final filters of a query.
+
+  The datastore can't project properties filtered by equality, which the
+  decorated method of a query may have added.
+
+  Args:
+    query: An NDB query.
+    projection: A list of property names to project, or None.
+
+  Returns:
+    The projection, or None if the query filters one of the projected
+        properties by equality.
+  """
+  if not projection:
+    return projection
+  filtered = _EqualityFilterNames(query.filters).intersection(projection)
+  if filtered:
+    logging.info('Fetching full %s entities, %s filtered by equality.',
+                 query.kind, ', '.join(sorted(filtered)))
+    return None
+  return projection
+
+
+def _QueryCacheKey(query, limit, query_options, message_class):
+  """Creates a key describing a page of query results for a result cache.
+
+  Args:
+    query: An NDB query. Its representation includes the kind, ancestor,
+        filters and orders of the query.
+    limit: The number of items fetched.
+    query_options: A dictionary of query options passed to fetch_page_async.
+    message_class: The ProtoRPC message class the page is converted to.
+
+  Returns:
+    A hashable tuple.
+  """
+  start_cursor = query_options.get('start_cursor')
+  if start_cursor is not None:
+    start_cursor = start_cursor.to_websafe_string()
+  projection = tuple(query_options.get('projection') or ())
+  keys_only = bool(query_options.get('keys_only'))
+  # Queries without a namespace run in the current namespace
+  namespace = query.namespace
+  if namespace is None:
+    namespace = namespace_manager.get_namespace()
+  return (repr(query), namespace, limit, start_cursor, projection, keys_only,
+          message_class)
 
 
-def FromValue(prop, value):
+def _AsTasklet(api_method):
+  """Turns a generator API method into an NDB tasklet.
+
+  Methods already decorated with ndb.tasklet, and methods which are not
+  generator functions, are returned unchanged.
+
+  Args:
+    api_method: A method to be decorated by an EndpointsModel decorator.
+
+  Returns:
+    The API method, wrapped by ndb.tasklet if it is a generator function.
+  """
+  if inspect.isgeneratorfunction(api_method):
+    return ndb.tasklet(api_method)
+  return api_method
+
+
+def _InvalidatingPutHook(hook):
+  """Wraps a _post_put_hook to first invalidate the caches of the model class.
+
+  Args:
+    hook: The function implementing the _post_put_hook of a model class.
+
+  Returns:
+    A function to be used as the _post_put_hook of the model class.
+  """
+  @functools.wraps(hook)
+  def PostPutHook(self, future):
+    """Invalidates the caches for the entity, then calls the original hook."""
+    if self._key is not None:
+      self._InvalidateCaches(self._key)
+    return hook(self, future)
+
+  PostPutHook.invalidates_caches = True
+  return PostPutHook
+
+
+def _InvalidatingDeleteHook(hook):
+  """Wraps a _post_delete_hook to first invalidate the caches of the class.
+
+  Args:
+    hook: The function implementing the _post_delete_hook classmethod of a
+        model class.
+
+  Returns:
+    A classmethod to be used as the _post_delete_hook of the model class.
+  """
+  @functools.wraps(hook)
+  def PostDeleteHook(cls, key, future):
+    """Invalidates the caches for the key, then calls the original hook."""
+    cls._InvalidateCaches(key)
+    return hook(cls, key, future)
+
+  PostDeleteHook.invalidates_caches = True
+  return classmethod(PostDeleteHook)
+
+
+def _StructuredFromMessage(prop):
+  """Resolves the deserializer for a structured property.
+
+  Args:
+    prop: The NDB structured property to be set.
+
+  Returns:
+    The FromMessage method of the model class of the property if the model
+        class is an EndpointsModel, otherwise a callable which always raises.
+  """
+  modelclass = prop._modelclass
+  if utils.IsSubclass(modelclass, EndpointsModel):
+    return modelclass.FromMessage
+
+  def RaiseInvalidModelClass(unused_value):
+    """Dummy deserializer that will always raise TypeError.
+
+    Raises:
+      TypeError: always
+    """
+    error_msg = ('Structured properties should refer to models which '
+                 'inherit from EndpointsModel. Received an instance '
+                 'of %s.' % (modelclass.__class__.__name__,))
+    raise TypeError(error_msg)
+  return RaiseInvalidModelClass
+
+
+def _FromValueConverter(prop, registry=ndb_utils.NDB_PROPERTY_FROM_VALUE,
+                        custom_registry=None):
+  """Resolves the deserializer used by FromValue for a property.
+
+  A deserializer set for the property class in custom_registry takes
+  precedence. Otherwise, structured properties are deserialized by the model
+  class they refer to. For all other properties, a FromValue method defined on
+  the property takes precedence, otherwise the deserializer registered for the
+  property class is used. The result only depends on the property, so it can be
+  computed once and reused for every value deserialized for that property.
+
+  Args:
+    prop: The NDB or alias property to be set.
+    registry: An optional dictionary from property classes to deserializers.
+        Defaults to NDB_PROPERTY_FROM_VALUE from ndb_utils.
+    custom_registry: An optional dictionary from property classes to
+        deserializers, such as _custom_property_from_value on a model class.
+        Defaults to None.
+
+  Returns:
+    A callable which takes a single non-null value and returns the deserialized
+        version of the value, or None if values need no conversion.
+  """
+  if custom_registry:
+    custom_converter = ndb_utils.GetValueConverter(custom_registry,
+                                                   prop.__class__)
+    if custom_converter is not None:
+      return custom_converter
+
+  if isinstance(prop, (ndb.StructuredProperty, ndb.LocalStructuredProperty)):
+    return _StructuredFromMessage(prop)
+
+  from_value = getattr(prop, 'FromValue', None)
+  if callable(from_value):
+    return from_value
+
+  property_class = prop.__class__
+  if property_class in registry:
+    return registry[property_class]
+  return ndb_utils.GetValueConverter(registry, property_class)
+
+
+def FromValue(prop, value, modelclass=None):
   """Deserializes a value from a ProtoRPC message type to a property value.
 
   Args:
     prop: The NDB or alias property to be set.
     value: The value to be deserialized.
+    modelclass: An optional EndpointsModel subclass the property belongs to,
+        defaults to None. If set, the deserializers of the class, including
+        its _custom_property_from_value, are used.
 
   Returns:
     The deserialized version of the ProtoRPC value to be set on a property.
@@ -129,31 +661,15 @@ def FromValue(prop, value):
   if value is None:
     return value
 
-  if isinstance(prop, (ndb.StructuredProperty, ndb.LocalStructuredProperty)):
-    modelclass = prop._modelclass
-    if not utils.IsSubclass(modelclass, EndpointsModel):
-      error_msg = ('Structured properties should refer to models which '
-                   'inherit from EndpointsModel. Received an instance '
-                   'of %s.' % (modelclass.__class__.__name__,))
-      raise TypeError(error_msg)
-    return modelclass.FromMessage(value)
-
-  if hasattr(prop, 'FromValue') and callable(prop.FromValue):
-    return prop.FromValue(value)
-  elif isinstance(prop, ndb.UserProperty):
-    return utils.UserMessageToUser(value)
-  elif isinstance(prop, ndb.GeoPtProperty):
-    return datastore_types.GeoPt(lat=value.lat, lon=value.lon)
-  elif isinstance(prop, ndb.KeyProperty):
-    return ndb.Key(urlsafe=value)
-  elif isinstance(prop, ndb.BlobKeyProperty):
-    return datastore_types.BlobKey(value)
-  elif isinstance(prop, (ndb.TimeProperty,
-                         ndb.DateProperty,
-                         ndb.DateTimeProperty)):
-    return utils.DatetimeValueFromString(value)
+  if modelclass is None:
+    converter = _FromValueConverter(prop)
   else:
+    converter = _FromValueConverter(
+        prop, registry=modelclass._property_from_value,
+        custom_registry=modelclass._custom_property_from_value)
+  if converter is None:
     return value
+  return converter(value)
 
 
 class _EndpointsQueryInfo(object):
@@ -170,10 +686,16 @@ class _EndpointsQueryInfo(object):
   Attributes:
     _entity: An instance of EndpointsModel or a subclass. The values from this
         will be used to create filters for a query.
-    _filters: A set of simple equality filters (ndb.FilterNode). Utilizes the
-        fact that FilterNodes are hashable and respect equality.
+    _filters: A set of filters. Simple equality filters (ndb.FilterNode) are
+        created from the entity, while inequality filters and IN filters (an
+        ndb.DisjunctionNode of equality filters) are added by query fields
+        using operators. Utilizes the fact that filter nodes are hashable and
+        respect equality.
+    _inequality_property: The name of the property with inequality filters, if
+        any. The datastore only allows inequality filters on one property.
     _ancestor: An ndb Key to be used as an ancestor for a query.
-    _cursor: A datastore_query.Cursor, to be used for resuming a query.
+    _cursor: A datastore_query.Cursor, to be used for resuming a query, or a
+        _BranchCursors for resuming a disjunctive query.
     _limit: A positive integer, to be used in a fetch.
     _order: String; comma separated list of property names or property names
         preceded by a minus sign. Used to define an order of query results.
@@ -185,6 +707,9 @@ class _EndpointsQueryInfo(object):
         not null, setting attributes on the query info object will fail.
   """
 
+  __slots__ = ('_entity', '_filters', '_inequality_property', '_ancestor',
+               '_cursor', '_limit', '_order', '_order_attrs', '_query_final')
+
   def __init__(self, entity):
     """Sets all internal variables to the default values and verifies entity.
 
@@ -201,6 +726,7 @@ class _EndpointsQueryInfo(object):
     self._entity = entity
 
     self._filters = set()
+    self._inequality_property = None
     self._ancestor = None
     self._cursor = None
     self._limit = None
@@ -229,22 +755,46 @@ class _EndpointsQueryInfo(object):
 
     Uses the filters and orders in the query info to refine the query. If the
     final query is already set, does nothing.
+
+    NDB runs a query with IN filters as several queries merged together, which
+    can only be resumed from a cursor if the results are ordered by key, so the
+    key is added as the last sort order of such queries. Since the first sort
+    order must be on the property with an inequality filter, if there is one,
+    that property is ordered by first when no order was given.
+
+    Raises:
+      endpoints.BadRequestException: if there are inequality filters and the
+          first sort order is on a different property.
     """
     if self._query_final is not None:
       return
 
     self._PopulateFilters()
 
+    if self._inequality_property is not None and self._order is not None:
+      first_order = self._order.strip().split(',')[0].lstrip('-')
+      if first_order != self._inequality_property:
+        raise endpoints.BadRequestException(INEQUALITY_ORDER_TEMPLATE %
+                                            (self._inequality_property,
+                                             first_order))
+
     # _entity.query calls the classmethod for the entity
     if self.ancestor is not None:
       query = self._entity.query(ancestor=self.ancestor)
     else:
       query = self._entity.query()
 
-    for simple_filter in self._filters:
+    # Sorted so that equal query infos produce equal queries
+    for simple_filter in sorted(self._filters, key=repr):
       query = query.filter(simple_filter)
     for order_attr in self._order_attrs:
       query = query.order(order_attr)
+    if any(isinstance(query_filter, ndb.DisjunctionNode)
+           for query_filter in self._filters):
+      if not self._order_attrs and self._inequality_property is not None:
+        query = query.order(
+            self._entity._properties[self._inequality_property])
+      query = query.order(self._entity.__class__._key)
 
     self._query_final = query
 
@@ -272,6 +822,35 @@ class _EndpointsQueryInfo(object):
 
     self._filters.add(candidate_filter)
 
+  def _AddOperatorFilter(self, prop, operator, value):
+    """Adds an inequality or IN filter from a query field using an operator.
+
+    Args:
+      prop: The NDB property to be filtered.
+      operator: A key of QUERY_OPERATORS, e.g. 'gte' or 'in'.
+      value: The value to compare against, or a list of values for 'in'. An
+          empty list is ignored.
+
+    Raises:
+      AttributeError: if query on the object is already final.
+      endpoints.BadRequestException: if an inequality filter is added for a
+          property other than the one which already has inequality filters.
+    """
+    if self._query_final is not None:
+      raise AttributeError('Can\'t add more filters. Query info is final.')
+
+    if operator == QUERY_OPERATOR_IN:
+      if value:
+        self._filters.add(prop._IN(value))
+      return
+
+    inequality_property = self._inequality_property
+    if inequality_property not in (None, prop._name):
+      raise endpoints.BadRequestException(MULTIPLE_INEQUALITY_TEMPLATE %
+                                          (inequality_property, prop._name))
+    self._inequality_property = prop._name
+    self._filters.add(prop._comparison(QUERY_OPERATORS[operator], value))
+
   @property
   def query(self):
     """Public getter for the final query on query info."""
@@ -317,14 +896,14 @@ class _EndpointsQueryInfo(object):
       AttributeError: if query on the object is already final.
       AttributeError: if the cursor has already been set.
       TypeError: if the value to be set is not an instance of
-          datastore_query.Cursor.
+          datastore_query.Cursor or of _BranchCursors.
     """
     if self._query_final is not None:
       raise AttributeError('Can\'t set cursor. Query info is final.')
 
     if self._cursor is not None:
       raise AttributeError('Cursor can\'t be set twice.')
-    if not isinstance(value, datastore_query.Cursor):
+    if not isinstance(value, (datastore_query.Cursor, _BranchCursors)):
       raise TypeError('Cursor must be an instance of datastore_query.Cursor.')
     self._cursor = value
 
@@ -454,12 +1033,42 @@ class EndpointsMetaModel(ndb.MetaModel):
     cls._proto_models = {}
     cls._proto_collections = {}
     cls._resource_containers = {}
+    cls._proto_status_collections = {}
+    cls._expanded_proto_models = {}
+    cls._expanded_fields = {}
+    cls._expanded_proto_collections = {}
+    cls._aggregate_collections = {}
+    cls._query_methods = []
+    cls._known_message_classes = set()
+    cls._to_message_plans = {}
+    cls._from_message_plans = {}
     cls._property_to_proto = ndb_utils.NDB_PROPERTY_TO_PROTO.copy()
+    cls._property_to_value = ndb_utils.NDB_PROPERTY_TO_VALUE.copy()
+    cls._property_from_value = ndb_utils.NDB_PROPERTY_FROM_VALUE.copy()
+
+    # Only classes with caches pay for the put and delete hooks, NDB skips
+    # calling the default ones
+    if any(getattr(cls, name) is not None for name in INVALIDATED_CACHES):
+      cls._InstallCacheInvalidation()
 
     cls._FixUpAliasProperties()
 
     cls._VerifyMessageFieldsSchema()
     cls._VerifyProtoMapping()
+    cls._ResolveValueConverters()
+
+  def _InstallCacheInvalidation(cls):
+    """Wraps the put and delete hooks of the class to invalidate its caches.
+
+    Hooks which already invalidate the caches, such as those inherited from a
+    class with caches, are left alone. Hooks defined on the class are wrapped
+    too, so they don't need to call the hooks of the superclass.
+    """
+    if not getattr(cls._post_put_hook, 'invalidates_caches', False):
+      cls._post_put_hook = _InvalidatingPutHook(cls._post_put_hook.__func__)
+    if not getattr(cls._post_delete_hook, 'invalidates_caches', False):
+      cls._post_delete_hook = _InvalidatingDeleteHook(
+          cls._post_delete_hook.__func__)
 
   def _FixUpAliasProperties(cls):
     """Updates the alias properties map and verifies each alias property.
@@ -545,6 +1154,38 @@ class EndpointsMetaModel(ndb.MetaModel):
         raise TypeError('No converter present for property %s' %
                         (property_class.__name__,))
 
+  def _ResolveValueConverters(cls):
+    """Resolves the value converters for each property class on the class.
+
+    First checks if there are _custom_property_to_value and
+    _custom_property_from_value dictionaries present and uses them to override
+    the mappings found in _property_to_value and _property_from_value.
+
+    Then, for each property (NDB or alias), stores the converters inferred from
+    the closest registered ancestor of the property class, so serializing or
+    deserializing a value only needs a single lookup by property class.
+
+    Raises:
+      TypeError: if a key from _custom_property_to_value or
+          _custom_property_from_value is not a valid NDB property.
+    """
+    for custom_attr, registry in (
+        ('_custom_property_to_value', cls._property_to_value),
+        ('_custom_property_from_value', cls._property_from_value)):
+      custom_registry = getattr(cls, custom_attr, None)
+      if isinstance(custom_registry, dict):
+        for key, value in custom_registry.iteritems():
+          if not utils.IsSubclass(key, ndb.Property):
+            raise TypeError('Invalid property class: %s.' % (key,))
+          registry[key] = value
+
+    for prop in cls._EndpointsPropertyItervalues():
+      property_class = prop.__class__
+      for registry in (cls._property_to_value, cls._property_from_value):
+        if property_class not in registry:
+          registry[property_class] = ndb_utils.GetValueConverter(
+              registry, property_class)
+
   # TODO(dhermes): Consider renaming this optional property attr from
   #                "message_field" to something more generic. It can either be
   #                a field or it can be a method with the signature
@@ -613,18 +1254,76 @@ class EndpointsModel(ndb.Model):
       _custom_property_to_proto: if set as a dictionary, allows default mappings
           from NDB properties to ProtoRPC fields in _property_to_proto to be
           overridden.
+      _property_to_value, _property_from_value: These are mappings from
+          properties to the methods used to serialize their values to ProtoRPC
+          values and to deserialize them back again. They start out as copies
+          of the global NDB_PROPERTY_TO_VALUE and NDB_PROPERTY_FROM_VALUE from
+          ndb_utils. A ToValue or FromValue method defined on a property takes
+          precedence over these mappings.
+      _custom_property_to_value, _custom_property_from_value: if set as
+          dictionaries, allow the default mappings in _property_to_value and
+          _property_from_value to be overridden.
+      _defer_update_from_key: if set to True, UpdateFromKey (used by the id and
+          entityKey setters) starts the get rather than blocking on it. The
+          entity is merged the first time a public attribute of the instance,
+          such as a property or from_datastore, is read, or by
+          MergePendingUpdates, so the get runs while the caller does other
+          work. NDB batches the gets started together into a single RPC.
+          Query methods merge the entity before building the query.
+      _entity_cache: if set to an EntityCache, UpdateFromKey reads entities
+          through the cache before going to the datastore. Cached entities are
+          invalidated when they are put or deleted through NDB in the same
+          process. The cache can be shared by several classes, and its hits,
+          misses, evictions and hit_rate can be used to tune its size and time
+          to live.
+      _missing_key_cache: if set to a MissingKeyCache, UpdateFromKey records
+          keys which have no entity and answers repeated gets for them without
+          going to the datastore, until the key expires from the cache or is
+          put through NDB in the same process. Since puts made by other
+          instances are not seen, its time to live bounds how long an entity
+          created elsewhere can still be reported as missing.
+      _key_get_coalescer: if set to a KeyGetCoalescer, concurrent calls to
+          UpdateFromKey for the same key from different threads share a single
+          datastore get, unless they are made in a transaction.
+      _query_result_cache: if set to a QueryResultCache, query methods created
+          with cache_results=True store their response messages in the cache.
+          Puts and deletes of entities of the class through NDB in the same
+          process invalidate the cached responses for queries of its kind.
+      _page_token_codec: if set to a PageTokenCodec, page tokens of query
+          methods are encoded and decoded by it rather than being the websafe
+          strings of cursors.
+      _page_prefetcher: if set to a PagePrefetcher, query methods created with
+          prefetch_next_page=True fetch the page after each one they return
+          ahead of time. As for _query_result_cache, puts and deletes through
+          NDB in the same process invalidate the prefetched pages of the kind.
+      _query_count_cache: if set to a QueryResultCache, count methods created
+          with cache_results=True store their responses in it. It is separate
+          from _query_result_cache so counts can be given a shorter time to
+          live, and is invalidated by writes in the same way.
+
+  The caches invalidated by writes must be set in the class definition, since
+  the metaclass wraps the _post_put_hook and _post_delete_hook of a class to
+  invalidate them only when one of them is set. Classes without caches keep the
+  default NDB hooks, which NDB does not call at all.
 
   The metaclass ensures each property (alias properties included) can be
   converted to a ProtoRPC message field before the class can be created. Due to
   this, a ProtoRPC message class can be created using any subset of the model
   properties in any order, or a collection containing multiple messages of the
   same class. Once created, these ProtoRPC message classes are cached in the
-  class variables _proto_models and _proto_collections.
-
-  Endpoints models also have two class methods which can be used as decorators
-  for Cloud Endpoints API methods: method and query_method. These methods use
-  the endpoints.api decorator but tailor the behavior to the specific model
-  class.
+  class variables _proto_models and _proto_collections, or in
+  _expanded_proto_models and _expanded_proto_collections for message classes
+  where KeyProperty fields are expanded into the messages of the entities they
+  refer to, and the names of the expanded fields of each such message class
+  are kept in _expanded_fields. The serializer and deserializer plans used by
+  ToMessage and FromMessage for each of these message classes are also cached,
+  in the class variables _to_message_plans and _from_message_plans. The
+  message classes of aggregate methods are cached in _aggregate_collections.
+
+  Endpoints models also have class methods which can be used as decorators
+  for Cloud Endpoints API methods: method, query_method, multi_method,
+  count_method and aggregate_method. These methods use the endpoints.api
+  decorator but tailor the behavior to the specific model class.
 
   Where a method decorated with the endpoints.api expects a ProtoRPC
   message class for the response and request type, a method decorated with the
@@ -650,11 +1349,21 @@ class EndpointsModel(ndb.Model):
   __metaclass__ = EndpointsMetaModel
 
   # Custom properties that can be specified to override this value when
-  # the class is defined. The value for `custom_property_to_proto`
+  # the class is defined. The values for the `_custom_property_*` mappings
   # will persist through subclasses while that for `_message_fields_schema`
   # will only work on the class where it is explicitly mentioned in
   # the definition.
   _custom_property_to_proto = None
+  _custom_property_to_value = None
+  _custom_property_from_value = None
+  _defer_update_from_key = False
+  _entity_cache = None
+  _missing_key_cache = None
+  _key_get_coalescer = None
+  _query_result_cache = None
+  _page_token_codec = None
+  _page_prefetcher = None
+  _query_count_cache = None
   _message_fields_schema = None
 
   # A new instance of each of these will be created by the metaclass
@@ -663,20 +1372,57 @@ class EndpointsModel(ndb.Model):
   _proto_models = None
   _proto_collections = None
   _resource_containers = None
+  _proto_status_collections = None
+  _expanded_proto_models = None
+  _expanded_proto_collections = None
+  _expanded_fields = None
+  _aggregate_collections = None
+  _query_methods = None
+  _known_message_classes = None
+  _to_message_plans = None
+  _from_message_plans = None
   _property_to_proto = None
+  _property_to_value = None
+  _property_from_value = None
+
+  # Default values for instance state. Since entities are also created when
+  # NDB deserializes query results, these are only set on an instance when
+  # they are needed.
+  _from_datastore = False
+  _pending_update = None
+  _deferring_update = False
+  _request_index = None
+  __query_info = None
+
+  @property
+  def _endpoints_query_info(self):
+    """Query info object for the current instance, created on first access.
+
+    The _EndpointsQueryInfo instance is directly tied to the current instance
+    and can be used to form queries using properties provided by the instance
+    and can be augmented by alias properties to allow custom queries.
+
+    Returns:
+      The _EndpointsQueryInfo instance for the current entity.
+    """
+    query_info = self.__query_info
+    if query_info is None:
+      query_info = self.__query_info = _EndpointsQueryInfo(self)
+    return query_info
 
-  def __init__(self, *args, **kwargs):
-    """Initializes NDB model and adds a query info object.
+  def __getattribute__(self, name):
+    """Merges a deferred UpdateFromKey before a public attribute is read.
 
-    Attributes:
-      _endpoints_query_info: An _EndpointsQueryInfo instance, directly tied to
-          the current instance that can be used to form queries using properties
-          provided by the instance and can be augmented by alias properties to
-          allow custom queries.
+    Args:
+      name: The name of the attribute.
+
+    Returns:
+      The value of the attribute.
     """
-    super(EndpointsModel, self).__init__(*args, **kwargs)
-    self._endpoints_query_info = _EndpointsQueryInfo(self)
-    self._from_datastore = False
+    if (name[:1] != '_' and
+        object.__getattribute__(self, '_pending_update') is not None):
+      object.__getattribute__(self, '_ResolvePendingUpdate')()
+    return super(EndpointsModel, self).__getattribute__(name)
 
   @property
   def from_datastore(self):
@@ -731,60 +1477,190 @@ class EndpointsModel(ndb.Model):
         if not value_set:
           setattr(self, attr_name, value)
 
-  def UpdateFromKey(self, key):
-    """Attempts to get current entity for key and update the unset properties.
+  def _MergeFromDatastore(self, entity):
+    """Merges an entity retrieved from the datastore into the current one.
 
-    Only does anything if there is a corresponding entity in the datastore.
     Calls _CopyFromEntity to merge the current entity with the one that was
     retrieved. If one was retrieved, sets _from_datastore to True to signal that
     an entity was retrieved.
 
     Args:
-      key: An NDB key used to retrieve an entity.
+      entity: The entity retrieved from the datastore, or None if there was no
+          corresponding entity.
     """
-    self._key = key
-    entity = self._key.get()
     if entity is not None:
       self._CopyFromEntity(entity)
       self._from_datastore = True
 
-  def IdSet(self, value):
-    """Setter to be used for default id EndpointsAliasProperty.
-
-    Sets the key on the current entity using the value passed in as the ID.
-    Using this key, attempts to retrieve the entity from the datastore and
-    update the unset properties of the current entity with those from the
-    retrieved entity.
+  @classmethod
+  @ndb.tasklet
+  def _MergePendingUpdatesAsync(cls, entities):
+    """Merges the entities got by deferred UpdateFromKey calls once retrieved.
 
     Args:
-      value: An integer ID value for a simple key.
-
-    Raises:
-      TypeError: if the value to be set is not an integer. (Though if outside of
-          a given range, the get call will also throw an exception.)
+      entities: A list of entities of this model. Entities without a deferred
+          update are skipped.
     """
-    if not isinstance(value, (int, long)):
-      raise TypeError('ID must be an integer.')
-    self.UpdateFromKey(ndb.Key(self.__class__, value))
+    pending = [entity for entity in entities
+               if entity._pending_update is not None]
+    if not pending:
+      return
 
-  @EndpointsAliasProperty(setter=IdSet, property_type=messages.IntegerField)
-  def id(self):
-    """Getter to be used for default id EndpointsAliasProperty.
+    futures = [entity._pending_update for entity in pending]
+    results = yield futures
 
-    Specifies that the ProtoRPC property_type is IntegerField, though simple
-    string IDs or more complex IDs that use ancestors could also be used.
+    for entity, future, result in zip(pending, futures, results):
+      # Only merge if the key was not changed while waiting on the get
+      if entity._pending_update is future:
+        entity._pending_update = None
+        entity._MergeFromDatastore(result)
 
-    Returns:
-      The integer ID of the entity key, if the key is not null and the integer
-          ID is not null, else returns None.
+  @classmethod
+  def MergePendingUpdates(cls, entities):
+    """Merges the entities for deferred UpdateFromKey calls into entities.
+
+    Args:
+      entities: A list of entities of this model.
     """
-    if self._key is not None:
-      return self._key.integer_id()
+    cls._MergePendingUpdatesAsync(entities).get_result()
 
-  def EntityKeySet(self, value):
-    """Setter to be used for default entityKey EndpointsAliasProperty.
+  def _ResolvePendingUpdate(self):
+    """Merges the entity for a deferred UpdateFromKey call, if there is one."""
+    if self._pending_update is not None:
+      self._MergePendingUpdatesAsync([self]).get_result()
 
-    Sets the key on the current entity using the urlsafe entity key string.
+  def _GetForUpdateAsync(self, key):
+    """Issues the get used by UpdateFromKey.
+
+    If _missing_key_cache is set on the class, keys recently found to have no
+    entity are not retrieved again. If _entity_cache is set on the class, the
+    entity is read through the cache.
+
+    Args:
+      key: An NDB key used to retrieve an entity.
+
+    Returns:
+      An NDB future whose result is the entity, or None if there is no entity
+          for the key.
+    """
+    if self._missing_key_cache is not None:
+      return self._missing_key_cache.GetAsync(key, self._GetEntityAsync)
+    return self._GetEntityAsync(key)
+
+  def _GetEntityAsync(self, key):
+    """Gets an entity, through _entity_cache if it is set on the class.
+
+    Args:
+      key: An NDB key used to retrieve an entity.
+
+    Returns:
+      An NDB future whose result is the entity, or None if there is no entity
+          for the key.
+    """
+    if self._entity_cache is not None:
+      return self._entity_cache.GetAsync(key, self._GetFromDatastoreAsync)
+    return self._GetFromDatastoreAsync(key)
+
+  def _GetFromDatastoreAsync(self, key):
+    """Gets an entity from the datastore.
+
+    If _key_get_coalescer is set on the class, the get is shared with concurrent
+    gets of the same key.
+
+    Args:
+      key: An NDB key used to retrieve an entity.
+
+    Returns:
+      An NDB future whose result is the entity, or None if there is no entity
+          for the key.
+    """
+    if self._key_get_coalescer is not None:
+      return self._key_get_coalescer.GetAsync(key)
+    return key.get_async()
+
+  def UpdateFromKey(self, key):
+    """Attempts to get current entity for key and update the unset properties.
+
+    Only does anything if there is a corresponding entity in the datastore.
+    Calls _MergeFromDatastore to merge the current entity with the one that was
+    retrieved. If _entity_cache is set on the class, the entity may be retrieved
+    from the cache instead.
+
+    If _defer_update_from_key is set on the class, the get is only started
+    here and the entity is merged when a public attribute is first read, or by
+    MergePendingUpdates.
+
+    Args:
+      key: An NDB key used to retrieve an entity.
+    """
+    # A previous update must be merged before the key changes
+    self._ResolvePendingUpdate()
+
+    self._key = key
+    if self._defer_update_from_key or self._deferring_update:
+      self._pending_update = self._GetForUpdateAsync(key)
+    else:
+      self._MergeFromDatastore(self._GetForUpdateAsync(key).get_result())
+
+  @classmethod
+  def _InvalidateCaches(cls, key):
+    """Invalidates the caches of the class after a put or delete of a key.
+
+    Removes the entity from _entity_cache and the key from _missing_key_cache,
+    and invalidates the query results for the kind in _query_result_cache,
+    _page_prefetcher and _query_count_cache, if any of them is set.
+
+    Args:
+      key: The NDB key of an entity which has been written or deleted.
+    """
+    if cls._entity_cache is not None:
+      cls._entity_cache.Invalidate(key)
+    if cls._missing_key_cache is not None:
+      cls._missing_key_cache.Invalidate(key)
+    kind = key.kind()
+    for result_cache in (cls._query_result_cache, cls._page_prefetcher,
+                         cls._query_count_cache):
+      if result_cache is not None:
+        result_cache.Invalidate(kind)
+
+  def IdSet(self, value):
+    """Setter to be used for default id EndpointsAliasProperty.
+
+    Sets the key on the current entity using the value passed in as the ID.
+    Using this key, attempts to retrieve the entity from the datastore and
+    update the unset properties of the current entity with those from the
+    retrieved entity.
+
+    Args:
+      value: An integer ID value for a simple key.
+
+    Raises:
+      TypeError: if the value to be set is not an integer. (Though if outside of
+          a given range, the get call will also throw an exception.)
+    """
+    if not isinstance(value, (int, long)):
+      raise TypeError('ID must be an integer.')
+    self.UpdateFromKey(ndb.Key(self.__class__, value))
+
+  @EndpointsAliasProperty(setter=IdSet, property_type=messages.IntegerField,
+                          key_derived=True)
+  def id(self):
+    """Getter to be used for default id EndpointsAliasProperty.
+
+    Specifies that the ProtoRPC property_type is IntegerField, though simple
+    string IDs or more complex IDs that use ancestors could also be used.
+
+    Returns:
+      The integer ID of the entity key, if the key is not null and the integer
+          ID is not null, else returns None.
+    """
+    if self._key is not None:
+      return self._key.integer_id()
+
+  def EntityKeySet(self, value):
+    """Setter to be used for default entityKey EndpointsAliasProperty.
+
+    Sets the key on the current entity using the urlsafe entity key string.
     Using the key set on the entity, attempts to retrieve the entity from the
     datastore and update the unset properties of the current entity with those
     from the retrieved entity.
@@ -801,7 +1677,7 @@ class EndpointsModel(ndb.Model):
       raise TypeError('entityKey must be a string.')
     self.UpdateFromKey(ndb.Key(urlsafe=value))
 
-  @EndpointsAliasProperty(setter=EntityKeySet)
+  @EndpointsAliasProperty(setter=EntityKeySet, key_derived=True)
   def entityKey(self):
     """Getter to be used for default entityKey EndpointsAliasProperty.
 
@@ -834,7 +1710,9 @@ class EndpointsModel(ndb.Model):
     Returns:
       The integer (or null) limit from the query info on the entity.
     """
-    return self._endpoints_query_info.limit
+    query_info = self.__query_info
+    if query_info is not None:
+      return query_info.limit
 
   def OrderSet(self, value):
     """Setter to be used for default order EndpointsAliasProperty.
@@ -856,20 +1734,23 @@ class EndpointsModel(ndb.Model):
     Returns:
       The string (or null) order from the query info on the entity.
     """
-    return self._endpoints_query_info.order
+    query_info = self.__query_info
+    if query_info is not None:
+      return query_info.order
 
   def PageTokenSet(self, value):
     """Setter to be used for default pageToken EndpointsAliasProperty.
 
-    Tries to use Cursor.from_websafe_string to convert the value to a cursor
-    and then sets the cursor on the entity's query info object, and the query
-    info object handles validation.
+    Tries to use Cursor.from_websafe_string, or the _page_token_codec set on
+    the class, to convert the value to a cursor and then sets the cursor on the
+    entity's query info object, and the query info object handles validation.
+    Composite page tokens, which hold a cursor for each branch of a disjunctive
+    query, are converted to _BranchCursors.
 
     Args:
       value: The websafe string version of a cursor.
     """
-    cursor = datastore_query.Cursor.from_websafe_string(value)
-    self._endpoints_query_info.cursor = cursor
+    self._endpoints_query_info.cursor = self._DecodePageToken(value)
 
   @EndpointsAliasProperty(setter=PageTokenSet)
   def pageToken(self):
@@ -881,9 +1762,44 @@ class EndpointsModel(ndb.Model):
       The websafe string from the cursor on the entity's query info object, or
           None if the cursor is null.
     """
-    cursor = self._endpoints_query_info.cursor
-    if cursor is not None:
-      return cursor.to_websafe_string()
+    query_info = self.__query_info
+    if query_info is not None and query_info.cursor is not None:
+      return self._EncodePageToken(query_info.cursor)
+
+  @classmethod
+  def _EncodePageToken(cls, cursor):
+    """Converts a cursor to a page token.
+
+    Args:
+      cursor: A datastore_query.Cursor or _BranchCursors.
+
+    Returns:
+      The page token, encoded by the _page_token_codec set on the class or, if
+          there is none, the websafe string of the cursor.
+    """
+    codec = cls._page_token_codec
+    if isinstance(cursor, _BranchCursors):
+      return cursor.to_websafe_string(codec=codec)
+    elif codec is not None:
+      return codec.Encode(cursor)
+    return cursor.to_websafe_string()
+
+  @classmethod
+  def _DecodePageToken(cls, value):
+    """Converts a page token created by _EncodePageToken to a cursor.
+
+    Args:
+      value: The page token string.
+
+    Returns:
+      A datastore_query.Cursor, or a _BranchCursors for a composite page token.
+    """
+    codec = cls._page_token_codec
+    if value.startswith(COMPOSITE_PAGE_TOKEN_PREFIX):
+      return _BranchCursors.from_websafe_string(value, codec=codec)
+    elif codec is not None:
+      return codec.Decode(value)
+    return datastore_query.Cursor.from_websafe_string(value)
 
   @classmethod
   def _GetEndpointsProperty(cls, attr_name):
@@ -916,7 +1832,38 @@ class EndpointsModel(ndb.Model):
     return itertools.chain(property_values, alias_values)
 
   @classmethod
-  def _MessageFields(cls, message_fields_schema, allow_message_fields=True):
+  def _QueryOperatorField(cls, name):
+    """Parses a query field which filters a property using an operator.
+
+    A query field such as created__gte filters the NDB property created using
+    the operator gte. Names of properties on the class are never parsed.
+
+    Args:
+      name: The name of a field.
+
+    Returns:
+      A pair of the NDB property and the operator (a key of QUERY_OPERATORS),
+          or None if the name does not use an operator.
+
+    Raises:
+      TypeError: if the name uses an operator but the property is repeated.
+    """
+    if cls._GetEndpointsProperty(name) is not None:
+      return None
+
+    prop_name, _, operator = name.rpartition(QUERY_OPERATOR_SEPARATOR)
+    prop = cls._properties.get(prop_name)
+    if prop is None or operator not in QUERY_OPERATORS:
+      return None
+
+    if prop._repeated:
+      raise TypeError('Operators can\'t be used to query the repeated '
+                      'property %s.' % (prop_name,))
+    return prop, operator
+
+  @classmethod
+  def _MessageFields(cls, message_fields_schema, allow_message_fields=True,
+                     allow_query_operators=False):
     """Creates ProtoRPC fields from a MessageFieldsSchema.
 
     Verifies that each property is valid (may cause exception) and then uses the
@@ -927,6 +1874,10 @@ class EndpointsModel(ndb.Model):
       allow_message_fields: An optional boolean; defaults to True. If True, does
           nothing. If False, stops ProtoRPC message classes that have one or
           more ProtoRPC {MessageField}s from being created.
+      allow_query_operators: An optional boolean; defaults to False. If True,
+          fields may also be query fields using operators, such as created__gte
+          or score__in. These have the type of the property they filter, and
+          are repeated for the IN operator.
 
     Returns:
       Dictionary of ProtoRPC fields.
@@ -944,7 +1895,13 @@ class EndpointsModel(ndb.Model):
     message_fields = {}
     for index, name in enumerate(message_fields_schema):
       field_index = index + 1
-      prop = _VerifyProperty(cls, name)
+      operator_field = None
+      if allow_query_operators:
+        operator_field = cls._QueryOperatorField(name)
+      if operator_field is None:
+        prop = _VerifyProperty(cls, name)
+      else:
+        prop = operator_field[0]
       to_proto = cls._property_to_proto.get(prop.__class__)
 
       if to_proto is None:
@@ -966,6 +1923,9 @@ class EndpointsModel(ndb.Model):
           error_msg = NO_MSG_FIELD_TEMPLATE % (proto_attr.__class__.__name__,)
           raise TypeError(error_msg)
 
+      if operator_field is not None and operator_field[1] == QUERY_OPERATOR_IN:
+        proto_attr = _RepeatedField(proto_attr)
+
       message_fields[name] = proto_attr
 
     return message_fields
@@ -974,9 +1934,9 @@ class EndpointsModel(ndb.Model):
   def ProtoModel(cls, fields=None, allow_message_fields=True):
     """Creates a ProtoRPC message class using a subset of the class properties.
 
-    Creates a MessageFieldsSchema from the passed in fields (may cause exception
-    if not valid). If this MessageFieldsSchema is already in the cache of
-    models, returns the cached value.
+    Gets an interned MessageFieldsSchema for the passed in fields (may cause
+    exception if not valid). If this MessageFieldsSchema is already in the cache
+    of models, returns the cached value.
 
     If not creates ProtoRPC fields from the MessageFieldsSchema (may cause
     exception). Using the created fields and the name from the MessageFieldsSchema,
@@ -1004,8 +1964,8 @@ class EndpointsModel(ndb.Model):
       fields = cls._message_fields_schema
     # If fields is None, either the module user manaully removed the default
     # value or some bug has occurred in the library
-    message_fields_schema = MessageFieldsSchema(fields,
-                                                basename=cls.__name__ + 'Proto')
+    message_fields_schema = MessageFieldsSchema.Intern(
+        fields, basename=cls.__name__ + 'Proto')
 
     if message_fields_schema in cls._proto_models:
       cached_model = cls._proto_models[message_fields_schema]
@@ -1029,10 +1989,93 @@ class EndpointsModel(ndb.Model):
                          message_fields)
 
     cls._proto_models[message_fields_schema] = message_class
+    cls._known_message_classes.add(message_class)
+    return message_class
+
+  @classmethod
+  def _ExpandedKeyProperty(cls, name):
+    """Gets a KeyProperty to be expanded and the model class it refers to.
+
+    Args:
+      name: The name of the property.
+
+    Returns:
+      A pair of the NDB KeyProperty and the EndpointsModel subclass with the
+          kind set on the property.
+
+    Raises:
+      TypeError: if the property is not a KeyProperty, or its kind is not set
+          to an EndpointsModel subclass which has already been defined.
+    """
+    prop = cls._properties.get(name)
+    if not isinstance(prop, ndb.KeyProperty) or prop._kind is None:
+      raise TypeError(EXPAND_NOT_KEY_TEMPLATE % (name,))
+
+    target_class = ndb.Model._kind_map.get(prop._kind)
+    if not utils.IsSubclass(target_class, EndpointsModel):
+      raise TypeError(EXPAND_NOT_KEY_TEMPLATE % (name,))
+    return prop, target_class
+
+  @classmethod
+  def ExpandedProtoModel(cls, fields=None, expand=()):
+    """Creates a ProtoRPC message class with some keys expanded to messages.
+
+    As with ProtoModel, but each KeyProperty named in expand is a MessageField
+    holding the message (from ProtoModel with the default fields) of the entity
+    its key refers to, rather than a urlsafe key string.
+
+    Args:
+      fields: Optional fields, defaults to None. If None, the default from
+          the class is used. If specified, will be converted to a
+          MessageFieldsSchema object (and verified as such).
+      expand: An optional list or tuple of the names of KeyProperty fields to
+          be expanded. Defaults to an empty tuple, in which case the result of
+          ProtoModel is returned.
+
+    Returns:
+      The cached or created ProtoRPC message class specified by the fields and
+          the expanded fields.
+
+    Raises:
+      TypeError: if a name in expand is not one of the fields or can't be
+          expanded.
+    """
+    if not expand:
+      return cls.ProtoModel(fields=fields)
+
+    if fields is None:
+      fields = cls._message_fields_schema
+    message_fields_schema = MessageFieldsSchema.Intern(
+        fields, basename=cls.__name__ + 'Proto')
+
+    expand = tuple(sorted(set(expand)))
+    cache_key = (message_fields_schema, expand)
+    if cache_key in cls._expanded_proto_models:
+      return cls._expanded_proto_models[cache_key]
+
+    message_fields = cls._MessageFields(message_fields_schema)
+    for name in expand:
+      if name not in message_fields:
+        raise TypeError(EXPAND_NOT_IN_FIELDS_TEMPLATE % (name,))
+      prop, target_class = cls._ExpandedKeyProperty(name)
+      message_fields[name] = messages.MessageField(
+          target_class.ProtoModel(), message_fields[name].number,
+          repeated=prop._repeated)
+
+    # As in ProtoModel, to keep the schema name in the discovery document
+    message_fields['__module__'] = ''
+    message_class = type(message_fields_schema.name + _ExpandSuffix(expand),
+                         (messages.Message,),
+                         message_fields)
+
+    cls._expanded_proto_models[cache_key] = message_class
+    cls._expanded_fields[message_class] = frozenset(expand)
+    cls._known_message_classes.add(message_class)
     return message_class
 
   @classmethod
-  def ResourceContainer(cls, message=message_types.VoidMessage, fields=None):
+  def ResourceContainer(cls, message=message_types.VoidMessage, fields=None,
+                        allow_query_operators=False):
     """Creates a ResourceContainer using a subset of the class properties.
 
     Creates a MessageFieldsSchema from the passed in fields (may cause exception
@@ -1050,6 +2093,9 @@ class EndpointsModel(ndb.Model):
       fields: Optional fields, defaults to None. If None, the default from
           the class is used. If specified, will be converted to a
           MessageFieldsSchema object (and verified as such).
+      allow_query_operators: An optional boolean; defaults to False. If True,
+          fields may also be query fields using operators, such as
+          created__gte. Passed to _MessageFields.
 
     Returns:
       The cached or created ResourceContainer specified by the fields and message.
@@ -1059,19 +2105,22 @@ class EndpointsModel(ndb.Model):
     if fields is None:
       fields = cls._message_fields_schema
 
-    message_fields_schema = MessageFieldsSchema(fields,
-                                                basename=cls.__name__ + 'Proto')
+    message_fields_schema = MessageFieldsSchema.Intern(
+        fields, basename=cls.__name__ + 'Proto')
 
-    container_key = (message.__name__, message_fields_schema)
+    container_key = (message.__name__, message_fields_schema,
+                     allow_query_operators)
     if container_key in cls._resource_containers:
       return cls._resource_containers[container_key]
 
-    message_fields = cls._MessageFields(message_fields_schema,
-                                        allow_message_fields=False)
+    message_fields = cls._MessageFields(
+        message_fields_schema, allow_message_fields=False,
+        allow_query_operators=allow_query_operators)
 
     resource_container = endpoints.ResourceContainer(message, **message_fields)
 
     cls._resource_containers[container_key] = resource_container
+    cls._known_message_classes.add(resource_container.combined_message_class)
     return resource_container
 
   @classmethod
@@ -1105,8 +2154,8 @@ class EndpointsModel(ndb.Model):
     """
     if collection_fields is None:
       collection_fields = cls._message_fields_schema
-    message_fields_schema = MessageFieldsSchema(collection_fields,
-                                                basename=cls.__name__ + 'Proto')
+    message_fields_schema = MessageFieldsSchema.Intern(
+        collection_fields, basename=cls.__name__ + 'Proto')
 
     if message_fields_schema in cls._proto_collections:
       return cls._proto_collections[message_fields_schema]
@@ -1127,167 +2176,1375 @@ class EndpointsModel(ndb.Model):
     cls._proto_collections[message_fields_schema] = collection_class
     return collection_class
 
-  def ToMessage(self, fields=None):
-    """Converts an entity to an ProtoRPC message.
+  @classmethod
+  def ExpandedProtoCollection(cls, collection_fields=None, expand=()):
+    """Creates a ProtoRPC collection message class with some keys expanded.
 
-    Uses the fields list passed in to create a ProtoRPC message class and then
-    converts the relevant fields from the entity using ToValue.
+    As with ProtoCollection, but the items are created by ExpandedProtoModel.
 
     Args:
-      fields: Optional fields, defaults to None. Passed to ProtoModel to
-          create a ProtoRPC message class for the message.
+      collection_fields: Optional fields, defaults to None. If None, the
+          default from the class is used. If specified, will be converted to a
+          MessageFieldsSchema object (and verified as such).
+      expand: An optional list or tuple of the names of KeyProperty fields to
+          be expanded. Defaults to an empty tuple, in which case the result of
+          ProtoCollection is returned.
 
     Returns:
-      The ProtoRPC message created using the values from the entity and the
-          fields provided for the message class.
-
-    Raises:
-      TypeError: if a repeated field has a value which is not a tuple or list.
+      The cached or created ProtoRPC (collection) message class specified by
+          the fields and the expanded fields.
     """
-    proto_model = self.ProtoModel(fields=fields)
-
-    proto_args = {}
-    for field in proto_model.all_fields():
-      name = field.name
-      value_property = _VerifyProperty(self.__class__, name)
+    if not expand:
+      return cls.ProtoCollection(collection_fields=collection_fields)
 
-      # Since we are using getattr rather than checking self._values, this will
-      # also work for properties which have a default set
-      value = getattr(self, value_property._code_name)
-      if value is None:
-        continue
+    if collection_fields is None:
+      collection_fields = cls._message_fields_schema
+    message_fields_schema = MessageFieldsSchema.Intern(
+        collection_fields, basename=cls.__name__ + 'Proto')
 
-      if field.repeated:
-        if not isinstance(value, (list, tuple)):
-          error_msg = ('Property %s is a repeated field and its value should '
-                       'be a list or tuple. Received: %s' % (name, value))
-          raise TypeError(error_msg)
+    expand = tuple(sorted(set(expand)))
+    cache_key = (message_fields_schema, expand)
+    if cache_key in cls._expanded_proto_collections:
+      return cls._expanded_proto_collections[cache_key]
 
-        to_add = [ToValue(value_property, element) for element in value]
-      else:
-        to_add = ToValue(value_property, value)
-      proto_args[name] = to_add
+    proto_model = cls.ExpandedProtoModel(fields=message_fields_schema,
+                                         expand=expand)
 
-    return proto_model(**proto_args)
+    message_fields = {
+        'items': messages.MessageField(proto_model, 1, repeated=True),
+        'nextPageToken': messages.StringField(2),
+        '__module__': '',
+    }
+    collection_class = type(
+        message_fields_schema.collection_name + _ExpandSuffix(expand),
+        (messages.Message,),
+        message_fields)
+    cls._expanded_proto_collections[cache_key] = collection_class
+    return collection_class
 
   @classmethod
-  def FromMessage(cls, message):
-    """Converts a ProtoRPC message to an entity of the model class.
-
-    Makes sure the message being converted is an instance of a ProtoRPC message
-    class we have already encountered and then converts the relevant field
-    values to the entity values using FromValue.
-
-    When collecting the values from the message for conversion to an entity, NDB
-    and alias properties are treated differently. The NDB properties can just be
-    passed in to the class constructor as kwargs, but the alias properties must
-    be set after the fact, and may even throw exceptions if the message has
-    fields corresponding to alias properties which don't define a setter.
+  def _AggregateProperty(cls, aggregate):
+    """Parses the name of an aggregate, e.g. score__sum.
 
     Args:
-      message: A ProtoRPC message.
+      aggregate: The name of a non-repeated integer or float NDB property,
+          followed by QUERY_OPERATOR_SEPARATOR and one of AGGREGATE_FUNCTIONS.
 
     Returns:
-      The entity of the current class that was created using the
-          message field values.
+      A triple of the NDB property, the aggregate function name and the
+          ProtoRPC field class of the aggregate value.
 
     Raises:
-      TypeError: if a message class is encountered that has not been stored in
-          the _proto_models cache on the class. This is a precaution against
-          unkown ProtoRPC message classes.
-      TypeError: if a repeated field has a value which is not a tuple or list.
+      TypeError: if the aggregate is not valid for this class.
     """
-    message_class = message.__class__
+    name, _, function = aggregate.rpartition(QUERY_OPERATOR_SEPARATOR)
+    prop = cls._properties.get(name)
+    if function in AGGREGATE_FUNCTIONS and prop is not None and (
+        not prop._repeated):
+      for property_class, field_class in AGGREGATE_PROPERTY_TO_FIELD:
+        if isinstance(prop, property_class):
+          return prop, function, field_class
+    raise TypeError(BAD_AGGREGATE_TEMPLATE % (aggregate,))
 
-    # The CombinedContainer is a result of ResourceContainers.
-    # Might need some better handling...
-    if (message_class not in cls._proto_models.values() and
-        message_class.__name__ != "CombinedContainer"):
-      error_msg = ('The message is an instance of %s, which is a class this '
-                   'EndpointsModel does not know how to process.' %
-                   (message_class.__name__))
-      raise TypeError(error_msg)
-
-    entity_kwargs = {}
-    alias_args = []
-
-    for field in sorted(message_class.all_fields(),
-                        key=lambda field: field.number):
-      if not field.name in message._Message__decoded_fields:
-        continue
-      name = field.name
-      value = getattr(message, name, None)
-      if value is None:
-        continue
+  @classmethod
+  def AggregateCollection(cls, group_by=(), aggregates=()):
+    """Creates a ProtoRPC message class for the aggregates of query results.
 
-      value_property = _VerifyProperty(cls, name)
+    The collection has a single field, items, with one message for each group
+    of results. Each of these has the fields group, a message created by
+    ProtoModel holding the group_by properties (only if there are any), count,
+    the number of results in the group, and one field for each aggregate, named
+    after it.
 
-      if field.repeated:
-        if not isinstance(value, (list, tuple)):
-          error_msg = ('Repeated attribute should be a list or tuple. '
-                       'Received a %s.' % (value.__class__.__name__,))
-          raise TypeError(error_msg)
-        to_add = [FromValue(value_property, element) for element in value]
-      else:
-        to_add = FromValue(value_property, value)
+    The message classes are cached in _aggregate_collections.
 
-      local_name = value_property._code_name
-      if isinstance(value_property, EndpointsAliasProperty):
-        alias_args.append((local_name, to_add))
-      else:
-        entity_kwargs[local_name] = to_add
+    Args:
+      group_by: An optional list or tuple of the names of the NDB properties
+          the results are grouped by. Defaults to an empty tuple, in which case
+          all results are in a single group.
+      aggregates: An optional list or tuple of aggregate names, such as
+          score__sum, score__min or score__max. Defaults to an empty tuple.
 
-    # Will not throw exception if a required property is not included. This
-    # sort of exception is only thrown when attempting to put the entity.
-    entity = cls(**entity_kwargs)
+    Returns:
+      The cached or created ProtoRPC (collection) message class.
 
-    # Set alias properties, will fail on an alias property if that
-    # property was not defined with a setter
-    for name, value in alias_args:
-      setattr(entity, name, value)
+    Raises:
+      TypeError: if a group_by property or an aggregate is not valid for this
+          class.
+    """
+    group_by = tuple(group_by)
+    aggregates = tuple(aggregates)
+    cache_key = (group_by, aggregates)
+    if cache_key in cls._aggregate_collections:
+      return cls._aggregate_collections[cache_key]
+
+    for name in group_by:
+      prop = cls._properties.get(name)
+      if (prop is None or prop._repeated or
+          isinstance(prop, AGGREGATE_UNGROUPABLE_PROPERTIES)):
+        raise TypeError(BAD_GROUP_BY_TEMPLATE % (name,))
+
+    class_name = '_'.join((cls.__name__ + 'Aggregate',) + group_by + aggregates)
+    group_fields = {
+        'count': messages.IntegerField(2, required=True),
+        '__module__': '',
+    }
+    if group_by:
+      group_fields['group'] = messages.MessageField(
+          cls.ProtoModel(fields=group_by), 1)
+    for number, aggregate in enumerate(aggregates, 3):
+      _, _, field_class = cls._AggregateProperty(aggregate)
+      group_fields[aggregate] = field_class(number)
+    group_class = type(class_name, (messages.Message,), group_fields)
 
-    return entity
+    message_fields = {
+        'items': messages.MessageField(group_class, 1, repeated=True),
+        '__module__': '',
+    }
+    collection_class = type(class_name + 'Collection', (messages.Message,),
+                            message_fields)
+    cls._aggregate_collections[cache_key] = collection_class
+    return collection_class
 
   @classmethod
-  def ToMessageCollection(cls, items, collection_fields=None,
-                          next_cursor=None):
-    """Converts a list of entities and cursor to ProtoRPC (collection) message.
+  def ProtoStatusCollection(cls, collection_fields=None):
+    """Creates a ProtoRPC message class for the results of a multi method.
 
-    Uses the fields list to create a ProtoRPC (collection) message class and
-    then converts each item into a ProtoRPC message to be set as a list of
-    items.
+    Similar to ProtoCollection, but rather than nextPageToken, the collection
+    has a field statuses. The field items is a repeated ProtoRPC MessageField
+    holding the entities that were written, while statuses is a repeated
+    MessageField holding an ItemStatusMessage for each item, in the same order.
 
-    If the cursor is not null, we convert it to a websafe string and set the
-    nextPageToken field on the result message.
+    As with ProtoCollection, the collection class is cached using the
+    MessageFieldsSchema created from the passed in fields.
 
     Args:
-      items: A list of entities of this model.
-      collection_fields: Optional fields, defaults to None. Passed to
-          ProtoCollection to create a ProtoRPC message class for for the
-          collection of messages.
-      next_cursor: An optional query cursor, defaults to None.
+      collection_fields: Optional fields, defaults to None. If None, the
+          default from the class is used. If specified, will be converted to a
+          MessageFieldsSchema object (and verified as such).
 
     Returns:
-      The ProtoRPC message created using the entities and cursor provided,
-          making sure that the entity message class matches collection_fields.
+      The cached or created ProtoRPC (collection) message class specified by
+          the fields.
     """
-    proto_model = cls.ProtoCollection(collection_fields=collection_fields)
-
-    items_as_message = [item.ToMessage(fields=collection_fields)
-                        for item in items]
-    result = proto_model(items=items_as_message)
+    if collection_fields is None:
+      collection_fields = cls._message_fields_schema
+    message_fields_schema = MessageFieldsSchema.Intern(
+        collection_fields, basename=cls.__name__ + 'Proto')
 
-    if next_cursor is not None:
-      result.nextPageToken = next_cursor.to_websafe_string()
+    if message_fields_schema in cls._proto_status_collections:
+      return cls._proto_status_collections[message_fields_schema]
 
-    return result
+    proto_model = cls.ProtoModel(fields=message_fields_schema)
 
-  @classmethod
-  @utils.positional(1)
-  def method(cls,
+    message_fields = {
+        'items': messages.MessageField(proto_model, 1, repeated=True),
+        'statuses': messages.MessageField(utils.ItemStatusMessage, 2,
+                                          repeated=True),
+        # TODO(dhermes): This behavior should be regulated more directly.
+        #                This is to make sure the schema name in the discovery
+        #                document is message_fields_schema.name
+        #                followed by StatusCollection.
+        '__module__': '',
+    }
+    collection_class = type(message_fields_schema.name + 'StatusCollection',
+                            (messages.Message,),
+                            message_fields)
+    cls._proto_status_collections[message_fields_schema] = collection_class
+    return collection_class
+
+  @classmethod
+  def _ToMessagePlan(cls, proto_model):
+    """Gets the serializer plan for a ProtoRPC message class.
+
+    The plan resolves each message field to its property and its serializer
+    once, so ToMessage need not verify properties or dispatch on property type
+    for every entity it converts. Plans are cached in _to_message_plans.
+
+    Only the fields expanded by ExpandedProtoModel hold the entities their keys
+    refer to, other KeyProperty fields are serialized by their converters even
+    if they map to message fields.
+
+    Args:
+      proto_model: A ProtoRPC message class created by ProtoModel or
+          ExpandedProtoModel.
+
+    Returns:
+      A tuple of (field name, property code name, converter, repeated) tuples,
+          one for each field of the message class. The converter is None if
+          values need no conversion, other than entities being serialized to
+          their messages.
+    """
+    plan = cls._to_message_plans.get(proto_model)
+    if plan is None:
+      expanded_fields = cls._expanded_fields.get(proto_model, ())
+      plan_entries = []
+      for field in proto_model.all_fields():
+        name = field.name
+        value_property = _VerifyProperty(cls, name)
+        if name in expanded_fields:
+          # An expanded key, whose value is the entity it refers to
+          converter = ndb_utils.EntityToMessage
+        else:
+          converter = _ToValueConverter(
+              value_property, registry=cls._property_to_value,
+              custom_registry=cls._custom_property_to_value)
+        plan_entries.append((name, value_property._code_name, converter,
+                             field.repeated))
+      plan = tuple(plan_entries)
+      cls._to_message_plans[proto_model] = plan
+    return plan
+
+  def ToMessage(self, fields=None):
+    """Converts an entity to an ProtoRPC message.
+
+    Uses the fields list passed in to create a ProtoRPC message class and then
+    converts the relevant fields from the entity using the cached serializer
+    plan for that message class.
+
+    Args:
+      fields: Optional fields, defaults to None. Passed to ProtoModel to
+          create a ProtoRPC message class for the message.
+
+    Returns:
+      The ProtoRPC message created using the values from the entity and the
+          fields provided for the message class.
+
+    Raises:
+      TypeError: if a repeated field has a value which is not a tuple or list.
+    """
+    return self._ToMessage(self.ProtoModel(fields=fields))
+
+  def _ToMessage(self, proto_model, batch_values=None):
+    """Converts an entity to an instance of a ProtoRPC message class.
+
+    Args:
+      proto_model: A ProtoRPC message class created by ProtoModel.
+      batch_values: An optional dictionary of property code names to values
+          already computed for this entity by a batch getter. Defaults to None.
+
+    Returns:
+      The ProtoRPC message created using the values from the entity.
+
+    Raises:
+      TypeError: if a repeated field has a value which is not a tuple or list.
+    """
+    proto_args = {}
+    for name, code_name, converter, repeated in self._ToMessagePlan(
+        proto_model):
+      if batch_values is not None and code_name in batch_values:
+        value = batch_values[code_name]
+      else:
+        # Since we are using getattr rather than checking self._values, this
+        # will also work for properties which have a default set
+        value = getattr(self, code_name)
+      if value is None:
+        continue
+
+      if repeated:
+        if not isinstance(value, (list, tuple)):
+          error_msg = ('Property %s is a repeated field and its value should '
+                       'be a list or tuple. Received: %s' % (name, value))
+          raise TypeError(error_msg)
+
+        if converter is not None:
+          value = [converter(element) for element in value]
+        else:
+          value = [_EntityToMessage(element) for element in value]
+      elif converter is not None:
+        value = converter(value)
+      else:
+        value = _EntityToMessage(value)
+      proto_args[name] = value
+
+    return proto_model(**proto_args)
+
+  @classmethod
+  def _FromMessagePlan(cls, message_class):
+    """Gets the deserializer plan for a ProtoRPC message class.
+
+    The plan sorts the message fields by number once, resolves each field to
+    its property and its deserializer and splits NDB properties, which are
+    passed to the class constructor, from alias properties, which must be set
+    after the fact, and from query fields using operators, which are added as
+    filters to the query info. Plans are cached in _from_message_plans.
+
+    Args:
+      message_class: A ProtoRPC message class known to this model.
+
+    Returns:
+      A triple of tuples, for NDB properties, alias properties and query fields
+          using operators. Each contains (field name, target, converter,
+          repeated) tuples ordered by field number. The target is the property
+          code name, except for query fields using operators where it is a pair
+          of the property and the operator. The converter is None if values
+          need no conversion. Fields which are not properties of the class,
+          such as the body of a custom ResourceContainer, have a target of None
+          and are only verified, by _ValuesFromMessage, if they are decoded.
+    """
+    plan = cls._from_message_plans.get(message_class)
+    if plan is None:
+      property_entries = []
+      alias_entries = []
+      filter_entries = []
+      for field in sorted(message_class.all_fields(),
+                          key=lambda field: field.number):
+        name = field.name
+        operator_field = cls._QueryOperatorField(name)
+        if operator_field is not None:
+          converter = _FromValueConverter(
+              operator_field[0], registry=cls._property_from_value,
+              custom_registry=cls._custom_property_from_value)
+          filter_entries.append((name, operator_field, converter,
+                                 field.repeated))
+          continue
+
+        value_property = cls._GetEndpointsProperty(name)
+        if value_property is None:
+          property_entries.append((name, None, None, field.repeated))
+          continue
+
+        converter = _FromValueConverter(
+            value_property, registry=cls._property_from_value,
+            custom_registry=cls._custom_property_from_value)
+        entry = (name, value_property._code_name, converter, field.repeated)
+        if isinstance(value_property, EndpointsAliasProperty):
+          alias_entries.append(entry)
+        else:
+          property_entries.append(entry)
+      plan = (tuple(property_entries), tuple(alias_entries),
+              tuple(filter_entries))
+      cls._from_message_plans[message_class] = plan
+    return plan
+
+  @classmethod
+  def _ValuesFromMessage(cls, message, plan_entries):
+    """Deserializes the values for a group of entries from a deserializer plan.
+
+    Args:
+      message: A ProtoRPC message.
+      plan_entries: A tuple of entries from a plan created by _FromMessagePlan.
+
+    Returns:
+      A list of (target, deserialized value) pairs, one for each field which
+          was decoded from the request and has a non-null value.
+
+    Raises:
+      TypeError: if a repeated field has a value which is not a tuple or list.
+      AttributeError: if a decoded field is not a property of the class.
+    """
+    result = []
+    if not plan_entries:
+      return result
+
+    decoded_fields = message._Message__decoded_fields
+    for name, code_name, converter, repeated in plan_entries:
+      if not name in decoded_fields:
+        continue
+      value = getattr(message, name, None)
+      if value is None:
+        continue
+
+      if code_name is None:
+        # Raises, since the field is not a property of the class
+        _VerifyProperty(cls, name)
+
+      if repeated:
+        if not isinstance(value, (list, tuple)):
+          error_msg = ('Repeated attribute should be a list or tuple. '
+                       'Received a %s.' % (value.__class__.__name__,))
+          raise TypeError(error_msg)
+        if converter is None:
+          value = list(value)
+        else:
+          value = [converter(element) for element in value]
+      elif converter is not None:
+        value = converter(value)
+      result.append((code_name, value))
+    return result
+
+  @classmethod
+  def FromMessage(cls, message):
+    """Converts a ProtoRPC message to an entity of the model class.
+
+    Makes sure the message being converted is an instance of a ProtoRPC message
+    class we have already encountered and then converts the relevant field
+    values to the entity values using the cached deserializer plan for that
+    message class.
+
+    When collecting the values from the message for conversion to an entity, NDB
+    and alias properties are treated differently. The NDB properties can just be
+    passed in to the class constructor as kwargs, but the alias properties must
+    be set after the fact, and may even throw exceptions if the message has
+    fields corresponding to alias properties which don't define a setter.
+
+    Args:
+      message: A ProtoRPC message.
+
+    Returns:
+      The entity of the current class that was created using the
+          message field values.
+
+    Raises:
+      TypeError: if a message class is encountered that has not been stored in
+          the _proto_models cache on the class. This is a precaution against
+          unkown ProtoRPC message classes.
+      TypeError: if a repeated field has a value which is not a tuple or list.
+    """
+    return cls._FromMessage(message)
+
+  @classmethod
+  def _NewFromMessage(cls, message):
+    """Creates an entity of the model class from the NDB property fields.
+
+    Args:
+      message: A ProtoRPC message.
+
+    Returns:
+      A tuple of the entity, the (name, value) pairs of the alias properties to
+          be set on it and the filter entries of the deserializer plan.
+
+    Raises:
+      TypeError: if a message class is encountered that has not been stored in
+          the _proto_models cache on the class.
+      TypeError: if a repeated field has a value which is not a tuple or list.
+    """
+    message_class = message.__class__
+
+    # The CombinedContainer is a result of ResourceContainers.
+    # Might need some better handling...
+    if (message_class not in cls._known_message_classes and
+        message_class.__name__ != "CombinedContainer"):
+      error_msg = ('The message is an instance of %s, which is a class this '
+                   'EndpointsModel does not know how to process.' %
+                   (message_class.__name__))
+      raise TypeError(error_msg)
+
+    property_entries, alias_entries, filter_entries = cls._FromMessagePlan(
+        message_class)
+
+    # Will not throw exception if a required property is not included. This
+    # sort of exception is only thrown when attempting to put the entity.
+    entity = cls(**dict(cls._ValuesFromMessage(message, property_entries)))
+    alias_values = cls._ValuesFromMessage(message, alias_entries)
+    return entity, alias_values, filter_entries
+
+  @classmethod
+  def _AddFiltersFromMessage(cls, entity, message, filter_entries):
+    """Adds the operator filters decoded from a message to the query info.
+
+    Args:
+      entity: The entity created from the message.
+      message: A ProtoRPC message.
+      filter_entries: The filter entries of the deserializer plan.
+    """
+    if filter_entries:
+      query_info = entity._endpoints_query_info
+      for (prop, operator), value in cls._ValuesFromMessage(message,
+                                                            filter_entries):
+        query_info._AddOperatorFilter(prop, operator, value)
+
+  @classmethod
+  def _FromMessage(cls, message):
+    """Converts a ProtoRPC message to an entity of the model class.
+
+    Args:
+      message: A ProtoRPC message.
+
+    Returns:
+      The entity of the current class that was created using the
+          message field values.
+
+    Raises:
+      TypeError: if a message class is encountered that has not been stored in
+          the _proto_models cache on the class.
+      TypeError: if a repeated field has a value which is not a tuple or list.
+    """
+    entity, alias_values, filter_entries = cls._NewFromMessage(message)
+
+    # Set alias properties, will fail on an alias property if that
+    # property was not defined with a setter
+    for name, value in alias_values:
+      setattr(entity, name, value)
+
+    cls._AddFiltersFromMessage(entity, message, filter_entries)
+    return entity
+
+  @classmethod
+  @ndb.tasklet
+  def _FromMessageAsync(cls, message):
+    """Converts a ProtoRPC message to an entity, deferring UpdateFromKey gets.
+
+    The gets issued by UpdateFromKey (from alias setters such as id) are
+    deferred as if _defer_update_from_key were set on the class, and each one is
+    waited on and merged before the next alias property is set, so later
+    setters see the merged values. NDB batches the gets of conversions run
+    together, so the entities of a collection are retrieved in a single batch.
+
+    Args:
+      message: A ProtoRPC message.
+
+    Returns:
+      An NDB future whose result is the entity of the current class that was
+          created using the message field values.
+
+    Raises:
+      TypeError: if a message class is encountered that has not been stored in
+          the _proto_models cache on the class.
+      TypeError: if a repeated field has a value which is not a tuple or list.
+    """
+    entity, alias_values, filter_entries = cls._NewFromMessage(message)
+
+    entity._deferring_update = True
+    try:
+      for name, value in alias_values:
+        setattr(entity, name, value)
+        if entity._pending_update is not None:
+          yield cls._MergePendingUpdatesAsync([entity])
+    finally:
+      entity._deferring_update = False
+
+    cls._AddFiltersFromMessage(entity, message, filter_entries)
+    raise ndb.Return(entity)
+
+  @classmethod
+  @ndb.tasklet
+  def _ExpandedValuesAsync(cls, items, expand):
+    """Gets the entities referred to by expanded keys with a single get.
+
+    Args:
+      items: A list of entities of this model.
+      expand: A list or tuple of the names of KeyProperty fields to be expanded.
+
+    Returns:
+      An NDB future for a list of dictionaries, one for each entity, of
+          property code names to the entity (or list of entities) referred to
+          by the value of the property.
+    """
+    code_names = [cls._properties[name]._code_name for name in expand]
+
+    keys = set()
+    for item in items:
+      for code_name in code_names:
+        value = getattr(item, code_name)
+        if isinstance(value, (list, tuple)):
+          keys.update(value)
+        elif value is not None:
+          keys.add(value)
+
+    keys = list(keys)
+    entities = []
+    if keys:
+      entities = yield ndb.get_multi_async(keys)
+    entities_by_key = dict(itertools.izip(keys, entities))
+
+    result = []
+    for item in items:
+      item_values = {}
+      for code_name in code_names:
+        value = getattr(item, code_name)
+        if isinstance(value, (list, tuple)):
+          # Keys with no entity are left out
+          item_values[code_name] = [entities_by_key[key] for key in value
+                                    if entities_by_key[key] is not None]
+        elif value is not None:
+          item_values[code_name] = entities_by_key[value]
+      result.append(item_values)
+    raise ndb.Return(result)
+
+  @classmethod
+  @ndb.tasklet
+  def _ItemsToMessagesAsync(cls, items, collection_fields=None, expand=()):
+    """Converts a list of entities to ProtoRPC messages for a collection.
+
+    Alias properties in the message which have a batch getter are computed for
+    all the entities at once, rather than once per entity. Similarly, the
+    entities referred to by expanded keys are retrieved with a single get.
+
+    Args:
+      items: A list of entities of this model.
+      collection_fields: Optional fields, defaults to None. Passed to
+          ExpandedProtoModel to create a ProtoRPC message class for each item.
+      expand: An optional list or tuple of the names of KeyProperty fields to
+          be expanded. Defaults to an empty tuple.
+
+    Returns:
+      An NDB future for a list of ProtoRPC messages, one for each entity.
+    """
+    item_model = cls.ExpandedProtoModel(fields=collection_fields,
+                                        expand=expand)
+    items = list(items)
+    if not items:
+      raise ndb.Return([])
+
+    # Issue the get first so it overlaps with any batch getters
+    expanded_future = None
+    if expand:
+      expanded_future = cls._ExpandedValuesAsync(items, expand)
+
+    batch_values = [{} for _ in items]
+    for name, code_name, _, _ in cls._ToMessagePlan(item_model):
+      prop = cls._alias_properties.get(name)
+      if prop is None or prop._batch_getter is None:
+        continue
+
+      values = prop.GetBatchValues(cls, items)
+      for item_values, value in itertools.izip(batch_values, values):
+        item_values[code_name] = value
+
+    if expanded_future is not None:
+      expanded = yield expanded_future
+      for item_values, expanded_values in itertools.izip(batch_values,
+                                                         expanded):
+        item_values.update(expanded_values)
+
+    raise ndb.Return([
+        item._ToMessage(item_model, batch_values=item_values or None)
+        for item, item_values in itertools.izip(items, batch_values)])
+
+  @classmethod
+  def _ItemsToMessages(cls, items, collection_fields=None, expand=()):
+    """Converts a list of entities to ProtoRPC messages for a collection.
+
+    Args:
+      items: A list of entities of this model.
+      collection_fields: Optional fields, defaults to None. Passed to
+          _ItemsToMessagesAsync.
+      expand: An optional list or tuple of the names of KeyProperty fields to
+          be expanded. Defaults to an empty tuple.
+
+    Returns:
+      A list of ProtoRPC messages, one for each entity.
+    """
+    return cls._ItemsToMessagesAsync(items, collection_fields=collection_fields,
+                                     expand=expand).get_result()
+
+  @classmethod
+  def ToMessageCollection(cls, items, collection_fields=None,
+                          next_cursor=None, expand=()):
+    """Converts a list of entities and cursor to ProtoRPC (collection) message.
+
+    Uses the fields list to create a ProtoRPC (collection) message class and
+    then converts each item into a ProtoRPC message to be set as a list of
+    items.
+
+    If the cursor is not null, we convert it to a page token, using the
+    _page_token_codec set on the class if any, and set the nextPageToken field
+    on the result message.
+
+    Args:
+      items: A list of entities of this model.
+      collection_fields: Optional fields, defaults to None. Passed to
+          ProtoCollection to create a ProtoRPC message class for for the
+          collection of messages.
+      next_cursor: An optional query cursor, defaults to None.
+      expand: An optional list or tuple of the names of KeyProperty fields to
+          be expanded. Defaults to an empty tuple.
+
+    Returns:
+      The ProtoRPC message created using the entities and cursor provided,
+          making sure that the entity message class matches collection_fields.
+    """
+    proto_model = cls.ExpandedProtoCollection(
+        collection_fields=collection_fields, expand=expand)
+
+    items_as_message = cls._ItemsToMessages(items, collection_fields,
+                                            expand=expand)
+    result = proto_model(items=items_as_message)
+
+    if next_cursor is not None:
+      result.nextPageToken = cls._EncodePageToken(next_cursor)
+
+    return result
+
+  @classmethod
+  def _KeysOnlyForFields(cls, collection_fields):
+    """Decides whether a keys-only query can serve the collection fields.
+
+    Args:
+      collection_fields: The collection fields of a query method, or None for
+          the default fields.
+
+    Returns:
+      Boolean indicating whether or not every collection field is an alias
+          property computed from the key alone.
+    """
+    if collection_fields is None:
+      collection_fields = cls._message_fields_schema
+    collection_fields = MessageFieldsSchema.Intern(
+        collection_fields, basename=cls.__name__ + 'Proto')
+
+    if not list(collection_fields):
+      return False
+    for name in collection_fields:
+      alias_prop = cls._alias_properties.get(name)
+      if alias_prop is None or not alias_prop._key_derived:
+        return False
+    return True
+
+  @classmethod
+  def _ProjectionForFields(cls, collection_fields, query_fields=()):
+    """Decides whether a projection query can serve the collection fields.
+
+    A projection query is safe if every collection field is either an indexed,
+    non-repeated NDB property whose value can be read back from a projection,
+    or an alias property computed from the key alone. Since the datastore
+    doesn't allow projecting properties filtered by equality, none of the
+    projected properties may be query fields.
+
+    Args:
+      collection_fields: The collection fields of a query method, or None for
+          the default fields.
+      query_fields: The query fields of a query method. Defaults to an empty
+          tuple.
+
+    Returns:
+      A pair of the list of property names to project (or None if a projection
+          query is not safe) and a string describing the decision.
+    """
+    if collection_fields is None:
+      collection_fields = cls._message_fields_schema
+    collection_fields = MessageFieldsSchema.Intern(
+        collection_fields, basename=cls.__name__ + 'Proto')
+    query_fields = MessageFieldsSchema.Intern(
+        query_fields, basename=cls.__name__ + 'Proto')
+    equality_fields = set()
+    for name in query_fields:
+      operator_field = cls._QueryOperatorField(name)
+      if operator_field is None:
+        equality_fields.add(name)
+      elif operator_field[1] == QUERY_OPERATOR_IN:
+        equality_fields.add(operator_field[0]._name)
+
+    projection = []
+    for name in collection_fields:
+      prop = cls._properties.get(name)
+      if prop is None:
+        alias_prop = cls._alias_properties.get(name)
+        if alias_prop is None or not alias_prop._key_derived:
+          return None, 'field %s is not derived from the key' % (name,)
+        continue
+
+      if isinstance(prop, PROJECTION_UNSAFE_PROPERTIES):
+        return None, 'field %s is a %s' % (name, prop.__class__.__name__)
+      if not prop._indexed:
+        return None, 'field %s is not indexed' % (name,)
+      if prop._repeated:
+        return None, 'field %s is repeated' % (name,)
+      if name in equality_fields:
+        return None, 'field %s may be filtered by equality' % (name,)
+      projection.append(name)
+
+    if not projection:
+      return None, 'no fields are NDB properties'
+    return projection, 'projecting %s' % (', '.join(projection),)
+
+  @classmethod
+  @ndb.tasklet
+  def _FetchBranchAsync(cls, query, limit, start_cursor, query_options):
+    """Fetches results from one branch of a disjunctive query.
+
+    Args:
+      query: The NDB query for the branch.
+      limit: The number of results to fetch.
+      start_cursor: The cursor to start from, None to start from the beginning
+          or _BRANCH_EXHAUSTED if the branch has no more results.
+      query_options: A dictionary of query options, other than start_cursor.
+
+    Returns:
+      An NDB future for a list of (result, cursor after the result) pairs.
+    """
+    results = []
+    if start_cursor is _BRANCH_EXHAUSTED:
+      raise ndb.Return(results)
+
+    def CollectResult(batch, index, result):
+      results.append((result, batch.cursor(index + 1)))
+
+    yield query.map_async(CollectResult, limit=limit, start_cursor=start_cursor,
+                          produce_cursors=True, pass_batch_into_callback=True,
+                          **query_options)
+    raise ndb.Return(results)
+
+  @classmethod
+  @ndb.tasklet
+  def _FetchPageFanOutAsync(cls, query, limit, start_cursor, query_options):
+    """Fetches a page of a disjunctive query, one query per branch at once.
+
+    Rather than letting NDB run the branches of an IN or OR query one after
+    another, each branch is fetched concurrently. The results are merge sorted
+    by the order of the query (and then by key, as the datastore does), and
+    results matching several branches are only returned once. The position in
+    each branch is kept in a _BranchCursors for the next page. The query must
+    not be ordered by a repeated property, since the value of the property
+    the datastore sorts by depends on the filters of each branch.
+
+    Args:
+      query: An NDB query whose filters are an ndb.DisjunctionNode.
+      limit: The number of items to fetch.
+      start_cursor: A _BranchCursors from a previous page, or None.
+      query_options: A dictionary of query options, other than start_cursor.
+
+    Returns:
+      An NDB future for a triple of the items, a _BranchCursors for the next
+          page and a boolean indicating whether or not there are more results.
+
+    Raises:
+      endpoints.BadRequestException: if start_cursor does not match the
+          branches of the query.
+    """
+    branches = list(query.filters)
+    if start_cursor is None:
+      start_cursors = [None] * len(branches)
+    elif (isinstance(start_cursor, _BranchCursors) and
+          len(start_cursor.cursors) == len(branches)):
+      start_cursors = list(start_cursor.cursors)
+    else:
+      raise endpoints.BadRequestException(COMPOSITE_PAGE_TOKEN_MISMATCH)
+
+    # One more than the limit, so a branch which returns no more than the
+    # limit is known to be exhausted
+    branch_results = yield [
+        cls._FetchBranchAsync(_BranchQuery(query, branch), limit + 1,
+                              branch_cursor, query_options)
+        for branch, branch_cursor in itertools.izip(branches, start_cursors)]
+
+    merged = []
+    for index, results in enumerate(branch_results):
+      merged.extend((result, cursor, index) for result, cursor in results)
+    compare = _ResultComparator(_OrderSpec(query))
+    merged.sort(cmp=lambda lhs, rhs: compare(lhs[0], rhs[0]))
+
+    items = []
+    seen_keys = set()
+    next_cursors = start_cursors
+    consumed = [0] * len(branches)
+    for result, cursor, index in merged:
+      key = _ResultKey(result)
+      if key not in seen_keys:
+        if len(items) == limit:
+          break
+        items.append(result)
+        seen_keys.add(key)
+      # Duplicates directly after the page are consumed, so the next page
+      # doesn't start with them
+      consumed[index] += 1
+      next_cursors[index] = cursor
+
+    for index, results in enumerate(branch_results):
+      if consumed[index] == len(results) and len(results) <= limit:
+        next_cursors[index] = _BRANCH_EXHAUSTED
+
+    more_results = any(cursor is not _BRANCH_EXHAUSTED
+                       for cursor in next_cursors)
+    raise ndb.Return((items, _BranchCursors(next_cursors), more_results))
+
+  @classmethod
+  @ndb.tasklet
+  def _FetchPageInBatchesAsync(cls, query, limit, batch_size,
+                               collection_fields=None, query_options=None,
+                               expand=()):
+    """Fetches a page of query results, converting them one batch at a time.
+
+    The query is iterated with the given batch size and each batch of entities
+    is converted to messages before the next one is taken from the iterator,
+    so the entities of a batch can be freed once it is converted. Alias
+    property batch getters and expanded keys are resolved once per batch. The
+    messages of the whole page are still returned together, since the response
+    is encoded at once.
+
+    Args:
+      query: An NDB query for the current class.
+      limit: The number of items to fetch.
+      batch_size: A positive integer; the number of entities fetched from the
+          datastore and converted to messages at a time.
+      collection_fields: Optional fields, defaults to None. Passed to
+          _ItemsToMessages to create the item messages.
+      query_options: An optional dictionary of query options, passed to
+          iter.
+      expand: An optional list or tuple of the names of KeyProperty fields to
+          be expanded. Defaults to an empty tuple.
+
+    Returns:
+      An NDB future for a tuple of the list of item messages, the cursor after
+          the last item and a boolean indicating whether there are probably
+          more results, as returned by fetch_page_async.
+    """
+    query_options = query_options or {}
+    keys_only = query_options.get('keys_only')
+    # One more than the limit is allowed, as in fetch_page_async, to find out
+    # whether there are more results
+    iterator = query.iter(limit=limit + 1, batch_size=batch_size,
+                          produce_cursors=True, **query_options)
+
+    item_messages = []
+    batch = []
+    count = 0
+    while count < limit and (yield iterator.has_next_async()):
+      result = iterator.next()
+      count += 1
+      batch.append(cls(key=result) if keys_only else result)
+      if len(batch) == batch_size:
+        item_messages.extend((yield cls._ItemsToMessagesAsync(
+            batch, collection_fields=collection_fields, expand=expand)))
+        batch = []
+    if batch:
+      item_messages.extend((yield cls._ItemsToMessagesAsync(
+          batch, collection_fields=collection_fields, expand=expand)))
+
+    try:
+      next_cursor = iterator.cursor_after()
+    except datastore_errors.BadArgumentError:
+      next_cursor = None
+    more_results = bool(count) and (yield iterator.probably_has_next_async())
+    raise ndb.Return((item_messages, next_cursor, more_results))
+
+  @classmethod
+  @ndb.tasklet
+  def _FetchCollectionAsync(cls, query, limit, collection_fields=None,
+                            query_options=None, expand=(), batch_size=None):
+    """Fetches a page of query results from the datastore as a message.
+
+    Queries with IN or OR filters are fetched by _FetchPageFanOutAsync, and
+    the cursor of the resulting page is a composite page token, unless they are
+    ordered by a repeated property. Otherwise, if a batch size is given, the
+    page is fetched by _FetchPageInBatchesAsync.
+
+    Args:
+      query: An NDB query for the current class.
+      limit: The number of items to fetch.
+      collection_fields: Optional fields, defaults to None. Passed to
+          ToMessageCollection to create the collection message.
+      query_options: An optional dictionary of query options, passed to
+          fetch_page_async.
+      expand: An optional list or tuple of the names of KeyProperty fields to
+          be expanded. Defaults to an empty tuple.
+      batch_size: An optional positive integer, defaults to None. The number of
+          entities fetched and converted to messages at a time.
+
+    Returns:
+      An NDB future for the ProtoRPC (collection) message containing the page
+          of results and the cursor if there are more results and a cursor was
+          returned.
+
+    Raises:
+      endpoints.BadRequestException: if the start cursor is a composite page
+          token which does not match the query.
+    """
+    query_options = query_options or {}
+    start_cursor = query_options.get('start_cursor')
+    fetch_options = dict(query_options)
+    keys_only = fetch_options.get('keys_only')
+
+    fan_out = False
+    if isinstance(query.filters, ndb.DisjunctionNode):
+      inequality_name = _InequalityFilterName(query.filters)
+      if query.orders is None and inequality_name is not None:
+        # The key can only be ordered by after the inequality property
+        query = query.order(cls._properties.get(
+            inequality_name, ndb.GenericProperty(inequality_name)))
+      order_spec = _OrderSpec(query)
+      if keys_only and any(name != '__key__' for name, _ in order_spec):
+        # Results can only be sorted by their other orders if they are
+        # entities, so entities are fetched and keyed afterwards
+        del fetch_options['keys_only']
+
+      # The datastore sorts by one of the values of a repeated property, chosen
+      # using the filters on the property, which merging the branches can't
+      # reproduce. NDB merges them itself, but only resumes from a cursor if
+      # the results are also ordered by key.
+      fan_out = not any(getattr(cls._properties.get(name), '_repeated', False)
+                        for name, _ in order_spec)
+      if not fan_out and (not order_spec or order_spec[-1][0] != '__key__'):
+        query = query.order(cls._key)
+
+    item_messages = None
+    if fan_out:
+      fetch_options.pop('start_cursor', None)
+      items, next_cursor, more_results = yield cls._FetchPageFanOutAsync(
+          query, limit, start_cursor, fetch_options)
+    elif isinstance(start_cursor, _BranchCursors):
+      raise endpoints.BadRequestException(COMPOSITE_PAGE_TOKEN_MISMATCH)
+    elif batch_size is not None:
+      item_messages, next_cursor, more_results = (
+          yield cls._FetchPageInBatchesAsync(
+              query, limit, batch_size, collection_fields=collection_fields,
+              query_options=fetch_options, expand=expand))
+    else:
+      items, next_cursor, more_results = yield query.fetch_page_async(
+          limit, **fetch_options)
+
+    # Don't pass a cursor if there are no more results
+    if not more_results:
+      next_cursor = None
+
+    if item_messages is None:
+      if keys_only:
+        # The collection fields only need the key of each entity
+        items = [cls(key=_ResultKey(item)) for item in items]
+      result = cls.ToMessageCollection(
+          items, collection_fields=collection_fields, next_cursor=next_cursor,
+          expand=expand)
+    else:
+      result = cls.ExpandedProtoCollection(
+          collection_fields=collection_fields, expand=expand)(
+              items=item_messages)
+      if next_cursor is not None:
+        result.nextPageToken = cls._EncodePageToken(next_cursor)
+    raise ndb.Return(result)
+
+  @classmethod
+  def _PrefetchNextPage(cls, query, limit, page_token, collection_class,
+                        collection_fields=None, query_options=None,
+                        expand=(), batch_size=None):
+    """Starts prefetching the page after the current one into _page_prefetcher.
+
+    The page is fetched by _FetchCollectionAsync in a thread started by the
+    prefetcher, so the current request does not wait for it.
+
+    Args:
+      query: An NDB query for the current class.
+      limit: The number of items to fetch.
+      page_token: The next page token of the current page.
+      collection_class: The ProtoRPC message class of the pages.
+      collection_fields: Optional fields, defaults to None. Passed to
+          _FetchCollectionAsync.
+      query_options: An optional dictionary of query options, the start cursor
+          of which is replaced with the cursor of the next page.
+      expand: An optional list or tuple of the names of KeyProperty fields to
+          be expanded. Defaults to an empty tuple.
+      batch_size: An optional positive integer, defaults to None. Passed to
+          _FetchCollectionAsync.
+
+    Returns:
+      The thread fetching the page, or None if the prefetch was not started.
+    """
+    next_options = dict(query_options or {})
+    next_options['start_cursor'] = cls._DecodePageToken(page_token)
+    cache_key = _QueryCacheKey(query, limit, next_options, collection_class)
+
+    def FetchNextPageAsync():
+      """Starts fetching the next page."""
+      return cls._FetchCollectionAsync(
+          query, limit, collection_fields=collection_fields,
+          query_options=next_options, expand=expand, batch_size=batch_size)
+
+    return cls._page_prefetcher.Prefetch(query.kind, cache_key,
+                                         FetchNextPageAsync)
+
+  @classmethod
+  @ndb.tasklet
+  def _QueryCollectionAsync(cls, query, limit, collection_fields=None,
+                            query_options=None, expand=(),
+                            cache_results=False, batch_size=None,
+                            prefetch=False):
+    """Gets a page of query results as a ProtoRPC (collection) message.
+
+    The page is looked up in _query_result_cache and then in _page_prefetcher,
+    if enabled, before being fetched by _FetchCollectionAsync. If prefetching
+    and the page did not come from _query_result_cache, the next page is then
+    prefetched in the background. A projection in query_options is dropped if
+    the query filters one of the projected properties by equality.
+
+    Args:
+      query: An NDB query for the current class, or an NDB future which will
+          produce one.
+      limit: The number of items to fetch.
+      collection_fields: Optional fields, defaults to None. Passed to
+          ToMessageCollection to create the collection message.
+      query_options: An optional dictionary of query options, passed to
+          fetch_page_async.
+      expand: An optional list or tuple of the names of KeyProperty fields to
+          be expanded. Defaults to an empty tuple.
+      cache_results: An optional boolean, defaults to False. If True, the
+          message is looked up in and stored in _query_result_cache.
+      batch_size: An optional positive integer, defaults to None. The number of
+          entities fetched and converted to messages at a time.
+      prefetch: An optional boolean, defaults to False. If True, the message is
+          looked up in _page_prefetcher and the next page is prefetched. Must
+          only be set along with cache_results.
+
+    Returns:
+      An NDB future for the ProtoRPC (collection) message containing the page
+          of results and the cursor if there are more results and a cursor was
+          returned.
+
+    Raises:
+      endpoints.BadRequestException: if the start cursor is a composite page
+          token which does not match the query.
+    """
+    if isinstance(query, ndb.Future):
+      query = yield query
+    query_options = query_options or {}
+
+    projection = query_options.get('projection')
+    if projection and _ProjectionForQuery(query, projection) is None:
+      query_options = dict(query_options)
+      del query_options['projection']
+
+    if cache_results or prefetch:
+      collection_class = cls.ExpandedProtoCollection(
+          collection_fields=collection_fields, expand=expand)
+      cache_key = _QueryCacheKey(query, limit, query_options, collection_class)
+
+    result = None
+    if cache_results:
+      result_cache = cls._query_result_cache
+      generation = result_cache.Generation(query.kind)
+      result = result_cache.Get(query.kind, cache_key, collection_class)
+      # Pages served from the result cache don't prefetch the next page
+      prefetch = prefetch and result is None
+    if result is None and prefetch:
+      result = cls._page_prefetcher.Get(query.kind, cache_key,
+                                        collection_class)
+
+    if result is None:
+      result = yield cls._FetchCollectionAsync(
+          query, limit, collection_fields=collection_fields,
+          query_options=query_options, expand=expand, batch_size=batch_size)
+      if cache_results:
+        result_cache.Set(query.kind, cache_key, result, generation)
+
+    if prefetch and result.nextPageToken is not None:
+      cls._PrefetchNextPage(
+          query, limit, result.nextPageToken, collection_class,
+          collection_fields=collection_fields, query_options=query_options,
+          expand=expand, batch_size=batch_size)
+    raise ndb.Return(result)
+
+  @classmethod
+  @ndb.tasklet
+  def _CountAsync(cls, query, limit, exists_only=False, cache_results=False):
+    """Counts the results of a query, or checks whether there are any.
+
+    Counting uses count_async, which only reads keys. Checking existence uses
+    a keys-only get, which reads at most one key.
+
+    Args:
+      query: An NDB query for the current class, or an NDB future which will
+          produce one.
+      limit: The maximum number of results to count.
+      exists_only: An optional boolean, defaults to False. If True, only
+          whether or not there are any results is checked.
+      cache_results: An optional boolean, defaults to False. If True, the
+          message is looked up in and stored in _query_count_cache.
+
+    Returns:
+      An NDB future for a utils.ExistsMessage if exists_only is True, else for
+          a utils.CountMessage.
+    """
+    if isinstance(query, ndb.Future):
+      query = yield query
+
+    message_class = utils.ExistsMessage if exists_only else utils.CountMessage
+    if cache_results:
+      count_cache = cls._query_count_cache
+      cache_key = _QueryCacheKey(query, limit, {}, message_class)
+      generation = count_cache.Generation(query.kind)
+      result = count_cache.Get(query.kind, cache_key, message_class)
+      if result is not None:
+        raise ndb.Return(result)
+
+    if exists_only:
+      key = yield query.get_async(keys_only=True)
+      result = utils.ExistsMessage(exists=key is not None)
+    else:
+      # Count one more than the limit to find out whether it was reached
+      count = yield query.count_async(limit=limit + 1)
+      result = utils.CountMessage(count=min(count, limit),
+                                  capped=count > limit)
+
+    if cache_results:
+      count_cache.Set(query.kind, cache_key, result, generation)
+    raise ndb.Return(result)
+
+  @classmethod
+  @ndb.tasklet
+  def _AggregateAsync(cls, query, group_by=(), aggregates=(), projection=None,
+                      batch_size=QUERY_BATCH_SIZE_DEFAULT,
+                      max_groups=AGGREGATE_GROUPS_MAX, cache_results=False):
+    """Computes aggregates over the results of a query, grouped by properties.
+
+    The query is iterated in batches and each result is added to the running
+    totals of its group and then dropped, so memory holds one batch of results
+    and the totals of each group.
+
+    Args:
+      query: An NDB query for the current class, or an NDB future which will
+          produce one.
+      group_by: An optional list or tuple of the names of the NDB properties
+          the results are grouped by. Defaults to an empty tuple.
+      aggregates: An optional list or tuple of aggregate names, as accepted by
+          AggregateCollection. Defaults to an empty tuple.
+      projection: An optional list of property names to project, which must
+          include the group_by and aggregated properties. Defaults to None, in
+          which case whole entities are fetched. Dropped if the query filters
+          one of them by equality.
+      batch_size: An optional positive integer, defaults to
+          QUERY_BATCH_SIZE_DEFAULT. The number of results fetched at a time.
+      max_groups: An optional positive integer, defaults to
+          AGGREGATE_GROUPS_MAX. The maximum number of groups.
+      cache_results: An optional boolean, defaults to False. If True, the
+          message is looked up in and stored in _query_result_cache.
+
+    Returns:
+      An NDB future for the message created by AggregateCollection, with the
+          groups in the order their first results were found.
+
+    Raises:
+      AggregateGroupsExceededError: if the results have more than max_groups
+          groups.
+    """
+    if isinstance(query, ndb.Future):
+      query = yield query
+    projection = _ProjectionForQuery(query, projection)
+
+    collection_class = cls.AggregateCollection(group_by=group_by,
+                                               aggregates=aggregates)
+    if cache_results:
+      result_cache = cls._query_result_cache
+      cache_key = _QueryCacheKey(query, None, {'projection': projection},
+                                 collection_class)
+      generation = result_cache.Generation(query.kind)
+      result = result_cache.Get(query.kind, cache_key, collection_class)
+      if result is not None:
+        raise ndb.Return(result)
+
+    group_properties = [cls._properties[name] for name in group_by]
+    functions = [(aggregate,) + cls._AggregateProperty(aggregate)[:2]
+                 for aggregate in aggregates]
+    query_options = {}
+    if projection is not None:
+      query_options['projection'] = projection
+    iterator = query.iter(batch_size=batch_size, **query_options)
+
+    # The count and the aggregate values of each group
+    totals = collections.OrderedDict()
+    while (yield iterator.has_next_async()):
+      entity = iterator.next()
+      group = tuple(prop._get_value(entity) for prop in group_properties)
+      group_totals = totals.get(group)
+      if group_totals is None:
+        if len(totals) >= max_groups:
+          raise AggregateGroupsExceededError(
+              AGGREGATE_GROUPS_EXCEEDED_TEMPLATE % (max_groups,))
+        group_totals = totals[group] = [0] + [None] * len(functions)
+      group_totals[0] += 1
+
+      for index, (_, prop, function) in enumerate(functions, 1):
+        value = prop._get_value(entity)
+        if value is None:
+          continue
+        total = group_totals[index]
+        if total is None:
+          group_totals[index] = value
+        elif function == 'sum':
+          group_totals[index] = total + value
+        elif function == 'min':
+          group_totals[index] = min(total, value)
+        else:
+          group_totals[index] = max(total, value)
+
+    group_class = collection_class.items.type
+    items = []
+    for group, group_totals in totals.iteritems():
+      group_message = group_class(count=group_totals[0])
+      if group_by:
+        group_entity = cls()
+        for prop, value in zip(group_properties, group):
+          prop._set_value(group_entity, value)
+        group_message.group = group_entity.ToMessage(fields=group_by)
+      for (aggregate, _, _), total in zip(functions, group_totals[1:]):
+        setattr(group_message, aggregate, total)
+      items.append(group_message)
+
+    result = collection_class(items=items)
+    if cache_results:
+      result_cache.Set(query.kind, cache_key, result, generation)
+    raise ndb.Return(result)
+
+  @classmethod
+  def _WriteMulti(cls, entities, operation, batch_size=MULTI_BATCH_SIZE):
+    """Writes or deletes a list of entities in concurrent batches.
+
+    Entities which can't be written are skipped: for updates and deletes, this
+    is any entity without a key or which was not retrieved from the datastore.
+    All batches are started before any is waited on.
+
+    Args:
+      entities: A list of entities of this model.
+      operation: One of MULTI_INSERT, MULTI_UPDATE or MULTI_DELETE.
+      batch_size: An optional positive integer, defaults to MULTI_BATCH_SIZE.
+          The maximum number of entities sent in a single put or delete call.
+
+    Returns:
+      A list containing an error string for each entity which failed and None
+          for each entity which succeeded, in the same order as entities.
+    """
+    errors = [None] * len(entities)
+    to_write = []
+    for index, entity in enumerate(entities):
+      if operation != MULTI_INSERT:
+        if entity.key is None:
+          errors[index] = MULTI_NO_KEY_ERROR
+          continue
+        if not entity.from_datastore:
+          errors[index] = MULTI_NOT_FOUND_ERROR
+          continue
+      to_write.append(index)
+
+    futures = []
+    for start in xrange(0, len(to_write), batch_size):
+      batch = to_write[start:start + batch_size]
+      if operation == MULTI_DELETE:
+        batch_futures = ndb.delete_multi_async(
+            [entities[index].key for index in batch])
+      else:
+        batch_futures = ndb.put_multi_async(
+            [entities[index] for index in batch])
+      futures.extend(zip(batch, batch_futures))
+
+    for index, future in futures:
+      exception = future.get_exception()
+      if exception is not None:
+        errors[index] = '%s: %s' % (exception.__class__.__name__, exception)
+
+    return errors
+
+  @classmethod
+  def ToMessageStatusCollection(cls, items, errors, collection_fields=None):
+    """Converts a list of entities and errors to a ProtoRPC (collection) message.
+
+    The index of each status is the position of the item in the request, for
+    entities created by multi_method, and is unset for other entities.
+
+    Args:
+      items: A list of entities of this model.
+      errors: A list of the same length as items, containing an error string for
+          each item which failed and None for each item which succeeded.
+      collection_fields: Optional fields, defaults to None. Passed to
+          ProtoStatusCollection to create a ProtoRPC message class for the
+          collection of messages.
+
+    Returns:
+      The ProtoRPC message created using the entities and errors provided,
+          making sure that the entity message class matches collection_fields.
+    """
+    proto_model = cls.ProtoStatusCollection(collection_fields=collection_fields)
+
+    items_as_message = cls._ItemsToMessages(items, collection_fields)
+    statuses = [utils.ItemStatusMessage(index=item._request_index,
+                                        success=error is None, error=error)
+                for item, error in zip(items, errors)]
+    return proto_model(items=items_as_message, statuses=statuses)
+
+  @classmethod
+  @utils.positional(1)
+  def method(cls,
              request_fields=None,
              response_fields=None,
              user_required=False,
+             expand=(),
              **kwargs):
     """Creates an API method decorator using provided metadata.
 
@@ -1313,6 +3570,11 @@ class EndpointsModel(ndb.Model):
     convert the object (returned by the decorated method) in the opposite
     direction.
 
+    The decorated method may also be an NDB tasklet (or a generator function,
+    which will be wrapped as one) or return an NDB future. The result is waited
+    on before it is converted, so the decorated method can issue several RPCs in
+    parallel and still return an entity.
+
     NOTE: Using utils.positional(1), we ensure the class instance will be the
     only positional argument hence won't have leaking/collision between the
     endpoints.method decorator function that we mean to pass metadata to.
@@ -1326,6 +3588,10 @@ class EndpointsModel(ndb.Model):
           message class. Defaults to None.
       user_required: Boolean; indicates whether or not a user is required on any
           incoming request.
+      expand: An (optional) list or tuple of the names of KeyProperty fields in
+          the response fields. Rather than a urlsafe key, the response contains
+          the message of the entity the key refers to. Defaults to an empty
+          tuple.
 
     Returns:
       A decorator that takes the metadata passed in and augments an API method.
@@ -1333,6 +3599,7 @@ class EndpointsModel(ndb.Model):
     Raises:
       TypeError: if there is a collision (either request or response) of
           field list and custom message definition.
+      TypeError: if expand is used with a custom response message class.
     """
     request_message = kwargs.get(REQUEST_MESSAGE)
     if request_fields is not None and request_message is not None:
@@ -1357,8 +3624,12 @@ class EndpointsModel(ndb.Model):
     if response_fields is not None and response_message is not None:
       raise TypeError('Received both a response message class and a field list '
                       'for creating a response message class.')
+    if expand and response_message is not None:
+      raise TypeError('Fields can only be expanded in a response message class '
+                      'created from a field list.')
     if response_message is None:
-      kwargs[RESPONSE_MESSAGE] = cls.ProtoModel(fields=response_fields)
+      kwargs[RESPONSE_MESSAGE] = cls.ExpandedProtoModel(fields=response_fields,
+                                                        expand=expand)
 
     apiserving_method_decorator = endpoints.method(**kwargs)
 
@@ -1379,6 +3650,8 @@ class EndpointsModel(ndb.Model):
             back to a ProtoRPC message.
       """
 
+      entity_api_method = _AsTasklet(api_method)
+
       @functools.wraps(api_method)
       def EntityToRequestMethod(service_instance, request):
         """Stub method to be decorated.
@@ -1411,7 +3684,9 @@ class EndpointsModel(ndb.Model):
         # class for them, their method should expect to receive an instance of
         # the current EndpointsModel class, and if it fails for some reason
         # their API users will receive a 503 from an uncaught exception.
-        response = api_method(service_instance, request)
+        response = entity_api_method(service_instance, request)
+        if isinstance(response, ndb.Future):
+          response = response.get_result()
 
         if response_message is None:
           # If developers using a custom request message class with
@@ -1419,7 +3694,11 @@ class EndpointsModel(ndb.Model):
           # up to them to return an instance of the current EndpointsModel
           # class. If not, their API users will receive a 503 from an uncaught
           # exception.
-          response = response.ToMessage(fields=response_fields)
+          if expand:
+            response = response._ItemsToMessages(
+                [response], response_fields, expand=expand)[0]
+          else:
+            response = response.ToMessage(fields=response_fields)
 
         return response
 
@@ -1436,6 +3715,10 @@ class EndpointsModel(ndb.Model):
                    limit_max=QUERY_LIMIT_MAX,
                    user_required=False,
                    use_projection=False,
+                   expand=(),
+                   cache_results=False,
+                   batch_size=None,
+                   prefetch_next_page=False,
                    **kwargs):
     """Creates an API query method decorator using provided metadata.
 
@@ -1473,6 +3756,15 @@ class EndpointsModel(ndb.Model):
       pageToken: allows a websafe string value to be converted to a cursor and
           set on the query info of the deserialized entity.
 
+    Query fields may also filter an NDB property using an operator, by adding
+    one of the suffixes __lt, __lte, __gt, __gte or __in to the property name.
+    For example, created__gte filters for entities created at or after a time
+    and score__in (a repeated field) for entities with one of several scores.
+    As in the datastore, only one property can have inequality filters and if
+    an order is used, its first property must be the one with inequality
+    filters. Requests breaking these rules fail with a 400 Bad Request. Results
+    of queries with IN filters are also ordered by key, after any other order.
+
     NOTE: Using utils.positional(1), we ensure the class instance will be the
     only positional argument hence won't have leaking/collision between the
     endpoints.method decorator function that we mean to pass metadata to.
@@ -1490,12 +3782,52 @@ class EndpointsModel(ndb.Model):
           fetch in a query. Defaults to the global QUERY_LIMIT_MAX.
       user_required: Boolean; indicates whether or not a user is required on any
           incoming request. Defaults to False.
-      use_projection: Boolean; indicates whether or the query should retrieve
-          entire entities or just a projection using the collection fields.
-          Defaults to False. If used, all properties in a projection must be
-          indexed, so this should be used with care. However, when used
-          correctly, this will speed up queries, reduce payload size and even
-          reduce cost at times.
+      use_projection: Boolean or PROJECTION_AUTO; indicates whether or the
+          query should retrieve entire entities or just a projection using the
+          collection fields. Defaults to False. If used, all properties in a
+          projection must be indexed, so this should be used with care.
+          However, when used correctly, this will speed up queries, reduce
+          payload size and even reduce cost at times. If True, the NDB
+          properties among the collection fields (or the default fields of the
+          class, if collection_fields is None) are projected. If set to
+          PROJECTION_AUTO ('auto'), the collection fields are checked when the
+          decorator is applied and a projection is only used if it is safe. The
+          decision is logged. In both cases, full entities are fetched for
+          requests whose final query, including filters added by the decorated
+          method, filters a projected property by equality, since the
+          datastore doesn't allow projecting it. Regardless of this value, if
+          every collection field is an alias property derived from the key
+          (e.g. id and entityKey), a keys-only query is used and the entities
+          are created from the keys.
+      expand: An (optional) list or tuple of the names of KeyProperty fields in
+          the collection fields. The entities their keys refer to across the
+          whole page are retrieved with a single get and their messages are
+          returned instead of urlsafe keys. Defaults to an empty tuple.
+      cache_results: Boolean; indicates whether or not the response messages
+          should be cached in the _query_result_cache set on the class, keyed by
+          the final query, the limit, the cursor and the projection. Should only
+          be used when the response depends on nothing else, for example not on
+          the current user unless the query is filtered by the user. Defaults
+          to False.
+      batch_size: An (optional) positive integer. If set, the query is iterated
+          in batches of this size and each batch of entities is converted to
+          messages before the next one is taken, resolving batch getters and
+          expanded keys once per batch. The response still holds the messages
+          of the whole page. Queries with IN or OR filters are still fetched a
+          page at a time. Defaults to None.
+      prefetch_next_page: Boolean; indicates whether or not the page after each
+          one returned should also be fetched, in a thread started by the
+          _page_prefetcher set on the class, so a client requesting it next
+          gets it from memory. The response does not wait for the next page.
+          Pages are not prefetched for responses served from the
+          _query_result_cache. Since prefetched pages are shared in the
+          same way as cached results, this can only be used along with
+          cache_results. Defaults to False.
+
+    The decorated method may also be an NDB tasklet (or a generator function,
+    which will be wrapped as one) or return an NDB future for the query. The
+    query is then fetched with fetch_page_async in the same tasklet, so other
+    RPCs started by the decorated method overlap with the query.
 
     Returns:
       A decorator that takes the metadata passed in and augments an API query
@@ -1506,20 +3838,55 @@ class EndpointsModel(ndb.Model):
       TypeError: if there is a custom request or response message class was
           passed in.
       TypeError: if a http_method other than 'GET' is passed in.
+      TypeError: if cache_results is True but no _query_result_cache is set
+          on the class.
+      TypeError: if batch_size is not a positive integer or None.
+      TypeError: if prefetch_next_page is True but no _page_prefetcher is set
+          on the class, or cache_results is False.
     """
+    if cache_results and cls._query_result_cache is None:
+      raise TypeError('Query results can only be cached if a '
+                      '_query_result_cache is set on %s.' % (cls.__name__,))
+    if prefetch_next_page and cls._page_prefetcher is None:
+      raise TypeError('Pages can only be prefetched if a _page_prefetcher is '
+                      'set on %s.' % (cls.__name__,))
+    if prefetch_next_page and not cache_results:
+      raise TypeError('Pages can only be prefetched for query methods which '
+                      'cache their results.')
+    if batch_size is not None and (not isinstance(batch_size, (int, long)) or
+                                   batch_size < 1):
+      raise TypeError('Batch size must be a positive integer or None. '
+                      'Received %r.' % (batch_size,))
+
+    keys_only = cls._KeysOnlyForFields(collection_fields)
+    projection = None
+    if not keys_only:
+      if use_projection == PROJECTION_AUTO:
+        projection, projection_reason = cls._ProjectionForFields(
+            collection_fields, query_fields=query_fields)
+      elif use_projection:
+        projected_fields = collection_fields
+        if projected_fields is None:
+          projected_fields = cls._message_fields_schema
+        projected_fields = MessageFieldsSchema.Intern(
+            projected_fields, basename=cls.__name__ + 'Proto')
+        projection = [name for name in projected_fields
+                      if name in cls._properties]
+
     if REQUEST_MESSAGE in kwargs:
       raise TypeError('Received a request message class on a method intended '
                       'for queries. This is explicitly not allowed. Only '
                       'query_fields can be specified.')
 
-    kwargs[REQUEST_MESSAGE] = cls.ResourceContainer(fields=query_fields)
+    kwargs[REQUEST_MESSAGE] = cls.ResourceContainer(fields=query_fields,
+                                                    allow_query_operators=True)
 
     if RESPONSE_MESSAGE in kwargs:
       raise TypeError('Received a response message class on a method intended '
                       'for queries. This is explicitly not allowed. Only '
                       'collection_fields can be specified.')
-    kwargs[RESPONSE_MESSAGE] = cls.ProtoCollection(
-        collection_fields=collection_fields)
+    kwargs[RESPONSE_MESSAGE] = cls.ExpandedProtoCollection(
+        collection_fields=collection_fields, expand=expand)
 
     # Only allow GET for queries
     if HTTP_METHOD in kwargs:
@@ -1547,6 +3914,22 @@ class EndpointsModel(ndb.Model):
             back to a ProtoRPC (collection) message.
       """
 
+      query_api_method = _AsTasklet(api_method)
+      # Recorded so the indexes needed by the query can be derived
+      cls._query_methods.append((api_method.__name__, query_fields,
+                                 projection))
+
+      if keys_only:
+        logging.info('%s.%s uses a keys-only query.', cls.__name__,
+                     api_method.__name__)
+      elif use_projection == PROJECTION_AUTO:
+        if projection is None:
+          logging.info('%s.%s fetches full entities: %s.', cls.__name__,
+                       api_method.__name__, projection_reason)
+        else:
+          logging.info('%s.%s uses a projection query: %s.', cls.__name__,
+                       api_method.__name__, projection_reason)
+
       @functools.wraps(api_method)
       def QueryFromRequestMethod(service_instance, request):
         """Stub method to be decorated.
@@ -1574,11 +3957,12 @@ class EndpointsModel(ndb.Model):
           raise endpoints.UnauthorizedException('Invalid token.')
 
         request_entity = cls.FromMessage(request)
+        request_entity._ResolvePendingUpdate()
         query_info = request_entity._endpoints_query_info
         query_info.SetQuery()
 
-        # Allow the caller to update the query
-        query = api_method(service_instance, query_info.query)
+        # Allow the caller to update the query, possibly asynchronously
+        query = query_api_method(service_instance, query_info.query)
 
         # Use limit on query info or default if none was set
         request_limit = query_info.limit or limit_default
@@ -1587,23 +3971,510 @@ class EndpointsModel(ndb.Model):
               QUERY_MAX_EXCEEDED_TEMPLATE % (request_limit, limit_max))
 
         query_options = {'start_cursor': query_info.cursor}
-        if use_projection:
-          projection = [value for value in collection_fields
-                        if value in cls._properties]
+        if keys_only:
+          query_options['keys_only'] = True
+        elif projection is not None:
           query_options['projection'] = projection
-        items, next_cursor, more_results = query.fetch_page(
-            request_limit, **query_options)
-
-        # Don't pass a cursor if there are no more results
-        if not more_results:
-          next_cursor = None
-
-        return cls.ToMessageCollection(items,
-                                       collection_fields=collection_fields,
-                                       next_cursor=next_cursor)
+        return cls._QueryCollectionAsync(
+            query, request_limit, collection_fields=collection_fields,
+            query_options=query_options, expand=expand,
+            cache_results=cache_results, batch_size=batch_size,
+            prefetch=prefetch_next_page).get_result()
 
       return apiserving_method_decorator(QueryFromRequestMethod)
 
     return RequestToQueryDecorator
+
+  @classmethod
+  @utils.positional(1)
+  def count_method(cls,
+                   query_fields=(),
+                   limit_max=COUNT_LIMIT_MAX,
+                   exists_only=False,
+                   user_required=False,
+                   cache_results=False,
+                   **kwargs):
+    """Creates an API method decorator for counting the results of a query.
+
+    As in query_method, the decorator produced is intended to decorate
+    functions which receive a query and return it, possibly modified. The
+    query fields are parsed and validated in the same way, so the same filters,
+    operators and orders can be used, but rather than fetching a page of
+    results, the query is counted with a single count_async call, which only
+    reads keys. If exists_only is True, a keys-only get for one result is used
+    instead.
+
+    The response is a utils.CountMessage, or a utils.ExistsMessage if
+    exists_only is True. The limit field, if in the query fields, sets the
+    maximum number of results counted, which defaults to limit_max. If there
+    are more results than the maximum, the count is the maximum and capped is
+    True. The pageToken field, if in the query fields, is ignored.
+
+    The decorated method may also be an NDB tasklet or return an NDB future for
+    the query, as in query_method.
+
+    Args:
+      query_fields: An (optional) list, tuple, dictionary or MessageFieldsSchema
+          that define a field ordering in a ProtoRPC message class. Defaults to
+          an empty tuple, which results in counting all entities of the kind.
+      limit_max: An (optional) max value for the amount of results to count.
+          Defaults to the global COUNT_LIMIT_MAX.
+      exists_only: Boolean; indicates whether or not the method only checks if
+          the query has any results. Defaults to False.
+      user_required: Boolean; indicates whether or not a user is required on any
+          incoming request. Defaults to False.
+      cache_results: Boolean; indicates whether or not the responses should be
+          cached in the _query_count_cache set on the class, keyed by the final
+          query and the limit. The same restrictions as for query_method
+          apply. Defaults to False.
+
+    Returns:
+      A decorator that takes the metadata passed in and augments an API count
+          method.
+
+    Raises:
+      TypeError: if there is a custom request or response message class was
+          passed in.
+      TypeError: if a http_method other than 'GET' is passed in.
+      TypeError: if cache_results is True but no _query_count_cache is set
+          on the class.
+    """
+    if cache_results and cls._query_count_cache is None:
+      raise TypeError('Counts can only be cached if a _query_count_cache is '
+                      'set on %s.' % (cls.__name__,))
+
+    if REQUEST_MESSAGE in kwargs:
+      raise TypeError('Received a request message class on a method intended '
+                      'for counts. This is explicitly not allowed. Only '
+                      'query_fields can be specified.')
+    kwargs[REQUEST_MESSAGE] = cls.ResourceContainer(fields=query_fields,
+                                                    allow_query_operators=True)
+
+    if RESPONSE_MESSAGE in kwargs:
+      raise TypeError('Received a response message class on a method intended '
+                      'for counts. This is explicitly not allowed.')
+    if exists_only:
+      kwargs[RESPONSE_MESSAGE] = utils.ExistsMessage
+    else:
+      kwargs[RESPONSE_MESSAGE] = utils.CountMessage
+
+    # Only allow GET for counts
+    if HTTP_METHOD in kwargs:
+      if kwargs[HTTP_METHOD] != QUERY_HTTP_METHOD:
+        raise TypeError('Count requests must use the HTTP GET methods. '
+                        'Received %s.' % (kwargs[HTTP_METHOD],))
+    kwargs[HTTP_METHOD] = QUERY_HTTP_METHOD
+
+    apiserving_method_decorator = endpoints.method(**kwargs)
+
+    def RequestToCountDecorator(api_method):
+      """A decorator that uses the metadata passed to the enclosing method.
+
+      Args:
+        api_method: A method to be decorated. Expected signature is two
+            positional arguments, an instance object of an API service and a
+            variable containing a deserialized API request object, required here
+            to be an NDB query object with kind set to the current
+            EndpointsModel class.
+
+      Returns:
+        A decorated method that uses the metadata of the enclosing method to
+            verify the service instance, convert the arguments to ones that can
+            be consumed by the decorated method and count the results of the
+            query it returns.
+      """
+
+      count_api_method = _AsTasklet(api_method)
+      # Recorded so the indexes needed by the query can be derived
+      cls._query_methods.append((api_method.__name__, query_fields, None))
+
+      @functools.wraps(api_method)
+      def CountFromRequestMethod(service_instance, request):
+        """Stub method to be decorated.
+
+        After creation, will be passed to the standard endpoints.method
+        decorator to preserve the necessary method attributes needed for
+        endpoints API methods.
+
+        Args:
+          service_instance: A ProtoRPC remove service instance.
+          request: A ProtoRPC message.
+
+        Returns:
+          A utils.CountMessage or utils.ExistsMessage for the query.
+
+        Raises:
+          endpoints.UnauthorizedException: if the user required boolean from
+             the metadata is True and if there is no current endpoints user.
+          endpoints.ForbiddenException: if the limit passed in through the
+             request exceeds the maximum allowed.
+        """
+        if user_required and endpoints.get_current_user() is None:
+          raise endpoints.UnauthorizedException('Invalid token.')
+
+        request_entity = cls.FromMessage(request)
+        request_entity._ResolvePendingUpdate()
+        query_info = request_entity._endpoints_query_info
+        query_info.SetQuery()
+
+        # Allow the caller to update the query, possibly asynchronously
+        query = count_api_method(service_instance, query_info.query)
+
+        request_limit = query_info.limit or limit_max
+        if request_limit > limit_max:
+          raise endpoints.ForbiddenException(
+              QUERY_MAX_EXCEEDED_TEMPLATE % (request_limit, limit_max))
+
+        return cls._CountAsync(query, request_limit, exists_only=exists_only,
+                               cache_results=cache_results).get_result()
+
+      return apiserving_method_decorator(CountFromRequestMethod)
+
+    return RequestToCountDecorator
+
+  @classmethod
+  @utils.positional(1)
+  def aggregate_method(cls,
+                       query_fields=(),
+                       group_by=(),
+                       aggregates=(),
+                       max_groups=AGGREGATE_GROUPS_MAX,
+                       batch_size=QUERY_BATCH_SIZE_DEFAULT,
+                       use_projection=False,
+                       user_required=False,
+                       cache_results=False,
+                       **kwargs):
+    """Creates an API method decorator for aggregating the results of a query.
+
+    As in query_method, the decorator produced is intended to decorate
+    functions which receive a query and return it, possibly modified, and the
+    query fields are parsed and validated in the same way. Rather than a page
+    of results, the response holds the count of the results in each group and
+    the requested aggregates, as produced by AggregateCollection. For example,
+    a leaderboard of the total and best score of each player:
+
+      @Score.aggregate_method(query_fields=('game',), group_by=('player',),
+                              aggregates=('points__sum', 'points__max'),
+                              path='scores/totals', name='scores.totals')
+      def ScoreTotals(self, query):
+        return query
+
+    The whole query is iterated in batches of batch_size, keeping only the
+    totals of each group. The limit and pageToken fields, if in the query
+    fields, are ignored.
+
+    The decorated method may also be an NDB tasklet or return an NDB future for
+    the query, as in query_method.
+
+    Args:
+      query_fields: An (optional) list, tuple, dictionary or MessageFieldsSchema
+          that define a field ordering in a ProtoRPC message class. Defaults to
+          an empty tuple, which results in aggregating all entities of the kind.
+      group_by: An (optional) list or tuple of the names of non-repeated NDB
+          properties the results are grouped by. Defaults to an empty tuple, in
+          which case all results are in a single group.
+      aggregates: An (optional) list or tuple of aggregates, each the name of a
+          non-repeated integer or float NDB property followed by __sum, __min or
+          __max. Defaults to an empty tuple, in which case only the count of
+          each group is computed.
+      max_groups: An (optional) maximum number of groups, bounding the memory
+          used. Defaults to the global AGGREGATE_GROUPS_MAX.
+      batch_size: An (optional) number of results fetched at a time. Defaults
+          to the global QUERY_BATCH_SIZE_DEFAULT.
+      use_projection: Boolean or PROJECTION_AUTO; indicates whether or not the
+          query should retrieve entire entities or just a projection of the
+          group_by and aggregated properties. Defaults to False. A projection
+          query skips entities which have never had a value for a projected
+          property, which changes the counts, and needs a composite index of
+          the projected properties (see index_advisor). If True, these
+          properties are projected. If set to PROJECTION_AUTO ('auto'), they
+          are checked when the decorator is applied, as in query_method, and
+          are only projected if they are also required, so that every entity
+          has a value for them. The decision is logged. In both cases, full
+          entities are fetched for requests whose final query filters a
+          projected property by equality.
+      user_required: Boolean; indicates whether or not a user is required on any
+          incoming request. Defaults to False.
+      cache_results: Boolean; indicates whether or not the responses should be
+          cached in the _query_result_cache set on the class, keyed by the final
+          query. The same restrictions as for query_method apply. Defaults to
+          False.
+
+    Returns:
+      A decorator that takes the metadata passed in and augments an API
+          aggregate method.
+
+    Raises:
+      TypeError: if there is a custom request or response message class was
+          passed in.
+      TypeError: if a http_method other than 'GET' is passed in.
+      TypeError: if a group_by property or an aggregate is not valid.
+      TypeError: if cache_results is True but no _query_result_cache is set
+          on the class.
+    """
+    if cache_results and cls._query_result_cache is None:
+      raise TypeError('Query results can only be cached if a '
+                      '_query_result_cache is set on %s.' % (cls.__name__,))
+
+    if REQUEST_MESSAGE in kwargs:
+      raise TypeError('Received a request message class on a method intended '
+                      'for aggregates. This is explicitly not allowed. Only '
+                      'query_fields can be specified.')
+    kwargs[REQUEST_MESSAGE] = cls.ResourceContainer(fields=query_fields,
+                                                    allow_query_operators=True)
+
+    if RESPONSE_MESSAGE in kwargs:
+      raise TypeError('Received a response message class on a method intended '
+                      'for aggregates. This is explicitly not allowed. Only '
+                      'group_by and aggregates can be specified.')
+    kwargs[RESPONSE_MESSAGE] = cls.AggregateCollection(group_by=group_by,
+                                                       aggregates=aggregates)
+
+    # Only allow GET for aggregates
+    if HTTP_METHOD in kwargs:
+      if kwargs[HTTP_METHOD] != QUERY_HTTP_METHOD:
+        raise TypeError('Aggregate requests must use the HTTP GET methods. '
+                        'Received %s.' % (kwargs[HTTP_METHOD],))
+    kwargs[HTTP_METHOD] = QUERY_HTTP_METHOD
+
+    projected_fields = list(group_by)
+    for aggregate in aggregates:
+      name = cls._AggregateProperty(aggregate)[0]._name
+      if name not in projected_fields:
+        projected_fields.append(name)
+    projection = None
+    if not projected_fields:
+      projection_reason = 'no fields are NDB properties'
+    elif use_projection == PROJECTION_AUTO:
+      projection, projection_reason = cls._ProjectionForFields(
+          projected_fields, query_fields=query_fields)
+      optional = [name for name in projection or ()
+                  if not cls._properties[name]._required]
+      if optional:
+        # Entities without a value would be left out of the counts
+        projection = None
+        projection_reason = 'field %s is not required' % (optional[0],)
+    elif use_projection:
+      projection = projected_fields
+
+    apiserving_method_decorator = endpoints.method(**kwargs)
+
+    def RequestToAggregateDecorator(api_method):
+      """A decorator that uses the metadata passed to the enclosing method.
+
+      Args:
+        api_method: A method to be decorated. Expected signature is two
+            positional arguments, an instance object of an API service and a
+            variable containing a deserialized API request object, required here
+            to be an NDB query object with kind set to the current
+            EndpointsModel class.
+
+      Returns:
+        A decorated method that uses the metadata of the enclosing method to
+            verify the service instance, convert the arguments to ones that can
+            be consumed by the decorated method and aggregate the results of
+            the query it returns.
+      """
+
+      aggregate_api_method = _AsTasklet(api_method)
+      # Recorded so the indexes needed by the query can be derived
+      cls._query_methods.append((api_method.__name__, query_fields,
+                                 projection))
+
+      if use_projection == PROJECTION_AUTO:
+        if projection is None:
+          logging.info('%s.%s aggregates full entities: %s.', cls.__name__,
+                       api_method.__name__, projection_reason)
+        else:
+          logging.info('%s.%s aggregates a projection query: %s.',
+                       cls.__name__, api_method.__name__, projection_reason)
+
+      @functools.wraps(api_method)
+      def AggregateFromRequestMethod(service_instance, request):
+        """Stub method to be decorated.
+
+        After creation, will be passed to the standard endpoints.method
+        decorator to preserve the necessary method attributes needed for
+        endpoints API methods.
+
+        Args:
+          service_instance: A ProtoRPC remove service instance.
+          request: A ProtoRPC message.
+
+        Returns:
+          A ProtoRPC (collection) message with the aggregates of each group.
+
+        Raises:
+          endpoints.UnauthorizedException: if the user required boolean from
+             the metadata is True and if there is no current endpoints user.
+          endpoints.ForbiddenException: if the results have more groups than
+             the maximum allowed.
+        """
+        if user_required and endpoints.get_current_user() is None:
+          raise endpoints.UnauthorizedException('Invalid token.')
+
+        request_entity = cls.FromMessage(request)
+        request_entity._ResolvePendingUpdate()
+        query_info = request_entity._endpoints_query_info
+        query_info.SetQuery()
+
+        # Allow the caller to update the query, possibly asynchronously
+        query = aggregate_api_method(service_instance, query_info.query)
+
+        try:
+          return cls._AggregateAsync(
+              query, group_by=group_by, aggregates=aggregates,
+              projection=projection, batch_size=batch_size,
+              max_groups=max_groups,
+              cache_results=cache_results).get_result()
+        except AggregateGroupsExceededError as error:
+          raise endpoints.ForbiddenException(str(error))
+
+      return apiserving_method_decorator(AggregateFromRequestMethod)
+
+    return RequestToAggregateDecorator
+
+  @classmethod
+  @utils.positional(1)
+  def multi_method(cls,
+                   request_fields=None,
+                   response_fields=None,
+                   operation=MULTI_INSERT,
+                   batch_size=MULTI_BATCH_SIZE,
+                   user_required=False,
+                   **kwargs):
+    """Creates an API method decorator for writing a collection of entities.
+
+    This will produce a decorator intended to decorate functions which receive
+    a list of entities and return the list of entities to be written. The
+    request is a collection of items, as produced by ProtoCollection, so a
+    client can insert, update or delete many entities in a single request.
+
+    The decorator deserializes each item to an entity. Gets issued by alias
+    setters such as id are started together and waited on together, so existing
+    entities are retrieved in a single batch before the decorated method is
+    called. The decorated method may drop or reorder the entities, the status of
+    each entity it returns carries the position of its item in the request. The
+    entities returned by the decorated method are then written (or deleted) in
+    batches of at most batch_size entities, with all batches running
+    concurrently.
+
+    The response contains each entity returned by the decorated method and an
+    ItemStatusMessage for each of them, as produced by ProtoStatusCollection.
+    For updates and deletes, entities without a key or which were not retrieved
+    from the datastore are not written and have a failed status.
+
+    As in query_method, no custom request/response message classes can be
+    passed in. The decorated method may also be an NDB tasklet (or a generator
+    function, which will be wrapped as one) or return an NDB future for the
+    list of entities.
+
+    NOTE: Using utils.positional(1), we ensure the class instance will be the
+    only positional argument hence won't have leaking/collision between the
+    endpoints.method decorator function that we mean to pass metadata to.
+
+    Args:
+      request_fields: An (optional) list, tuple, dictionary or
+          MessageFieldsSchema that defines a field ordering in the ProtoRPC
+          message class of each item in the request. Defaults to None.
+      response_fields: An (optional) list, tuple, dictionary or
+          MessageFieldsSchema that defines a field ordering in the ProtoRPC
+          message class of each item in the response. Defaults to None.
+      operation: One of MULTI_INSERT ('insert'), MULTI_UPDATE ('update') or
+          MULTI_DELETE ('delete'). Defaults to MULTI_INSERT.
+      batch_size: An (optional) maximum number of entities written in a single
+          datastore call. Defaults to the global MULTI_BATCH_SIZE, the datastore
+          limit.
+      user_required: Boolean; indicates whether or not a user is required on any
+          incoming request. Defaults to False.
+
+    Returns:
+      A decorator that takes the metadata passed in and augments an API method.
+
+    Raises:
+      TypeError: if a custom request or response message class was passed in.
+      TypeError: if the operation is not one of the allowed operations.
+      TypeError: if the batch size is not a positive integer.
+    """
+    if operation not in MULTI_OPERATIONS:
+      raise TypeError('Operation must be one of %s. Received %s.' %
+                      (', '.join(sorted(MULTI_OPERATIONS)), operation))
+    if not isinstance(batch_size, (int, long)) or batch_size < 1:
+      raise TypeError('Batch size must be a positive integer.')
+
+    if REQUEST_MESSAGE in kwargs:
+      raise TypeError('Received a request message class on a method intended '
+                      'for collections. This is explicitly not allowed. Only '
+                      'request_fields can be specified.')
+    kwargs[REQUEST_MESSAGE] = cls.ProtoCollection(
+        collection_fields=request_fields)
+
+    if RESPONSE_MESSAGE in kwargs:
+      raise TypeError('Received a response message class on a method intended '
+                      'for collections. This is explicitly not allowed. Only '
+                      'response_fields can be specified.')
+    kwargs[RESPONSE_MESSAGE] = cls.ProtoStatusCollection(
+        collection_fields=response_fields)
+
+    apiserving_method_decorator = endpoints.method(**kwargs)
+
+    def RequestToEntitiesDecorator(api_method):
+      """A decorator that uses the metadata passed to the enclosing method.
+
+      Args:
+        api_method: A method to be decorated. Expected signature is two
+            positional arguments, an instance object of an API service and a
+            list of instances of the current EndpointsModel class.
+
+      Returns:
+        A decorated method that uses the metadata of the enclosing method to
+            verify the service instance, convert the arguments to ones that can
+            be consumed by the decorated method, write the entities returned
+            and serialize them back to a ProtoRPC (collection) message.
+      """
+
+      entities_api_method = _AsTasklet(api_method)
+
+      @functools.wraps(api_method)
+      def EntitiesFromRequestMethod(service_instance, request):
+        """Stub method to be decorated.
+
+        After creation, will be passed to the standard endpoints.method
+        decorator to preserve the necessary method attributes needed for
+        endpoints API methods.
+
+        Args:
+          service_instance: A ProtoRPC remove service instance.
+          request: A ProtoRPC (collection) message.
+
+        Returns:
+          A ProtoRPC (collection) message, containing the entities returned by
+              the decorated method and the status of each write.
+
+        Raises:
+          endpoints.UnauthorizedException: if the user required boolean from
+             the metadata is True and if there is no current endpoints user.
+        """
+        if user_required and endpoints.get_current_user() is None:
+          raise endpoints.UnauthorizedException('Invalid token.')
+
+        # All conversions are started before any is waited on, so their gets
+        # are sent as a single batch
+        futures = [cls._FromMessageAsync(item) for item in request.items]
+        entities = [future.get_result() for future in futures]
+        for index, entity in enumerate(entities):
+          entity._request_index = index
+
+        entities = entities_api_method(service_instance, entities)
+        if isinstance(entities, ndb.Future):
+          entities = entities.get_result()
+
+        errors = cls._WriteMulti(entities, operation, batch_size=batch_size)
+        return cls.ToMessageStatusCollection(
+            entities, errors, collection_fields=response_fields)
+
+      return apiserving_method_decorator(EntitiesFromRequestMethod)
+
+    return RequestToEntitiesDecorator
 # Update base class global so EndpointsMetaModel can check subclasses against it
 BASE_MODEL_CLASS = EndpointsModel
@@ -0,0 +1,982 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Tests for ndb/model.py."""
+
+
+import threading
+import unittest
+
+import endpoints
+
+from protorpc import messages
+
+from . import cache
+from . import model
+from . import page_token
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+
+class Plain(model.EndpointsModel):
+  """Model without caches."""
+  text = ndb.StringProperty()
+
+
+class Cached(model.EndpointsModel):
+  """Model with caches invalidated by its hooks."""
+  _entity_cache = cache.EntityCache()
+  _missing_key_cache = cache.MissingKeyCache()
+  _query_result_cache = cache.QueryResultCache()
+
+  text = ndb.StringProperty()
+
+
+class CachedWithHooks(Cached):
+  """Model with caches whose hooks don't call the superclass hooks."""
+  puts = []
+  deletes = []
+
+  def _post_put_hook(self, future):
+    self.puts.append(self.key)
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    cls.deletes.append(key)
+
+
+class KeyMessage(messages.Message):
+  """Message used to serialize keys without expanding them."""
+  kind = messages.StringField(1)
+  id = messages.IntegerField(2)
+
+
+def _KeyToProto(prop, index):
+  """Maps key properties to KeyMessage fields."""
+  return messages.MessageField(KeyMessage, index, repeated=prop._repeated)
+
+
+def _KeyToMessage(value):
+  """Serializes a key to a KeyMessage."""
+  return KeyMessage(kind=value.kind(), id=value.id())
+
+
+class Owner(model.EndpointsModel):
+  """Model referred to by keys which can be expanded."""
+  name = ndb.StringProperty()
+
+
+class Pet(model.EndpointsModel):
+  """Model with keys serialized to messages, which can also be expanded."""
+  _custom_property_to_proto = {ndb.KeyProperty: _KeyToProto}
+  _custom_property_to_value = {ndb.KeyProperty: _KeyToMessage}
+
+  owner = ndb.KeyProperty(kind=Owner)
+
+
+@ndb.tasklet
+def _OwnerNamesAsync(modelclass, entities):
+  """Batch getter for the names of the owners of a list of entities."""
+  modelclass.batch_calls.append(len(entities))
+  owners = yield ndb.get_multi_async([entity.owner for entity in entities])
+  raise ndb.Return([owner.name for owner in owners])
+
+
+class Named(model.EndpointsModel):
+  """Model with an alias property whose values are got for a page at once."""
+  batch_calls = []
+
+  owner = ndb.KeyProperty(kind=Owner)
+
+  @model.EndpointsAliasProperty(batch_getter=_OwnerNamesAsync)
+  def ownerName(self):
+    """The name of the owner, got for a single entity."""
+    return self.owner.get().name
+
+
+class Score(model.EndpointsModel):
+  """Simple model used to test queries."""
+  player = ndb.StringProperty()
+  points = ndb.IntegerProperty()
+
+
+class Tagged(model.EndpointsModel):
+  """Model with a repeated property used to test disjunctive queries."""
+  group = ndb.StringProperty()
+  tags = ndb.StringProperty(repeated=True)
+
+
+class Result(model.EndpointsModel):
+  """Model whose aggregated properties every entity has a value for."""
+  team = ndb.StringProperty(required=True)
+  goals = ndb.IntegerProperty(required=True)
+
+
+class HeldThread(threading.Thread):
+  """Thread class holding the prefetches until a test releases them."""
+  held = []
+
+  def start(self):
+    self.held.append(self)
+
+  @classmethod
+  def ReleaseAll(cls):
+    """Runs the held threads and waits for them to complete."""
+    while cls.held:
+      thread = cls.held.pop(0)
+      super(HeldThread, thread).start()
+      thread.join()
+
+
+class Prefetched(model.EndpointsModel):
+  """Model whose query results are cached and prefetched."""
+  _query_result_cache = cache.QueryResultCache()
+  _page_prefetcher = cache.PagePrefetcher(thread_class=HeldThread)
+
+  points = ndb.IntegerProperty()
+
+
+class Deferred(model.EndpointsModel):
+  """Model whose UpdateFromKey gets are deferred."""
+  _defer_update_from_key = True
+
+  text = ndb.StringProperty()
+
+
+class DeferredCoalesced(model.EndpointsModel):
+  """Model whose deferred UpdateFromKey gets are coalesced."""
+  _defer_update_from_key = True
+  _key_get_coalescer = cache.KeyGetCoalescer()
+
+  text = ndb.StringProperty()
+
+
+class ModelTestCase(unittest.TestCase):
+  """Base class activating the datastore stub for model tests."""
+
+  def setUp(self):
+    """Activates the datastore stub and turns off the NDB caches."""
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    context = ndb.get_context()
+    context.set_cache_policy(False)
+    context.set_memcache_policy(False)
+
+  def tearDown(self):
+    """Deactivates the stubs."""
+    self.testbed.deactivate()
+
+
+class CacheInvalidationTests(ModelTestCase):
+  """Tests for the hooks invalidating the caches of a model class."""
+
+  def testHooksOnlyInstalledWithCaches(self):
+    """Tests that classes without caches keep the default NDB hooks."""
+    # pylint:disable-msg=W0212
+    self.assertTrue(ndb.Model._is_default_hook(
+        ndb.Model._default_post_put_hook, Plain()._post_put_hook))
+    self.assertTrue(ndb.Model._is_default_hook(
+        ndb.Model._default_post_delete_hook, Plain._post_delete_hook))
+    self.assertFalse(ndb.Model._is_default_hook(
+        ndb.Model._default_post_put_hook, Cached()._post_put_hook))
+    self.assertFalse(ndb.Model._is_default_hook(
+        ndb.Model._default_post_delete_hook, Cached._post_delete_hook))
+    # pylint:enable-msg=W0212
+
+  def testPutAndDeleteInvalidate(self):
+    """Tests that puts and deletes invalidate the caches of the class."""
+    # pylint:disable-msg=W0212
+    entity_cache = Cached._entity_cache
+    result_cache = Cached._query_result_cache
+    key = Cached(text='a').put()
+    self.assertEqual(entity_cache.GetAsync(key).get_result().text, 'a')
+
+    generation = result_cache.Generation('Cached')
+    Cached(key=key, text='b').put()
+    self.assertEqual(entity_cache.Get(key), None)
+    self.assertNotEqual(result_cache.Generation('Cached'), generation)
+
+    missing_cache = Cached._missing_key_cache
+    missing_key = ndb.Key(Cached, 'missing')
+    missing_cache.Add(missing_key, missing_cache.Version('Cached'))
+    Cached(key=missing_key).put()
+    self.assertFalse(missing_cache.IsMissing(missing_key))
+
+    entity_cache.GetAsync(key).get_result()
+    generation = result_cache.Generation('Cached')
+    key.delete()
+    self.assertEqual(entity_cache.Get(key), None)
+    self.assertNotEqual(result_cache.Generation('Cached'), generation)
+    # pylint:enable-msg=W0212
+
+  def testOverriddenHooksInvalidate(self):
+    """Tests that hooks which don't call the superclass still invalidate."""
+    # pylint:disable-msg=W0212
+    entity_cache = CachedWithHooks._entity_cache
+    key = CachedWithHooks(text='a').put()
+    self.assertEqual(CachedWithHooks.puts, [key])
+    entity_cache.GetAsync(key).get_result()
+
+    CachedWithHooks(key=key, text='b').put()
+    self.assertEqual(entity_cache.Get(key), None)
+
+    entity_cache.GetAsync(key).get_result()
+    key.delete()
+    self.assertEqual(CachedWithHooks.deletes, [key])
+    self.assertEqual(entity_cache.Get(key), None)
+    # pylint:enable-msg=W0212
+
+
+class DeferredUpdateTests(ModelTestCase):
+  """Tests for UpdateFromKey calls deferred by _defer_update_from_key."""
+
+  def testMergedOnAccess(self):
+    """Tests that the entity is merged when an attribute is first read."""
+    key = Deferred(text='a').put()
+    entity = Deferred()
+    entity.id = key.id()
+    # pylint:disable-msg=W0212
+    self.assertTrue(isinstance(entity._pending_update, ndb.Future))
+    self.assertFalse(entity._from_datastore)
+    self.assertEqual(entity.text, 'a')
+    self.assertEqual(entity._pending_update, None)
+    # pylint:enable-msg=W0212
+    self.assertTrue(entity.from_datastore)
+
+    # Values set on the entity are kept
+    entity = Deferred(text='b')
+    entity.id = key.id()
+    self.assertEqual(entity.text, 'b')
+    self.assertTrue(entity.from_datastore)
+
+    entity = Deferred()
+    entity.id = key.id() + 1
+    self.assertFalse(entity.from_datastore)
+    self.assertEqual(entity.text, None)
+
+  def testMergePendingUpdates(self):
+    """Tests merging the deferred updates of several entities."""
+    keys = [Deferred(text=text).put() for text in ('a', 'b')]
+    entities = [Deferred() for _ in range(3)]
+    for entity, key_id in zip(entities, [keys[0].id(), keys[1].id(),
+                                         keys[1].id() + 1]):
+      entity.id = key_id
+
+    Deferred.MergePendingUpdates(entities)
+    # pylint:disable-msg=W0212
+    self.assertEqual([entity._pending_update for entity in entities],
+                     [None, None, None])
+    # pylint:enable-msg=W0212
+    self.assertEqual([entity.text for entity in entities], ['a', 'b', None])
+    self.assertEqual([entity.from_datastore for entity in entities],
+                     [True, True, False])
+
+  def testCoalescedGets(self):
+    """Tests that deferred gets go through the key get coalescer."""
+    key = DeferredCoalesced(text='a').put()
+    # pylint:disable-msg=W0212
+    coalescer = DeferredCoalesced._key_get_coalescer
+    # pylint:enable-msg=W0212
+    shared = coalescer.shared
+    entities = [DeferredCoalesced(), DeferredCoalesced()]
+    for entity in entities:
+      entity.id = key.id()
+
+    DeferredCoalesced.MergePendingUpdates(entities)
+    self.assertEqual([entity.text for entity in entities], ['a', 'a'])
+    self.assertEqual(coalescer.shared, shared + 1)
+
+  def testMethodDefersMerge(self):
+    """Tests that method leaves the merge to the decorated method."""
+    key = Deferred(text='a').put()
+    pending = []
+
+    def Get(unused_service, entity):
+      # pylint:disable-msg=W0212
+      pending.append(entity._pending_update is not None)
+      # pylint:enable-msg=W0212
+      return entity
+
+    api_method = Deferred.method(request_fields=('id',),
+                                 response_fields=('id', 'text'))(Get)
+    request = Deferred.ProtoModel(fields=('id',))(id=key.id())
+    response = api_method(None, request)
+    self.assertEqual(pending, [True])
+    self.assertEqual((response.id, response.text), (key.id(), 'a'))
+
+
+class MethodTests(ModelTestCase):
+  """Tests for API methods decorated by method which run asynchronously."""
+
+  def _Call(self, api_method, key):
+    """Decorates and calls an API method for the Owner with the given key."""
+    decorated = Owner.method(request_fields=('id',),
+                             response_fields=('id', 'name'))(api_method)
+    return decorated(None, Owner.ProtoModel(fields=('id',))(id=key.id()))
+
+  def testGeneratorMethod(self):
+    """Tests that generator methods run as tasklets and are resolved."""
+    key = Owner(name='Ann').put()
+
+    def GetAsync(unused_service, entity):
+      owner = yield entity.key.get_async()
+      owner.name = owner.name.upper()
+      raise ndb.Return(owner)
+
+    response = self._Call(GetAsync, key)
+    self.assertEqual((response.id, response.name), (key.id(), 'ANN'))
+
+  def testFutureResponse(self):
+    """Tests that futures returned by methods are resolved."""
+    key = Owner(name='Ann').put()
+
+    @ndb.tasklet
+    def RenameAsync(entity):
+      entity.name = 'Bob'
+      yield entity.put_async()
+      raise ndb.Return(entity)
+
+    def Rename(unused_service, entity):
+      return RenameAsync(entity)
+
+    response = self._Call(Rename, key)
+    self.assertEqual((response.id, response.name), (key.id(), 'Bob'))
+    self.assertEqual(key.get(use_cache=False).name, 'Bob')
+
+  def testTaskletErrors(self):
+    """Tests that errors raised by tasklets reach the endpoints server."""
+    key = Owner(name='Ann').put()
+
+    def GetAsync(unused_service, entity):
+      owner = yield entity.key.get_async()
+      if owner.name != 'Bob':
+        raise endpoints.NotFoundException('Owner not found.')
+      raise ndb.Return(owner)
+
+    @ndb.tasklet
+    def Forbidden(unused_service, unused_entity):
+      yield ndb.sleep(0)
+      raise endpoints.ForbiddenException('Not allowed.')
+
+    self.assertRaises(endpoints.NotFoundException, self._Call, GetAsync, key)
+    self.assertRaises(endpoints.ForbiddenException, self._Call, Forbidden,
+                      key)
+
+
+class ToMessageTests(ModelTestCase):
+  """Tests for serializing entities to messages."""
+
+  def testOnlyExpandedKeysHoldEntities(self):
+    """Tests that keys mapped to message fields are only expanded if asked."""
+    owner_key = Owner(name='Ann').put()
+    pet = Pet(owner=owner_key)
+
+    message = pet.ToMessage(fields=('owner',))
+    self.assertEqual(message.owner, KeyMessage(kind='Owner',
+                                               id=owner_key.id()))
+
+    # pylint:disable-msg=W0212
+    item_messages = Pet._ItemsToMessages([pet], collection_fields=('owner',),
+                                         expand=('owner',))
+    # pylint:enable-msg=W0212
+    self.assertEqual(item_messages[0].owner.name, 'Ann')
+
+  def testBatchGetter(self):
+    """Tests that batch getters are called once for a page of entities."""
+    owner_keys = [Owner(name=name).put() for name in ('Ann', 'Bob', 'Cy')]
+    for index in range(4):
+      Named(owner=owner_keys[index % 3]).put()
+    Named.batch_calls = []
+
+    # pylint:disable-msg=W0212
+    result = Named._FetchCollectionAsync(
+        Named.query().order(Named.key), 4,
+        collection_fields=('ownerName',)).get_result()
+    # pylint:enable-msg=W0212
+    self.assertEqual([item.ownerName for item in result.items],
+                     ['Ann', 'Bob', 'Cy', 'Ann'])
+    self.assertEqual(Named.batch_calls, [4])
+
+    # Single entities use the getter
+    entity = Named.query().order(Named.key).get()
+    self.assertEqual(entity.ToMessage(fields=('ownerName',)).ownerName, 'Ann')
+    self.assertEqual(Named.batch_calls, [4])
+
+    def WrongCount(unused_modelclass, entities):
+      return [None] * (len(entities) + 1)
+    prop = model.EndpointsAliasProperty(lambda self: None,
+                                        batch_getter=WrongCount)
+    self.assertRaises(ValueError, prop.GetBatchValues, Named, [entity])
+    self.assertRaises(TypeError, Score.id.GetBatchValues, Score, [])
+
+
+class QueryInfoTests(ModelTestCase):
+  """Tests for queries created from query fields using operators."""
+
+  def testInFiltersOrderByKey(self):
+    """Tests that queries with IN filters can be resumed from a cursor."""
+    for points in (1, 2, 3):
+      Score(points=points).put()
+
+    # pylint:disable-msg=W0212
+    query_info = Score()._endpoints_query_info
+    query_info._AddOperatorFilter(Score.points, 'in', [1, 3])
+    query_info.order = 'points'
+    query_info.SetQuery()
+    query = query_info.query
+    self.assertEqual(model._OrderSpec(query),
+                     [('points', False), ('__key__', False)])
+    # pylint:enable-msg=W0212
+
+    results, cursor, more = query.fetch_page(1)
+    self.assertEqual([result.points for result in results], [1])
+    self.assertTrue(more)
+    results, _, _ = query.fetch_page(1, start_cursor=cursor)
+    self.assertEqual([result.points for result in results], [3])
+
+  def testInFiltersWithInequality(self):
+    """Tests that IN queries order by their inequality property first."""
+    for player, points in (('a', 1), ('b', 2), ('a', 3), ('c', 4)):
+      Score(player=player, points=points).put()
+
+    # pylint:disable-msg=W0212
+    query_info = Score()._endpoints_query_info
+    query_info._AddOperatorFilter(Score.player, 'in', ['a', 'b'])
+    query_info._AddOperatorFilter(Score.points, 'gt', 1)
+    query_info.SetQuery()
+    query = query_info.query
+    self.assertEqual(model._OrderSpec(query),
+                     [('points', False), ('__key__', False)])
+    # pylint:enable-msg=W0212
+
+    results, cursor, more = query.fetch_page(1)
+    self.assertEqual([result.points for result in results], [2])
+    self.assertTrue(more)
+    results, _, _ = query.fetch_page(1, start_cursor=cursor)
+    self.assertEqual([result.points for result in results], [3])
+
+    # Queries changed by the decorated method are ordered in the same way
+    query = Score.query(Score.player.IN(['a', 'b']), Score.points > 1)
+    # pylint:disable-msg=W0212
+    result = Score._FetchCollectionAsync(
+        query, 1, collection_fields=('points',)).get_result()
+    # pylint:enable-msg=W0212
+    self.assertEqual([item.points for item in result.items], [2])
+    self.assertNotEqual(result.nextPageToken, None)
+
+  def testInvalidOperatorsAreBadRequests(self):
+    """Tests that invalid combinations of operators fail as bad requests."""
+    # pylint:disable-msg=W0212
+    query_info = Score()._endpoints_query_info
+    query_info._AddOperatorFilter(Score.points, 'gte', 1)
+    self.assertRaises(endpoints.BadRequestException,
+                      query_info._AddOperatorFilter, Score.player, 'lt', 'b')
+    # pylint:enable-msg=W0212
+
+    query_info.order = 'player'
+    self.assertRaises(endpoints.BadRequestException, query_info.SetQuery)
+
+
+class FanOutTests(ModelTestCase):
+  """Tests for disjunctive queries fetched one query per branch."""
+
+  def _FetchAll(self, modelclass, query, limit, collection_fields=None,
+                **query_options):
+    """Fetches every page of a query, resuming it from the page tokens."""
+    # pylint:disable-msg=W0212
+    pages = []
+    next_page_token = ''
+    while next_page_token is not None:
+      if next_page_token:
+        query_options['start_cursor'] = modelclass._DecodePageToken(
+            next_page_token)
+      result = modelclass._FetchCollectionAsync(
+          query, limit, collection_fields=collection_fields,
+          query_options=query_options).get_result()
+      pages.append(result.items)
+      next_page_token = result.nextPageToken
+    # pylint:enable-msg=W0212
+    return pages
+
+  def testBranchCursors(self):
+    """Tests encoding and decoding the cursors of each branch."""
+    # pylint:disable-msg=W0212
+    Score(points=1).put()
+    _, cursor, _ = Score.query().fetch_page(1)
+    branch_cursors = model._BranchCursors([cursor, None,
+                                           model._BRANCH_EXHAUSTED])
+
+    for codec in (None, page_token.PageTokenCodec(secret='secret')):
+      token = branch_cursors.to_websafe_string(codec=codec)
+      self.assertTrue(token.startswith(model.COMPOSITE_PAGE_TOKEN_PREFIX))
+      decoded = model._BranchCursors.from_websafe_string(token, codec=codec)
+      self.assertEqual(decoded.cursors[0].to_websafe_string(),
+                       cursor.to_websafe_string())
+      self.assertEqual(decoded.cursors[1], None)
+      self.assertTrue(decoded.cursors[2] is model._BRANCH_EXHAUSTED)
+
+    self.assertRaises(ValueError, model._BranchCursors.from_websafe_string,
+                      cursor.to_websafe_string())
+    # pylint:enable-msg=W0212
+
+  def testMergeAcrossPages(self):
+    """Tests that the branches are merged in order without duplicates."""
+    for player, points in (('a', 5), ('b', 1), ('c', 3), ('a', 2), ('b', 4),
+                           ('c', 0)):
+      Score(player=player, points=points).put()
+
+    query = Score.query(Score.player.IN(['a', 'b'])).order(Score.points,
+                                                          Score._key)
+    pages = self._FetchAll(Score, query, 2)
+    self.assertEqual([[item.points for item in page] for page in pages],
+                     [[1, 2], [4, 5]])
+
+    query = Score.query(Score.player.IN(['a', 'b'])).order(-Score.points,
+                                                          Score._key)
+    pages = self._FetchAll(Score, query, 3)
+    self.assertEqual([[item.points for item in page] for page in pages],
+                     [[5, 4, 2], [1]])
+
+  def testKeysOnlyWithOrder(self):
+    """Tests keys-only disjunctive queries ordered by a property."""
+    keys = [Score(player=player, points=points).put()
+            for player, points in (('a', 3), ('b', 1), ('a', 2))]
+
+    query = Score.query(Score.player.IN(['a', 'b'])).order(Score.points,
+                                                          Score._key)
+    pages = self._FetchAll(Score, query, 2, collection_fields=('id',),
+                           keys_only=True)
+    self.assertEqual([[item.id for item in page] for page in pages],
+                     [[keys[1].id(), keys[2].id()], [keys[0].id()]])
+
+  def testRepeatedOrder(self):
+    """Tests that results ordered by a repeated property are not merged."""
+    Tagged(group='a', tags=['x', 'm']).put()
+    Tagged(group='b', tags=['k', 'z']).put()
+    Tagged(group='a', tags=['l']).put()
+    Tagged(group='c', tags=['a']).put()
+
+    # Ascending orders use the smallest value, descending the largest
+    query = Tagged.query(Tagged.group.IN(['a', 'b'])).order(Tagged.tags)
+    pages = self._FetchAll(Tagged, query, 2)
+    self.assertEqual([[item.tags for item in page] for page in pages],
+                     [[['k', 'z'], ['l']], [['x', 'm']]])
+
+    query = Tagged.query(Tagged.group.IN(['a', 'b'])).order(-Tagged.tags)
+    pages = self._FetchAll(Tagged, query, 2)
+    self.assertEqual([[item.tags for item in page] for page in pages],
+                     [[['k', 'z'], ['x', 'm']], [['l']]])
+
+  def testMismatchedPageToken(self):
+    """Tests that composite page tokens of other queries are bad requests."""
+    # pylint:disable-msg=W0212
+    query = Score.query(Score.player.IN(['a', 'b']))
+    start_cursor = model._BranchCursors([None, None, None])
+    self.assertRaises(
+        endpoints.BadRequestException,
+        Score._FetchCollectionAsync(
+            query, 1, query_options={'start_cursor': start_cursor}).get_result)
+    self.assertRaises(
+        endpoints.BadRequestException,
+        Score._FetchCollectionAsync(
+            Score.query(), 1,
+            query_options={'start_cursor': start_cursor}).get_result)
+    # pylint:enable-msg=W0212
+
+
+class BatchTests(ModelTestCase):
+  """Tests for pages fetched and converted to messages in batches."""
+
+  def testBatchesMatchPage(self):
+    """Tests that a page fetched in batches matches the page fetched at once."""
+    owner_keys = [Owner(name=name).put() for name in ('Ann', 'Bob', 'Cy')]
+    for index in range(5):
+      Pet(owner=owner_keys[index % 3]).put()
+    query = Pet.query().order(Pet.key)
+
+    # pylint:disable-msg=W0212
+    expected = Pet._FetchCollectionAsync(
+        query, 4, collection_fields=('owner',), expand=('owner',)).get_result()
+    result = Pet._FetchCollectionAsync(
+        query, 4, collection_fields=('owner',), expand=('owner',),
+        batch_size=3).get_result()
+    self.assertEqual(result, expected)
+    self.assertEqual([item.owner.name for item in result.items],
+                     ['Ann', 'Bob', 'Cy', 'Ann'])
+    self.assertNotEqual(result.nextPageToken, None)
+
+    result = Pet._FetchCollectionAsync(
+        query, 4, collection_fields=('owner',),
+        query_options={'start_cursor': Pet._DecodePageToken(
+            result.nextPageToken)}, batch_size=3).get_result()
+    # pylint:enable-msg=W0212
+    self.assertEqual(len(result.items), 1)
+    self.assertEqual(result.nextPageToken, None)
+
+
+class PrefetchTests(ModelTestCase):
+  """Tests for prefetching the next page of query results."""
+
+  def setUp(self):
+    """Empties the caches of the Prefetched model."""
+    super(PrefetchTests, self).setUp()
+    # pylint:disable-msg=W0212
+    Prefetched._query_result_cache.Clear()
+    Prefetched._page_prefetcher.Clear()
+    # pylint:enable-msg=W0212
+    HeldThread.held = []
+
+  def _FetchPage(self, start_cursor=None):
+    """Gets a page of Prefetched entities, caching and prefetching pages."""
+    # pylint:disable-msg=W0212
+    return Prefetched._QueryCollectionAsync(
+        Prefetched.query().order(Prefetched.points), 1,
+        collection_fields=('points',),
+        query_options={'start_cursor': start_cursor}, cache_results=True,
+        prefetch=True).get_result()
+    # pylint:enable-msg=W0212
+
+  def testPrefetchAfterResponse(self):
+    """Tests that the next page is stored without holding up the response."""
+    for points in (1, 2, 3):
+      Prefetched(points=points).put()
+    # pylint:disable-msg=W0212
+    prefetcher = Prefetched._page_prefetcher
+    # pylint:enable-msg=W0212
+
+    # The response is returned while the prefetch is still held
+    result = self._FetchPage()
+    self.assertEqual([item.points for item in result.items], [1])
+    self.assertEqual(prefetcher.started, 1)
+    self.assertEqual(len(HeldThread.held), 1)
+    HeldThread.ReleaseAll()
+
+    # pylint:disable-msg=W0212
+    next_cursor = Prefetched._DecodePageToken(result.nextPageToken)
+    # pylint:enable-msg=W0212
+    result = self._FetchPage(next_cursor)
+    self.assertEqual([item.points for item in result.items], [2])
+    self.assertEqual((prefetcher.hits, prefetcher.started), (1, 2))
+
+    # Pages served from the result cache don't prefetch the next page
+    self.assertEqual([item.points for item in self._FetchPage().items], [1])
+    self.assertEqual(prefetcher.started, 2)
+    HeldThread.ReleaseAll()
+
+  def testPrefetchRequiresCachedResults(self):
+    """Tests that only query methods caching results prefetch pages."""
+    self.assertRaises(TypeError, Prefetched.query_method,
+                      prefetch_next_page=True)
+    self.assertRaises(TypeError, Plain.query_method, cache_results=True,
+                      prefetch_next_page=True)
+
+
+class ProjectionTests(ModelTestCase):
+  """Tests for projection queries of query methods."""
+
+  def testEqualityFilterNames(self):
+    """Tests the model._EqualityFilterNames method."""
+    # pylint:disable-msg=W0212
+    query = Score.query(Score.player == 'a', Score.points > 1)
+    self.assertEqual(model._EqualityFilterNames(query.filters),
+                     set(['player']))
+    query = Score.query(Score.points.IN([1, 2]))
+    self.assertEqual(model._EqualityFilterNames(query.filters),
+                     set(['points']))
+    self.assertEqual(model._EqualityFilterNames(None), set())
+    # pylint:enable-msg=W0212
+
+  def testProjectionDroppedForEqualityFilters(self):
+    """Tests that properties filtered by equality are not projected."""
+    Score(player='a', points=1).put()
+    Score(player='b', points=2).put()
+    query_options = {'projection': ['player', 'points']}
+
+    # pylint:disable-msg=W0212
+    result = Score._QueryCollectionAsync(
+        Score.query(Score.player == 'a'), 10,
+        collection_fields=('player', 'points'),
+        query_options=query_options).get_result()
+    self.assertEqual([(item.player, item.points) for item in result.items],
+                     [('a', 1)])
+
+    result = Score._QueryCollectionAsync(
+        Score.query(Score.points > 1), 10,
+        collection_fields=('player', 'points'),
+        query_options=query_options).get_result()
+    # pylint:enable-msg=W0212
+    self.assertEqual([(item.player, item.points) for item in result.items],
+                     [('b', 2)])
+    self.assertEqual(query_options, {'projection': ['player', 'points']})
+
+
+class AggregateTests(ModelTestCase):
+  """Tests for aggregating the results of queries."""
+
+  def _Totals(self, result):
+    """Maps the player of each group to its count and aggregates."""
+    return dict((item.group.player, (item.count, item.points__sum,
+                                     item.points__max))
+                for item in result.items)
+
+  def testAggregateCollection(self):
+    """Tests the EndpointsModel.AggregateCollection method."""
+    collection_class = Score.AggregateCollection(
+        group_by=('player',), aggregates=('points__sum', 'points__max'))
+    self.assertTrue(collection_class is Score.AggregateCollection(
+        group_by=['player'], aggregates=['points__sum', 'points__max']))
+
+    group_class = collection_class.items.type
+    self.assertTrue(isinstance(group_class.field_by_name('points__sum'),
+                               messages.IntegerField))
+    self.assertFalse(group_class(points__sum=1).is_initialized())
+    player_class = Score.ProtoModel(fields=('player',))
+    group_message = group_class(group=player_class(player='a'), count=2,
+                                points__sum=3, points__max=2)
+    self.assertTrue(group_message.is_initialized())
+
+    # Without group_by, there is no group field
+    group_class = Score.AggregateCollection().items.type
+    self.assertRaises(KeyError, group_class.field_by_name, 'group')
+    self.assertTrue(group_class(count=0).is_initialized())
+
+    self.assertRaises(TypeError, Score.AggregateCollection,
+                      group_by=('missing',))
+    self.assertRaises(TypeError, Tagged.AggregateCollection,
+                      group_by=('tags',))
+    self.assertRaises(TypeError, Score.AggregateCollection,
+                      aggregates=('player__sum',))
+    self.assertRaises(TypeError, Score.AggregateCollection,
+                      aggregates=('points__avg',))
+
+  def testAggregateAsync(self):
+    """Tests the EndpointsModel._AggregateAsync method."""
+    Score(player='a', points=1).put()
+    Score(player='a', points=3).put()
+    Score(player='b', points=2).put()
+    Score(player='b').put()
+    aggregates = ('points__sum', 'points__max')
+
+    # pylint:disable-msg=W0212
+    result = Score._AggregateAsync(Score.query(), group_by=('player',),
+                                   aggregates=aggregates,
+                                   batch_size=2).get_result()
+    # Entities without a value are counted, but not aggregated
+    self.assertEqual(self._Totals(result), {'a': (2, 4, 3), 'b': (2, 2, 2)})
+
+    query_future = ndb.Future()
+    query_future.set_result(Score.query(Score.player == 'a'))
+    result = Score._AggregateAsync(query_future,
+                                   aggregates=aggregates).get_result()
+    self.assertEqual([(item.group, item.count, item.points__sum)
+                      for item in result.items], [(None, 2, 4)])
+
+    result = Score._AggregateAsync(Score.query(Score.player == 'c'),
+                                   aggregates=aggregates).get_result()
+    self.assertEqual(result.items, [])
+
+    future = Score._AggregateAsync(Score.query(), group_by=('player',),
+                                   max_groups=1)
+    self.assertRaises(model.AggregateGroupsExceededError, future.get_result)
+    # pylint:enable-msg=W0212
+
+  def testAggregateProjection(self):
+    """Tests that projections are checked against the final query."""
+    Score(player='a', points=1).put()
+    Score(player='a', points=3).put()
+    Score(player='b', points=2).put()
+    aggregates = ('points__sum', 'points__max')
+
+    # pylint:disable-msg=W0212
+    for query in (Score.query(), Score.query(Score.player == 'a')):
+      result = Score._AggregateAsync(query, group_by=('player',),
+                                     aggregates=aggregates,
+                                     projection=['player', 'points'])
+      expected = Score._AggregateAsync(query, group_by=('player',),
+                                       aggregates=aggregates)
+      self.assertEqual(self._Totals(result.get_result()),
+                       self._Totals(expected.get_result()))
+    # pylint:enable-msg=W0212
+
+  def testAggregateMethodProjection(self):
+    """Tests the projections chosen by aggregate_method."""
+    def Totals(unused_service, query):
+      return query
+
+    def Projection(modelclass, **kwargs):
+      # pylint:disable-msg=W0212
+      modelclass.aggregate_method(**kwargs)(Totals)
+      return modelclass._query_methods[-1][2]
+      # pylint:enable-msg=W0212
+
+    # Projections are opt-in
+    self.assertEqual(Projection(Result, group_by=('team',),
+                                aggregates=('goals__sum',)), None)
+    self.assertEqual(Projection(Result, group_by=('team',),
+                                aggregates=('goals__sum',),
+                                use_projection=model.PROJECTION_AUTO),
+                     ['team', 'goals'])
+    self.assertEqual(Projection(Score, group_by=('player',),
+                                aggregates=('points__sum',),
+                                use_projection=True),
+                     ['player', 'points'])
+
+    # Entities without a value for an optional property would not be counted
+    self.assertEqual(Projection(Score, group_by=('player',),
+                                aggregates=('points__sum',),
+                                use_projection=model.PROJECTION_AUTO), None)
+    self.assertEqual(Projection(Result, query_fields=('team',),
+                                group_by=('team',), aggregates=('goals__sum',),
+                                use_projection=model.PROJECTION_AUTO), None)
+
+
+class CountTests(ModelTestCase):
+  """Tests for counting the results of queries."""
+
+  def testCountMethodFilters(self):
+    """Tests that count_method counts the results of the filtered query."""
+    for player, points in (('a', 1), ('a', 2), ('a', 3), ('b', 5)):
+      Score(player=player, points=points).put()
+
+    def Count(unused_service, query):
+      return query
+
+    query_fields = ('player', 'points__gt', 'limit')
+    api_method = Score.count_method(query_fields=query_fields)(Count)
+    request_class = Score.ResourceContainer(
+        fields=query_fields, allow_query_operators=True).combined_message_class
+
+    response = api_method(None, request_class(player='a', points__gt=1))
+    self.assertEqual((response.count, response.capped), (2, False))
+    response = api_method(None, request_class(player='a'))
+    self.assertEqual((response.count, response.capped), (3, False))
+
+    # The limit caps the count
+    response = api_method(None, request_class(player='a', limit=2))
+    self.assertEqual((response.count, response.capped), (2, True))
+    response = api_method(None, request_class(player='a', limit=3))
+    self.assertEqual((response.count, response.capped), (3, False))
+
+  def testCountCap(self):
+    """Tests counts capped at the limit."""
+    for points in range(5):
+      Score(points=points).put()
+
+    # pylint:disable-msg=W0212
+    result = Score._CountAsync(Score.query(), 3).get_result()
+    self.assertEqual((result.count, result.capped), (3, True))
+    result = Score._CountAsync(Score.query(), 5).get_result()
+    self.assertEqual((result.count, result.capped), (5, False))
+    result = Score._CountAsync(Score.query(Score.points >= 3), 10).get_result()
+    self.assertEqual((result.count, result.capped), (2, False))
+    result = Score._CountAsync(Score.query(Score.points > 10), 10,
+                               exists_only=True).get_result()
+    # pylint:enable-msg=W0212
+    self.assertFalse(result.exists)
+
+  def testCountInFilter(self):
+    """Tests that results matching several IN values are counted once."""
+    for tags in (['a', 'b'], ['a'], ['b', 'c'], ['c']):
+      Tagged(group='x', tags=tags).put()
+
+    query = Tagged.query(Tagged.tags.IN(['a', 'b']))
+    # pylint:disable-msg=W0212
+    result = Tagged._CountAsync(query, 10).get_result()
+    self.assertEqual((result.count, result.capped), (3, False))
+    result = Tagged._CountAsync(query, 2).get_result()
+    self.assertEqual((result.count, result.capped), (2, True))
+    result = Tagged._CountAsync(query, 3).get_result()
+    self.assertEqual((result.count, result.capped), (3, False))
+    # pylint:enable-msg=W0212
+
+
+class MultiMethodTests(ModelTestCase):
+  """Tests for writing collections of entities with multi_method."""
+
+  def _Call(self, modelclass, operation, items, handler=None):
+    """Calls a multi_method API method with a request holding the items."""
+    def Write(unused_service, entities):
+      return entities
+
+    api_method = modelclass.multi_method(
+        request_fields=('id', 'text'), response_fields=('id', 'text'),
+        operation=operation)(handler or Write)
+    request_class = modelclass.ProtoCollection(
+        collection_fields=('id', 'text'))
+    item_class = request_class.field_by_name('items').type
+    return api_method(None, request_class(
+        items=[item_class(**item) for item in items]))
+
+  def _Statuses(self, response):
+    """Gets the index, success and error of each status in a response."""
+    return [(status.index, status.success, status.error)
+            for status in response.statuses]
+
+  def testMixedStatuses(self):
+    """Tests that each item gets its own status."""
+    key = Plain(text='a').put()
+    response = self._Call(Plain, model.MULTI_UPDATE, [
+        {'id': key.id(), 'text': 'b'},
+        {'id': key.id() + 1, 'text': 'c'},
+        {'text': 'd'},
+    ])
+    self.assertEqual(self._Statuses(response), [
+        (0, True, None),
+        (1, False, model.MULTI_NOT_FOUND_ERROR),
+        (2, False, model.MULTI_NO_KEY_ERROR),
+    ])
+    self.assertEqual([item.text for item in response.items], ['b', 'c', 'd'])
+    self.assertEqual(key.get().text, 'b')
+    self.assertEqual(Plain.query().count(), 1)
+
+    # Statuses keep the position of the items the decorated method reorders
+    def Reverse(unused_service, entities):
+      return entities[::-1]
+    response = self._Call(Plain, model.MULTI_DELETE,
+                          [{'id': key.id()}, {'id': key.id() + 1}],
+                          handler=Reverse)
+    self.assertEqual(self._Statuses(response), [
+        (1, False, model.MULTI_NOT_FOUND_ERROR),
+        (0, True, None),
+    ])
+    self.assertEqual(key.get(), None)
+
+  def testTransaction(self):
+    """Tests writes made in and out of a transaction."""
+    items = [{'text': 'a'}, {'text': 'b'}]
+    response = ndb.transaction(
+        lambda: self._Call(Plain, model.MULTI_INSERT, items), xg=True)
+    self.assertEqual(self._Statuses(response),
+                     [(0, True, None), (1, True, None)])
+    self.assertEqual(sorted(entity.text for entity in Plain.query()),
+                     ['a', 'b'])
+
+    # Writes in a transaction which is rolled back are discarded
+    def InsertAndRollback():
+      self._Call(Plain, model.MULTI_INSERT, [{'text': 'c'}])
+      raise ndb.Rollback()
+    ndb.transaction(InsertAndRollback)
+    self.assertEqual(Plain.query().count(), 2)
+
+    response = self._Call(Plain, model.MULTI_INSERT, [{'text': 'c'}])
+    self.assertEqual(self._Statuses(response), [(0, True, None)])
+    self.assertEqual(Plain.query().count(), 3)
+
+  def testRepeatedIds(self):
+    """Tests requests holding the same id more than once."""
+    for modelclass in (Plain, DeferredCoalesced):
+      key = modelclass(text='a').put()
+      response = self._Call(modelclass, model.MULTI_UPDATE, [
+          {'id': key.id(), 'text': 'b'},
+          {'id': key.id(), 'text': 'c'},
+      ])
+      self.assertEqual(self._Statuses(response),
+                       [(0, True, None), (1, True, None)])
+      self.assertTrue(key.get().text in ('b', 'c'))
+      self.assertEqual(modelclass.query().count(), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
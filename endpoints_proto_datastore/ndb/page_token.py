@@ -0,0 +1,154 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Page token codec used by EndpointsModel query methods.
+
+By default page tokens are the websafe strings of query cursors. A model class
+can instead set a PageTokenCodec, which can sign tokens and remembers the
+cursors of recently seen tokens:
+
+  class Event(EndpointsModel):
+    _page_token_codec = PageTokenCodec(secret='...')
+
+Tokens produced by a codec are only understood by a codec with the same
+secret, so changing the secret invalidates the tokens held by clients.
+"""
+
+import base64
+import hashlib
+import hmac
+
+from .. import utils
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore import datastore_query
+
+
+__all__ = ['PageTokenCodec']
+
+
+PAGE_TOKEN_CACHE_SIZE_DEFAULT = 1000
+SIGNATURE_SIZE = 16
+TOKEN_FORMAT = '\x00'
+INVALID_PAGE_TOKEN_TEMPLATE = 'Invalid page token %r.'
+
+
+def _CompareDigest(a, b):
+  """Compares two strings in constant time, as hmac.compare_digest does.
+
+  Used when hmac.compare_digest is not available, before Python 2.7.7.
+
+  Args:
+    a: A string.
+    b: A string.
+
+  Returns:
+    Boolean indicating whether or not the strings are equal.
+  """
+  if len(a) != len(b):
+    return False
+  result = 0
+  for char_a, char_b in zip(a, b):
+    result |= ord(char_a) ^ ord(char_b)
+  return result == 0
+
+
+_compare_digest = getattr(hmac, 'compare_digest', _CompareDigest)
+
+
+class PageTokenCodec(object):
+  """Encodes query cursors as optionally signed page tokens.
+
+  A token is the urlsafe base64 encoding, without padding, of a format byte
+  followed by the cursor bytes, preceded by an HMAC of the rest if a secret is
+  set. The format byte allows tokens of a later format to be told apart.
+  Decoded cursors are kept in an LRU cache keyed by token, and each encoded
+  token is added to it, so the next page request of a client paging through
+  results doesn't decode its token again.
+
+  Attributes:
+    cache: The utils.LRUCache holding decoded cursors. Its hit and miss
+        counts can be used for tuning.
+  """
+
+  def __init__(self, secret=None, cache_size=PAGE_TOKEN_CACHE_SIZE_DEFAULT):
+    """Constructor for PageTokenCodec.
+
+    Args:
+      secret: An optional string, defaults to None. If set, tokens are signed
+          with it and tokens with a bad signature are rejected.
+      cache_size: An optional positive integer, defaults to
+          PAGE_TOKEN_CACHE_SIZE_DEFAULT. The number of decoded cursors kept.
+    """
+    self._secret = secret
+    self.cache = utils.LRUCache(cache_size)
+
+  def _Sign(self, data):
+    """Computes the signature of token data.
+
+    Args:
+      data: The string of token data following the signature.
+
+    Returns:
+      A string of SIGNATURE_SIZE bytes.
+    """
+    return hmac.new(self._secret, data, hashlib.sha256).digest()[
+        :SIGNATURE_SIZE]
+
+  def Encode(self, cursor):
+    """Encodes a cursor as a page token.
+
+    Args:
+      cursor: A datastore_query.Cursor.
+
+    Returns:
+      The page token string.
+    """
+    data = TOKEN_FORMAT + cursor.to_bytes()
+    if self._secret is not None:
+      data = self._Sign(data) + data
+
+    token = base64.urlsafe_b64encode(data).rstrip('=')
+    self.cache.Set(token, cursor)
+    return token
+
+  def Decode(self, token):
+    """Decodes a page token created by Encode.
+
+    Args:
+      token: The page token string.
+
+    Returns:
+      The datastore_query.Cursor the token was created from.
+
+    Raises:
+      datastore_errors.BadValueError: if the token is malformed or its
+          signature does not match, as Cursor.from_websafe_string does for
+          invalid websafe strings.
+    """
+    cursor = self.cache.Get(token)
+    if cursor is not None:
+      return cursor
+
+    # Tokens are ASCII. Encoding one which is not raises a UnicodeError, which
+    # is a ValueError
+    try:
+      data = base64.urlsafe_b64decode(token.encode('ascii') +
+                                      '=' * (-len(token) % 4))
+    except (TypeError, ValueError):
+      raise datastore_errors.BadValueError(INVALID_PAGE_TOKEN_TEMPLATE %
+                                           (token,))
+
+    if self._secret is not None:
+      signature, data = data[:SIGNATURE_SIZE], data[SIGNATURE_SIZE:]
+      if not _compare_digest(signature, self._Sign(data)):
+        raise datastore_errors.BadValueError(INVALID_PAGE_TOKEN_TEMPLATE %
+                                             (token,))
+
+    data_format, cursor_bytes = data[:1], data[1:]
+    if data_format != TOKEN_FORMAT:
+      raise datastore_errors.BadValueError(INVALID_PAGE_TOKEN_TEMPLATE %
+                                           (token,))
+
+    cursor = datastore_query.Cursor.from_bytes(cursor_bytes)
+    self.cache.Set(token, cursor)
+    return cursor
@@ -0,0 +1,142 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+
+"""Tests for ndb/page_token.py."""
+
+
+import base64
+import unittest
+
+from . import page_token
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+
+class Note(ndb.Model):
+  """Simple model used to create query cursors."""
+  text = ndb.StringProperty()
+
+
+def _Unpack(token):
+  """Decodes the bytes of a page token."""
+  return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+
+
+def _Pack(data):
+  """Encodes bytes as a page token, without padding."""
+  return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+class PageTokenTests(unittest.TestCase):
+  """Tests for the endpoints_proto_datastore.ndb.page_token module."""
+
+  def setUp(self):
+    """Activates the datastore stub and creates a query cursor."""
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    Note(text='a').put()
+    Note(text='b').put()
+    _, self.cursor, _ = Note.query().fetch_page(1)
+    self.cursor_bytes = self.cursor.to_bytes()
+
+  def tearDown(self):
+    """Deactivates the stubs."""
+    self.testbed.deactivate()
+
+  def testRoundTrip(self):
+    """Tests encoding and decoding cursors with page_token.PageTokenCodec."""
+    for secret in (None, 'secret'):
+      codec = page_token.PageTokenCodec(secret=secret)
+      token = codec.Encode(self.cursor)
+      self.assertFalse(token.endswith('='))
+      self.assertEqual(codec.Decode(token).to_bytes(), self.cursor_bytes)
+      self.assertEqual(codec.cache.hits, 1)
+
+      # A codec which has not seen the token decodes it
+      other_codec = page_token.PageTokenCodec(secret=secret)
+      self.assertEqual(other_codec.Decode(token).to_bytes(),
+                       self.cursor_bytes)
+      self.assertEqual(other_codec.cache.misses, 1)
+
+    # Without a secret, the token holds the format byte and the cursor
+    codec = page_token.PageTokenCodec()
+    self.assertEqual(_Unpack(codec.Encode(self.cursor)),
+                     page_token.TOKEN_FORMAT + self.cursor_bytes)
+
+  def testPadding(self):
+    """Tests that tokens are decoded with or without their padding."""
+    codec = page_token.PageTokenCodec(secret='secret')
+    token = codec.Encode(self.cursor)
+    padded_token = token + '=' * (-len(token) % 4)
+
+    other_codec = page_token.PageTokenCodec(secret='secret')
+    self.assertEqual(other_codec.Decode(padded_token).to_bytes(),
+                     self.cursor_bytes)
+    self.assertEqual(other_codec.Decode(token).to_bytes(), self.cursor_bytes)
+
+    self.assertRaises(datastore_errors.BadValueError, other_codec.Decode, 'a')
+
+  def testNonAsciiToken(self):
+    """Tests that tokens with non-ASCII characters are rejected."""
+    for secret in (None, 'secret'):
+      codec = page_token.PageTokenCodec(secret=secret)
+      self.assertRaises(datastore_errors.BadValueError, codec.Decode,
+                        u'\xe9t\xe9')
+      self.assertRaises(datastore_errors.BadValueError, codec.Decode,
+                        '\xc3\xa9t\xc3\xa9')
+
+      # Unicode tokens holding ASCII characters are decoded
+      token = unicode(codec.Encode(self.cursor))
+      other_codec = page_token.PageTokenCodec(secret=secret)
+      self.assertEqual(other_codec.Decode(token).to_bytes(),
+                       self.cursor_bytes)
+
+  def testTamperedSignature(self):
+    """Tests that tokens with a bad signature are rejected."""
+    codec = page_token.PageTokenCodec(secret='secret')
+    data = _Unpack(codec.Encode(self.cursor))
+    tampered = chr(ord(data[0]) ^ 1) + data[1:]
+
+    other_codec = page_token.PageTokenCodec(secret='secret')
+    self.assertRaises(datastore_errors.BadValueError, other_codec.Decode,
+                      _Pack(tampered))
+
+    # Tokens signed with another secret, or not signed, are rejected too
+    other_secret = page_token.PageTokenCodec(secret='other')
+    self.assertRaises(datastore_errors.BadValueError, other_secret.Decode,
+                      codec.Encode(self.cursor))
+    unsigned = page_token.PageTokenCodec().Encode(self.cursor)
+    self.assertRaises(datastore_errors.BadValueError, other_codec.Decode,
+                      unsigned)
+    self.assertEqual(len(other_codec.cache), 0)
+
+  def testBadFormatByte(self):
+    """Tests that tokens of an unknown format are rejected."""
+    codec = page_token.PageTokenCodec(secret='secret')
+    data = '\x01' + self.cursor_bytes
+    # pylint:disable-msg=W0212
+    token = _Pack(codec._Sign(data) + data)
+    # pylint:enable-msg=W0212
+    self.assertRaises(datastore_errors.BadValueError, codec.Decode, token)
+
+    unsigned_codec = page_token.PageTokenCodec()
+    self.assertRaises(datastore_errors.BadValueError, unsigned_codec.Decode,
+                      _Pack(data))
+    self.assertRaises(datastore_errors.BadValueError, unsigned_codec.Decode,
+                      '')
+
+  def testCompareDigest(self):
+    """Tests the page_token._CompareDigest method."""
+    # pylint:disable-msg=W0212
+    self.assertTrue(page_token._CompareDigest('abc', 'abc'))
+    self.assertTrue(page_token._CompareDigest('', ''))
+    self.assertFalse(page_token._CompareDigest('abc', 'abd'))
+    self.assertFalse(page_token._CompareDigest('abc', 'ab'))
+    # pylint:enable-msg=W0212
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -110,7 +110,8 @@ class EndpointsAliasProperty(property):
   @utils.positional(2)
   def __init__(self, func=None, setter=None, fdel=None, doc=None,
                repeated=False, required=False, default=None, name=None,
-               variant=None, property_type=DEFAULT_PROPERTY_TYPE):
+               variant=None, property_type=DEFAULT_PROPERTY_TYPE,
+               batch_getter=None, key_derived=False, sets_ancestor=False):
     """Constructor for property.
 
     Attributes:
@@ -131,6 +132,12 @@ class EndpointsAliasProperty(property):
           alias properties.
       property_type: A ProtoRPC field, message class or enum class that
           describes the output of the alias property.
+      _batch_getter: An optional method used to get the value of the property
+          for every entity in a collection at once.
+      _key_derived: A boolean attribute denoting whether the value of the
+          property is computed from the entity key alone.
+      _sets_ancestor: A boolean attribute denoting whether the setter sets the
+          ancestor of the query info.
 
     Args:
       func: The method that outputs the value of the property. If None,
@@ -152,11 +159,27 @@ class EndpointsAliasProperty(property):
           be validated when a corresponding message field is created.
       property_type: A ProtoRPC field, message class or enum class that
           describes the output of the alias property.
+      batch_getter: The (optional) method used by ToMessageCollection to get
+          the values of the property for a list of entities at once, rather
+          than calling func for each entity. It is called with the model class
+          and the list of entities, and returns a list of values in the same
+          order, or an NDB future (e.g. from a tasklet) for such a list. This
+          allows related data to be retrieved with a single get_multi or query.
+          Defaults to None.
+      key_derived: Optional boolean, defaults to False. Indicates whether or
+          not func computes the value from the entity key alone, in which case
+          the property can be served by projection queries.
+      sets_ancestor: Optional boolean, defaults to False. Indicates whether or
+          not the setter sets the ancestor of the query info of the entity, so
+          the index advisor knows queries using the property have an ancestor.
     """
     self._required = required
     self._repeated = repeated
     self._name = name
     self._code_name = None
+    self._batch_getter = batch_getter
+    self._key_derived = key_derived
+    self._sets_ancestor = sets_ancestor
 
     if default is not None:
       self._default = default
@@ -214,6 +237,39 @@ class EndpointsAliasProperty(property):
     if self._name is None:
       self._name = self._code_name
 
+  def GetBatchValues(self, modelclass, entities):
+    """Gets the values of the property for a list of entities at once.
+
+    Args:
+      modelclass: The model class the entities belong to.
+      entities: A list of entities.
+
+    Returns:
+      A list of the values of the property, one for each entity.
+
+    Raises:
+      TypeError: if the property has no batch getter.
+      ValueError: if the batch getter does not return one value per entity.
+    """
+    if self._batch_getter is None:
+      raise TypeError('Property %s has no batch getter.' % (self._name,))
+
+    values = self._batch_getter(modelclass, entities)
+    if isinstance(values, ndb.Future):
+      values = values.get_result()
+
+    values = list(values)
+    if len(values) != len(entities):
+      raise ValueError('Batch getter for property %s returned %d values for '
+                       '%d entities.' % (self._name, len(values),
+                                         len(entities)))
+    return values
+
+
+# Alias property values may be entities when the property type is a message
+ndb_utils.NDB_PROPERTY_TO_VALUE[EndpointsAliasProperty] = (
+    ndb_utils.EntityToMessage)
+
 
 class EndpointsUserProperty(ndb.UserProperty):
   """A custom user property for interacting with user ID tokens.
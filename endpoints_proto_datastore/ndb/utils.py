@@ -17,12 +17,18 @@ these are:
   ComputedProperty -- a variant of this class is needed to determine the type
                       desired of the output. Such a variant is provided in
                       properties
+
+Similarly, the dictionaries NDB_PROPERTY_TO_VALUE and NDB_PROPERTY_FROM_VALUE
+register the methods used to serialize property values to ProtoRPC values and
+to deserialize them back again. Property classes which are not registered (and
+which have no registered ancestor) have values which need no conversion.
 """
 
 from .. import utils
 
 from protorpc import messages
 
+from google.appengine.api import datastore_types
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import msgprop
 
@@ -226,3 +232,87 @@ def UserPropertyToProto(prop, index):
   kwargs = GetKeywordArgs(prop, include_default=False)
   return messages.MessageField(UserMessage, index, **kwargs)
 NDB_PROPERTY_TO_PROTO[ndb.UserProperty] = UserPropertyToProto
+
+
+def EntityToMessage(value):
+  """Serializes a value which may be an entity with a ToMessage method.
+
+  Args:
+    value: The value to be serialized.
+
+  Returns:
+    The ProtoRPC message for the entity if value can be converted to a message,
+        otherwise the value itself.
+  """
+  to_message = getattr(value, 'ToMessage', None)
+  if to_message is None:
+    return value
+  return to_message()
+
+
+def GeoPtToMessage(value):
+  """Serializes a GeoPt value to a GeoPtMessage."""
+  return GeoPtMessage(lat=value.lat, lon=value.lon)
+
+
+def MessageToGeoPt(value):
+  """Deserializes a GeoPtMessage to a GeoPt value."""
+  return datastore_types.GeoPt(lat=value.lat, lon=value.lon)
+
+
+def KeyToUrlsafe(value):
+  """Serializes an NDB key to its urlsafe string."""
+  return value.urlsafe()
+
+
+def UrlsafeToKey(value):
+  """Deserializes a urlsafe string to an NDB key."""
+  return ndb.Key(urlsafe=value)
+
+
+NDB_PROPERTY_TO_VALUE = {
+    ndb.BlobKeyProperty: str,
+    # Computed and structured values may be entities with a message form
+    ndb.ComputedProperty: EntityToMessage,
+    ndb.DateProperty: utils.DatetimeValueToString,
+    ndb.DateTimeProperty: utils.DatetimeValueToString,
+    ndb.GeoPtProperty: GeoPtToMessage,
+    ndb.KeyProperty: KeyToUrlsafe,
+    ndb.LocalStructuredProperty: EntityToMessage,
+    ndb.StructuredProperty: EntityToMessage,
+    ndb.TimeProperty: utils.DatetimeValueToString,
+    ndb.UserProperty: utils.UserMessageFromUser,
+}
+
+
+NDB_PROPERTY_FROM_VALUE = {
+    ndb.BlobKeyProperty: datastore_types.BlobKey,
+    ndb.DateProperty: utils.DatetimeValueFromString,
+    ndb.DateTimeProperty: utils.DatetimeValueFromString,
+    ndb.GeoPtProperty: MessageToGeoPt,
+    ndb.KeyProperty: UrlsafeToKey,
+    ndb.TimeProperty: utils.DatetimeValueFromString,
+    ndb.UserProperty: utils.UserMessageToUser,
+}
+
+
+def GetValueConverter(registry, property_class):
+  """Looks up the value converter registered for a property class.
+
+  If the property class is not registered, each class in its method resolution
+  order is tried, so subclasses of registered properties behave as the
+  registered property would.
+
+  Args:
+    registry: A dictionary from property classes to value converters, such as
+        NDB_PROPERTY_TO_VALUE or NDB_PROPERTY_FROM_VALUE.
+    property_class: The class of a property from a model.
+
+  Returns:
+    The converter registered for the closest ancestor of the property class, or
+        None if no ancestor is registered.
+  """
+  for klass in getattr(property_class, '__mro__', (property_class,)):
+    if klass in registry:
+      return registry[klass]
+  return None
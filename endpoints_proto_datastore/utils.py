@@ -6,12 +6,18 @@ The methods here are not specific to NDB or DB (the datastore APIs) and can
 be used by utility methods in the datastore API specific code.
 """
 
-__all__ = ['GeoPtMessage', 'MessageFieldsSchema', 'UserMessage',
-           'method', 'positional', 'query_method']
+__all__ = ['CountMessage', 'ExistsMessage', 'FlightTimeoutError',
+           'GeoPtMessage', 'ItemStatusMessage', 'LRUCache',
+           'MessageFieldsSchema', 'SingleFlight', 'UserMessage',
+           'aggregate_method', 'count_method', 'method', 'multi_method',
+           'positional', 'query_method']
 
 
+import collections
 import datetime
 import json
+import threading
+import time
 
 from endpoints import protojson
 from protorpc import messages
@@ -20,10 +26,13 @@ from protorpc import util as protorpc_util
 from google.appengine.api import users
 
 
-ALLOWED_DECORATOR_NAME = frozenset(['method', 'query_method'])
+ALLOWED_DECORATOR_NAME = frozenset(['aggregate_method', 'count_method',
+                                    'method', 'multi_method', 'query_method'])
 DATETIME_STRING_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 DATE_STRING_FORMAT = '%Y-%m-%d'
 TIME_STRING_FORMAT = '%H:%M:%S.%f'
+# The number of shared fields schemas kept by MessageFieldsSchema.Intern
+INTERNED_SCHEMAS_MAX = 1000
 
 positional = protorpc_util.positional
 
@@ -119,9 +128,19 @@ class MessageFieldsSchema(object):
   as a key.
 
   These objects can be used as if they were dictionaries in many contexts and
-  can be compared for equality by hash.
+  can be compared for equality by hash. The hash is computed once, when the
+  instance is created, so the name and collection name should not be changed
+  after creation.
+
+  Use Intern to get a shared instance for a given set of fields, rather than
+  creating a new instance each time the same fields are used.
   """
 
+  # Shared instances created by Intern, keyed by class, fields and basename.
+  # Set to an LRUCache of at most INTERNED_SCHEMAS_MAX instances once LRUCache
+  # is defined.
+  _interned = None
+
   def __init__(self, fields, name=None, collection_name=None, basename=''):
     """Save list/tuple or convert dictionary a list based on value ordering.
 
@@ -162,6 +181,49 @@ class MessageFieldsSchema(object):
 
     self.name = name or self._DefaultName(basename=basename)
     self.collection_name = collection_name or (self.name + 'Collection')
+    self._hash = hash((self._data, self.name, self.collection_name))
+
+  @classmethod
+  def Intern(cls, fields, basename=''):
+    """Gets a shared fields schema for the fields and basename passed in.
+
+    Fields schemas are used as cache keys for ProtoRPC message classes, and are
+    looked up every time an entity is converted to a message. Interning them
+    avoids building a new instance and a new default name on each lookup.
+
+    Args:
+      fields: A dictionary or ordered iterable which defines an index ordering
+          for fields in a ProtoRPC message class, or an existing
+          MessageFieldsSchema instance, which is returned as is.
+      basename: A basename for the default fields schema name, defaults to the
+          empty string.
+
+    Returns:
+      A MessageFieldsSchema equal to MessageFieldsSchema(fields,
+          basename=basename). The same instance is returned for equal fields
+          and basename, unless it has been evicted from the bounded cache of
+          shared instances, in which case a new, equal, instance is shared.
+
+    Raises:
+      TypeError: if the fields passed in are not a dictionary, tuple, list or
+          existing MessageFieldsSchema instance.
+    """
+    if isinstance(fields, MessageFieldsSchema):
+      return fields
+    elif isinstance(fields, dict):
+      data = _DictToTuple(fields)
+    elif isinstance(fields, (list, tuple)):
+      data = tuple(fields)
+    else:
+      # Let the constructor raise the appropriate error
+      return cls(fields, basename=basename)
+
+    intern_key = (cls, data, basename)
+    result = cls._interned.Get(intern_key)
+    if result is None:
+      result = cls(data, basename=basename)
+      cls._interned.Set(intern_key, result)
+    return result
 
   def _DefaultName(self, basename=''):
     """The default name of the fields schema.
@@ -188,27 +250,302 @@ class MessageFieldsSchema(object):
 
   def __eq__(self, other):
     """Comparison for equality that uses the hash of the object."""
+    if other is self:
+      return True
     if not isinstance(other, self.__class__):
       return False
-    return self.__hash__() == other.__hash__()
+    return self._hash == other._hash
 
   def __hash__(self):
     """Unique and idempotent hash.
 
     Uses a the property list (_data) which is uniquely defined by its elements
     and their sort order, the name of the fields schema and the collection name
-    of the fields schema.
+    of the fields schema. Computed once when the instance is created.
 
     Returns:
       Integer hash value.
     """
-    return hash((self._data, self.name, self.collection_name))
+    return self._hash
 
   def __iter__(self):
     """Iterator for loop expressions."""
     return iter(self._data)
 
 
+class LRUCache(object):
+  """A thread-safe, bounded, least recently used cache.
+
+  Entries can optionally expire a fixed number of seconds after they are set.
+  Counts of hits, misses and evictions are kept so the size and time to live
+  of a cache can be tuned.
+
+  Attributes:
+    max_size: The maximum number of entries held in the cache.
+    ttl: The number of seconds an entry is valid for, or None if entries do not
+        expire.
+    hits: The number of lookups which found a valid entry.
+    misses: The number of lookups which did not find a valid entry.
+    evictions: The number of entries removed to make room for new entries.
+  """
+
+  def __init__(self, max_size, ttl=None, clock=time.time):
+    """Constructor for LRUCache.
+
+    Args:
+      max_size: A positive integer, the maximum number of entries.
+      ttl: An optional number of seconds an entry is valid for. Defaults to
+          None, in which case entries do not expire.
+      clock: An optional callable returning the current time in seconds.
+          Defaults to time.time.
+
+    Raises:
+      TypeError: if max_size is not a positive integer.
+      TypeError: if ttl is not None or a positive number.
+    """
+    if not isinstance(max_size, (int, long)) or max_size < 1:
+      raise TypeError('Cache size must be a positive integer.')
+    if ttl is not None and (not isinstance(ttl, (int, long, float)) or
+                            ttl <= 0):
+      raise TypeError('Cache time to live must be a positive number.')
+
+    self.max_size = max_size
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._clock = clock
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    """The number of entries in the cache, including expired entries."""
+    return len(self._entries)
+
+  def __contains__(self, key):
+    """Checks for a valid entry without affecting the statistics."""
+    with self._lock:
+      entry = self._entries.get(key)
+      return entry is not None and not self._Expired(entry)
+
+  @property
+  def hit_rate(self):
+    """The fraction of lookups which found a valid entry."""
+    lookups = self.hits + self.misses
+    if lookups == 0:
+      return 0.0
+    return float(self.hits) / lookups
+
+  def _Expired(self, entry):
+    """Checks if an entry has expired.
+
+    Args:
+      entry: An (expiration time, value) pair stored in the cache.
+
+    Returns:
+      Boolean indicating whether or not the entry has expired.
+    """
+    expires = entry[0]
+    return expires is not None and expires <= self._clock()
+
+  def Get(self, key, default=None):
+    """Looks up a value in the cache.
+
+    A valid entry becomes the most recently used entry, while an expired entry
+    is removed.
+
+    Args:
+      key: The key of the value.
+      default: An optional value returned if there is no valid entry. Defaults
+          to None.
+
+    Returns:
+      The cached value, or default if there is no valid entry for the key.
+    """
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None or self._Expired(entry):
+        self.misses += 1
+        return default
+
+      self._entries[key] = entry
+      self.hits += 1
+      return entry[1]
+
+  def Set(self, key, value):
+    """Stores a value in the cache.
+
+    If the cache is full, the least recently used entry is evicted.
+
+    Args:
+      key: The key of the value.
+      value: The value to be stored.
+    """
+    expires = None
+    if self.ttl is not None:
+      expires = self._clock() + self.ttl
+
+    with self._lock:
+      self._entries.pop(key, None)
+      if len(self._entries) >= self.max_size:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+      self._entries[key] = (expires, value)
+
+  def Delete(self, key):
+    """Removes the entry for a key from the cache, if there is one.
+
+    Args:
+      key: The key of the value.
+    """
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def Clear(self):
+    """Removes all entries from the cache. Statistics are kept."""
+    with self._lock:
+      self._entries.clear()
+
+
+MessageFieldsSchema._interned = LRUCache(INTERNED_SCHEMAS_MAX)
+
+
+class FlightTimeoutError(RuntimeError):
+  """Raised when a call shared through a SingleFlight takes too long."""
+
+
+class _FlightCall(object):
+  """The state of a call in progress in a SingleFlight.
+
+  Attributes:
+    done: A threading.Event set once the call completes.
+    result: The return value of the call.
+    error: The exception raised by the call, or None.
+    owner: The identifier of the thread which makes the call.
+    handle: An optional object attached to the call by its owner, such as an
+        NDB future for the call.
+  """
+
+  __slots__ = ('done', 'result', 'error', 'owner', 'handle')
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+    self.owner = threading.current_thread().ident
+    self.handle = None
+
+  def Wait(self, timeout=None):
+    """Waits for the call to complete.
+
+    Args:
+      timeout: An optional number of seconds to wait for. Defaults to None,
+          which waits until the call completes.
+
+    Returns:
+      The return value of the call.
+
+    Raises:
+      FlightTimeoutError: if the call did not complete within the timeout.
+      Any exception raised by the call.
+    """
+    if not self.done.wait(timeout):
+      raise FlightTimeoutError('The call did not complete within %s seconds.' %
+                               (timeout,))
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+
+class SingleFlight(object):
+  """Coalesces concurrent calls for the same key into a single call.
+
+  While a call for a key is in progress, other threads making a call for the
+  same key wait for it to complete and share its result (or exception) rather
+  than making the call themselves. Once the call completes, the next call for
+  the key is made again.
+
+  Attributes:
+    shared: The number of calls which shared the result of another call.
+  """
+
+  def __init__(self):
+    """Constructor for SingleFlight."""
+    self.shared = 0
+    self._calls = {}
+    self._lock = threading.Lock()
+
+  def Join(self, key):
+    """Joins the call in progress for a key, or starts a new one.
+
+    Used directly when the call completes asynchronously, else use Do.
+
+    Args:
+      key: A hashable key identifying the call.
+
+    Returns:
+      A tuple of the state of the call, whose Wait method returns its result,
+          and a boolean indicating whether the caller started the call. If so,
+          the caller must make the call and pass its outcome to Finish.
+    """
+    with self._lock:
+      call = self._calls.get(key)
+      if call is None:
+        call = self._calls[key] = _FlightCall()
+        return call, True
+      self.shared += 1
+      return call, False
+
+  def Finish(self, key, call, result=None, error=None):
+    """Completes a call started by Join and releases the callers waiting on it.
+
+    Args:
+      key: The hashable key identifying the call.
+      call: The state of the call returned by Join.
+      result: The optional return value of the call. Defaults to None.
+      error: The optional exception raised by the call. Defaults to None.
+    """
+    call.result = result
+    call.error = error
+    with self._lock:
+      del self._calls[key]
+    call.done.set()
+
+  def Do(self, key, function, timeout=None):
+    """Calls a function, unless a call for the same key is in progress.
+
+    Args:
+      key: A hashable key identifying the call.
+      function: A callable taking no arguments.
+      timeout: An optional number of seconds to wait for a call in progress.
+          Defaults to None, which waits until the call completes.
+
+    Returns:
+      The return value of the call made for the key.
+
+    Raises:
+      FlightTimeoutError: if the call in progress did not complete within the
+          timeout.
+      Any exception raised by the call made for the key.
+    """
+    call, leader = self.Join(key)
+    if not leader:
+      return call.Wait(timeout=timeout)
+
+    # The call is finished even if it is interrupted, else the key would stay
+    # in progress and every later caller would wait on it
+    outcome = {'error': RuntimeError('The call was interrupted.')}
+    try:
+      result = function()
+      outcome = {'result': result}
+    except Exception as error:
+      outcome = {'error': error}
+      raise
+    finally:
+      self.Finish(key, call, **outcome)
+    return result
+
+
 class GeoPtMessage(messages.Message):
   """ProtoRPC container for GeoPt instances.
 
@@ -247,6 +584,59 @@ class UserMessage(messages.Message):
   federated_identity = messages.StringField(4)
 
 
+class ItemStatusMessage(messages.Message):
+  """ProtoRPC container for the status of one item in a collection request.
+
+  Attributes:
+    index: Integer; The position of the item in the request collection, unset
+        for items which were not in the request.
+    success: Boolean; Whether or not the item was processed successfully.
+    error: String; A description of the failure, if the item failed.
+  """
+  # TODO(dhermes): This behavior should be regulated more directly.
+  #                This is to make sure the schema name in the discovery
+  #                document is ItemStatusMessage rather than
+  #                EndpointsProtoDatastoreItemStatusMessage.
+  __module__ = ''
+
+  index = messages.IntegerField(1)
+  success = messages.BooleanField(2, required=True)
+  error = messages.StringField(3)
+
+
+class CountMessage(messages.Message):
+  """ProtoRPC container for the number of results of a query.
+
+  Attributes:
+    count: Integer; The number of results, at most the limit of the count.
+    capped: Boolean; Whether or not the count stopped at the limit, in which
+        case there are more results than counted.
+  """
+  # TODO(dhermes): This behavior should be regulated more directly.
+  #                This is to make sure the schema name in the discovery
+  #                document is CountMessage rather than
+  #                EndpointsProtoDatastoreCountMessage.
+  __module__ = ''
+
+  count = messages.IntegerField(1, required=True)
+  capped = messages.BooleanField(2, required=True)
+
+
+class ExistsMessage(messages.Message):
+  """ProtoRPC container for whether or not a query has any results.
+
+  Attributes:
+    exists: Boolean; Whether or not the query has at least one result.
+  """
+  # TODO(dhermes): This behavior should be regulated more directly.
+  #                This is to make sure the schema name in the discovery
+  #                document is ExistsMessage rather than
+  #                EndpointsProtoDatastoreExistsMessage.
+  __module__ = ''
+
+  exists = messages.BooleanField(1, required=True)
+
+
 def UserMessageFromUser(user):
   """Converts a native users.User object to a UserMessage.
 
@@ -421,6 +811,60 @@ def query_method(modelclass, **kwargs):
   return _GetEndpointsMethodDecorator('query_method', modelclass, **kwargs)
 
 
+@positional(1)
+def count_method(modelclass, **kwargs):
+  """Decorate a ProtoRPC method intended for counting query results
+
+  For use by the endpoints model passed in. Requires exactly one positional
+  argument and passes the rest of the keyword arguments to the classmethod
+  "count_method" on the given class.
+
+  Args:
+    modelclass: An Endpoints model class that can create a count method.
+
+  Returns:
+    A decorator that will use the endpoint metadata to decorate an endpoints
+        count method.
+  """
+  return _GetEndpointsMethodDecorator('count_method', modelclass, **kwargs)
+
+
+@positional(1)
+def aggregate_method(modelclass, **kwargs):
+  """Decorate a ProtoRPC method intended for aggregating query results
+
+  For use by the endpoints model passed in. Requires exactly one positional
+  argument and passes the rest of the keyword arguments to the classmethod
+  "aggregate_method" on the given class.
+
+  Args:
+    modelclass: An Endpoints model class that can create an aggregate method.
+
+  Returns:
+    A decorator that will use the endpoint metadata to decorate an endpoints
+        aggregate method.
+  """
+  return _GetEndpointsMethodDecorator('aggregate_method', modelclass, **kwargs)
+
+
+@positional(1)
+def multi_method(modelclass, **kwargs):
+  """Decorate a ProtoRPC method intended for writing collections
+
+  For use by the endpoints model passed in. Requires exactly one positional
+  argument and passes the rest of the keyword arguments to the classmethod
+  "multi_method" on the given class.
+
+  Args:
+    modelclass: An Endpoints model class that can create a multi method.
+
+  Returns:
+    A decorator that will use the endpoint metadata to decorate an endpoints
+        multi method.
+  """
+  return _GetEndpointsMethodDecorator('multi_method', modelclass, **kwargs)
+
+
 class _EPDProtoJson(protojson.EndpointsProtoJson):
   """Slightly modifed version of EndpointsProtoJson.
 
@@ -3,6 +3,8 @@
 """Tests for utils.py."""
 
 
+import threading
+import time
 import unittest
 
 from protorpc import messages
@@ -40,6 +42,163 @@ class UtilsTests(unittest.TestCase):
     self.assertEqual((1, 3, -5), utils._DictToTuple(multiple_value_dictionary))
     # pylint:enable-msg=W0212
 
+  def testMessageFieldsSchemaHash(self):
+    """Tests equality and hashing of utils.MessageFieldsSchema."""
+    schema = utils.MessageFieldsSchema(('a', 'b'), basename='Base')
+    self.assertEqual(schema.name, 'Base_a_b')
+    self.assertEqual(schema.collection_name, 'Base_a_bCollection')
+    self.assertEqual(hash(schema), hash((('a', 'b'), 'Base_a_b',
+                                         'Base_a_bCollection')))
+
+    self.assertEqual(schema, utils.MessageFieldsSchema(['a', 'b'],
+                                                       basename='Base'))
+    self.assertEqual(schema, utils.MessageFieldsSchema({'a': 1, 'b': 2},
+                                                       basename='Base'))
+    self.assertEqual(schema, utils.MessageFieldsSchema(schema))
+    self.assertNotEqual(schema, utils.MessageFieldsSchema(('b', 'a'),
+                                                          basename='Base'))
+    self.assertNotEqual(schema, utils.MessageFieldsSchema(('a', 'b')))
+    self.assertNotEqual(schema, ('a', 'b'))
+
+    self.assertRaises(TypeError, utils.MessageFieldsSchema, None)
+
+  def testMessageFieldsSchemaIntern(self):
+    """Tests the utils.MessageFieldsSchema.Intern method."""
+    schema = utils.MessageFieldsSchema.Intern(('a', 'b'), basename='Base')
+    self.assertEqual(schema, utils.MessageFieldsSchema(('a', 'b'),
+                                                       basename='Base'))
+    self.assertTrue(schema is utils.MessageFieldsSchema.Intern(
+        ['a', 'b'], basename='Base'))
+    self.assertTrue(schema is utils.MessageFieldsSchema.Intern(
+        {'a': 1, 'b': 2}, basename='Base'))
+    self.assertTrue(schema is utils.MessageFieldsSchema.Intern(schema))
+
+    other_basename = utils.MessageFieldsSchema.Intern(('a', 'b'),
+                                                      basename='Other')
+    self.assertFalse(schema is other_basename)
+    self.assertEqual(other_basename.name, 'Other_a_b')
+
+    named_schema = utils.MessageFieldsSchema(('a', 'b'), name='Named')
+    self.assertTrue(named_schema is utils.MessageFieldsSchema.Intern(
+        named_schema, basename='Base'))
+
+    self.assertRaises(TypeError, utils.MessageFieldsSchema.Intern, None)
+
+    # The shared instances are bounded, evicted schemas are created again
+    interned = utils.MessageFieldsSchema._interned
+    self.assertTrue(isinstance(interned, utils.LRUCache))
+    self.assertEqual(interned.max_size, utils.INTERNED_SCHEMAS_MAX)
+    interned.Clear()
+    self.assertEqual(schema, utils.MessageFieldsSchema.Intern(
+        ('a', 'b'), basename='Base'))
+    self.assertEqual(len(interned), 1)
+
+  def testLRUCache(self):
+    """Tests the utils.LRUCache class."""
+    self.assertRaises(TypeError, utils.LRUCache, 0)
+    self.assertRaises(TypeError, utils.LRUCache, '1')
+    self.assertRaises(TypeError, utils.LRUCache, 1, ttl=0)
+
+    cache = utils.LRUCache(2)
+    self.assertEqual(cache.hit_rate, 0.0)
+    self.assertEqual(cache.Get('a'), None)
+    self.assertEqual(cache.Get('a', default=1), 1)
+    self.assertEqual(cache.misses, 2)
+
+    cache.Set('a', 1)
+    cache.Set('b', 2)
+    self.assertEqual(cache.Get('a'), 1)
+    # 'b' is now the least recently used entry
+    cache.Set('c', 3)
+    self.assertEqual(cache.evictions, 1)
+    self.assertEqual(len(cache), 2)
+    self.assertFalse('b' in cache)
+    self.assertTrue('a' in cache)
+    self.assertEqual(cache.Get('c'), 3)
+    self.assertEqual(cache.hits, 2)
+    self.assertEqual(cache.hit_rate, 0.5)
+
+    # Replacing an entry does not evict another one
+    cache.Set('c', 4)
+    self.assertEqual(cache.evictions, 1)
+    self.assertEqual(cache.Get('c'), 4)
+
+    cache.Delete('c')
+    cache.Delete('missing')
+    self.assertEqual(len(cache), 1)
+    cache.Clear()
+    self.assertEqual(len(cache), 0)
+    self.assertEqual(cache.hits, 3)
+
+  def testLRUCacheTtl(self):
+    """Tests expiration of entries in utils.LRUCache."""
+    now = [100.0]
+    cache = utils.LRUCache(2, ttl=10, clock=lambda: now[0])
+
+    cache.Set('a', 1)
+    now[0] = 109.0
+    self.assertEqual(cache.Get('a'), 1)
+    now[0] = 110.0
+    self.assertFalse('a' in cache)
+    self.assertEqual(cache.Get('a'), None)
+    self.assertEqual(len(cache), 0)
+    self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+  def testSingleFlight(self):
+    """Tests the utils.SingleFlight class."""
+    flight = utils.SingleFlight()
+    self.assertEqual(flight.Do('a', lambda: 1), 1)
+    self.assertEqual(flight.shared, 0)
+
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    def SlowCall():
+      calls.append(None)
+      started.set()
+      release.wait()
+      return 2
+
+    results = []
+    def CallInThread():
+      results.append(flight.Do('b', SlowCall))
+
+    leader = threading.Thread(target=CallInThread)
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=CallInThread)
+    follower.start()
+    while flight.shared == 0:
+      time.sleep(0.001)
+    release.set()
+    leader.join()
+    follower.join()
+    self.assertEqual(results, [2, 2])
+    self.assertEqual(len(calls), 1)
+
+    # Once complete, the call is made again
+    self.assertEqual(flight.Do('b', lambda: 3), 3)
+
+    def FailingCall():
+      raise ValueError('failed')
+    self.assertRaises(ValueError, flight.Do, 'c', FailingCall)
+    self.assertEqual(flight.Do('c', lambda: 4), 4)
+
+    # Interrupted calls are finished too
+    def InterruptedCall():
+      raise KeyboardInterrupt
+    self.assertRaises(KeyboardInterrupt, flight.Do, 'd', InterruptedCall)
+    self.assertEqual(flight.Do('d', lambda: 5), 5)
+
+    # Callers stop waiting on a call which takes longer than the timeout
+    def JoinAndAbandon():
+      flight.Join('e')
+    stuck = threading.Thread(target=JoinAndAbandon)
+    stuck.start()
+    stuck.join()
+    self.assertRaises(utils.FlightTimeoutError, flight.Do, 'e', lambda: 6,
+                      timeout=0.01)
+
   def testGeoPtMessage(self):
     """Tests the utils.GeoPtMessage protorpc message class."""
     geo_pt_message = utils.GeoPtMessage(lat=1.0)
@@ -62,6 +221,41 @@ class UtilsTests(unittest.TestCase):
     geo_pt_message = utils.GeoPtMessage(lat=1.0, lon=2.0)
     self.assertTrue(geo_pt_message.is_initialized())
 
+  def testItemStatusMessage(self):
+    """Tests the utils.ItemStatusMessage protorpc message class."""
+    status_message = utils.ItemStatusMessage(index=0)
+    self.assertEqual(status_message.index, 0)
+    self.assertEqual(status_message.success, None)
+    self.assertEqual(status_message.error, None)
+    self.assertFalse(status_message.is_initialized())
+
+    status_message.success = False
+    status_message.error = 'Entity not found.'
+    self.assertTrue(status_message.is_initialized())
+
+    self.assertRaises(messages.ValidationError,
+                      utils.ItemStatusMessage, index='0', success=True)
+
+    # Items which were not in the request have no index
+    self.assertTrue(utils.ItemStatusMessage(success=True).is_initialized())
+
+  def testCountMessages(self):
+    """Tests the utils.CountMessage and utils.ExistsMessage classes."""
+    count_message = utils.CountMessage(count=10)
+    self.assertEqual(count_message.capped, None)
+    self.assertFalse(count_message.is_initialized())
+
+    count_message.capped = True
+    self.assertTrue(count_message.is_initialized())
+
+    self.assertRaises(messages.ValidationError,
+                      utils.CountMessage, count='10', capped=False)
+
+    exists_message = utils.ExistsMessage()
+    self.assertFalse(exists_message.is_initialized())
+    exists_message.exists = False
+    self.assertTrue(exists_message.is_initialized())
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -129,9 +129,13 @@ class MyModel(EndpointsModel):
   # Since no property_type is specified, the default value of
   # messages.StringField is used.
 
+  # Since the setter sets the ancestor of queries, sets_ancestor=True lets the
+  # index advisor (endpoints_proto_datastore/ndb/index_advisor.py) know that
+  # the query methods using "parent" need ancestor indexes.
+
   # See matching_queries_to_indexes/main.py for more information on
   # EndpointsAliasProperty.
-  @EndpointsAliasProperty(setter=ParentSet, required=True)
+  @EndpointsAliasProperty(setter=ParentSet, required=True, sets_ancestor=True)
   def parent(self):
     # If _parent has not already been set on the entity, try to set it.
     if self._parent is None:
@@ -57,5 +57,24 @@ class MyApi(remote.Service):
     response_collection = MyModel.ProtoCollection()(items=response_items)
     return response_collection
 
+  # The steps above are common enough that EndpointsModel provides a decorator
+  # for them: multi_method. As with MyModelMultiInsert, the request is a
+  # collection of items. The decorator converts each item into an entity and
+  # the decorated method receives the list of entities. As with query_method,
+  # which expects the decorated method to return a query, multi_method expects
+  # the list of entities to be written to be returned. The decorator then
+  # writes them using ndb.put_multi_async, splitting very large requests into
+  # batches which are written concurrently.
+
+  # The response contains each entity written, along with a status for each
+  # item, so clients can tell which writes failed. By passing
+  # operation='update' or operation='delete' the same decorator can be used to
+  # update or delete a collection of entities identified by their "id".
+  @MyModel.multi_method(user_required=True,
+                        path='mymodel_batch',
+                        name='mymodel.insert_batch')
+  def MyModelBatchInsert(self, my_models):
+    return my_models
+
 
 application = endpoints.api_server([MyApi], restricted=False)